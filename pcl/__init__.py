@@ -2,4 +2,9 @@ from .ast import *
 from .codegen import *
 from .lexer import *
 from .parser import *
+from .closure import *
+from .bounds import *
+from .effects import *
+from .parallel import *
+from .loops import *
 from .error import *
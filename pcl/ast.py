@@ -2,7 +2,7 @@ import json
 import sys
 import warnings
 from abc import ABC, abstractmethod
-from collections import deque
+from collections import deque, OrderedDict
 from llvmlite import ir, binding
 
 from pcl.error import *
@@ -68,6 +68,17 @@ class AST(ABC):
             self.__class__.__name__, self.lineno, msg)
         warnings.warn(msg_new, PCLWarning)
 
+    def check_directives(self, directives, table):
+        '''
+            Drops the directives that are not valid for the node (see
+            LLVMDirectives) with a warning, as other compilers ignore them
+        '''
+        for directive in list(directives):
+            msg = LLVMDirectives.check(directive, table)
+            if msg:
+                self.raise_warning_helper(msg)
+                directives.remove(directive)
+
     @abstractmethod
     def sem(self):
         ''' Abstract method for semantic analysis '''
@@ -117,6 +128,53 @@ class AST(ABC):
             self.__class__.__name__, target_str, str_type(self.stype), ', '.join([str_type(arg) for arg in args]))
         self.raise_exception_helper(msg, PCLSemError)
 
+    def walk(self):
+        '''
+            Generator over the node and all of its successors
+            in pre-order.
+        '''
+        yield self
+        for k, v in vars(self).items():
+            if k in ['module', 'builder', 'symbol_table', 'callee', 'definition',
+                     'decl_type']:
+                continue
+            if isinstance(v, AST):
+                yield from v.walk()
+            elif isinstance(v, deque):
+                for x in v:
+                    if isinstance(x, AST):
+                        yield from x.walk()
+
+    def labeled(self):
+        ''' True if the node contains labeled statements (goto targets) '''
+        return any(type(node) is Statement and node.name for node in self.walk())
+
+    def side_effect_free(self):
+        '''
+            True if evaluating the node has no side effects and cannot
+            trap (calls, division, indexing and dereferencing may), thus
+            it can be evaluated speculatively.
+        '''
+        for node in self.walk():
+            if not isinstance(node, (IntegerConst, RealConst, CharConst,
+                                     BoolConst, Nil, NameLValue, ArUnOp,
+                                     ArOp, LogicUnOp, CompOp, LogicOp)):
+                return False
+            if isinstance(node, ArOp) and node.op in ['div', 'mod']:
+                return False
+        return True
+
+    def cost(self):
+        ''' Estimated cost of evaluating the node (number of nodes) '''
+        return sum(1 for node in self.walk())
+
+    def likely(self):
+        '''
+            Static prediction of a boolean expression. Returns True if it
+            is likely to hold, False if it is unlikely and None if unknown.
+        '''
+        return None
+
     def print_module(self):
         ''' Prints (non-verified) LLVM code at the given node '''
         print(str(self.module))
@@ -131,7 +189,7 @@ class AST(ABC):
         d = vars(self)
         for k, v in d.items():
 
-            if k not in ['module', 'builder', 'symbol_table']:
+            if k not in ['module', 'builder', 'symbol_table', 'callee', 'definition']:
                 if isinstance(v, AST):
                     sys.stderr.write((indent - 1) * ' ')
                     v.pprint(indent + 1)
@@ -157,6 +215,10 @@ class Program(AST):
         self.id_ = id_
         self.body = body
 
+        # Names of the main program used by procedures (set by the
+        # closure conversion). These are kept as globals.
+        self.captured = None
+
     @AST.sem_decorator
     def sem(self):
         '''
@@ -178,7 +240,8 @@ class Program(AST):
             proceeds to the program body.
         '''
         # Open program scope
-        self.symbol_table.open_scope()
+        scope = self.symbol_table.open_scope()
+        scope.captured = self.captured
 
         # Run codegen on body
         self.body.codegen()
@@ -235,6 +298,17 @@ class LocalHeader(Local):
         self.header = header
         self.body = body
 
+        # Free variables (set by the closure conversion)
+        self.free = None
+
+        # Side effects (set by the effect analysis)
+        self.effects = None
+
+        # Loop header of the self-recursive tail calls and the storage
+        # of the formals they assign (pointers, phi nodes if by-reference)
+        self.tail_block = None
+        self.tail_formals = []
+
     @AST.sem_decorator
     def sem(self):
         '''
@@ -254,7 +328,8 @@ class LocalHeader(Local):
             self.header.func_type.sem()
             header_name_entry = SymbolEntry(
                 stype=self.header.func_type.stype,
-                name_type=NameType.N_FUNCTION)
+                name_type=NameType.N_FUNCTION,
+                type_=self.header.func_type)
         else:
             # procedure
             header_name_entry = SymbolEntry(
@@ -264,6 +339,7 @@ class LocalHeader(Local):
                 name_type=NameType.N_PROCEDURE)
 
         self.symbol_table.insert(self.header.id_, header_name_entry, lineno=self.lineno)
+        self.check_directives(self.header.directives, LLVMDirectives.procedure)
 
         for formal in self.header.formals:
             formal.sem()
@@ -284,7 +360,8 @@ class LocalHeader(Local):
             formal.sem()
             for id_ in formal.ids:
                 id_entry = SymbolEntry(
-                    stype=formal.stype, name_type=NameType.N_VAR)
+                    stype=formal.stype, name_type=NameType.N_VAR,
+                    type_=formal.type_)
                 self.symbol_table.insert(id_, id_entry, lineno=self.lineno)
 
         # Sem the body
@@ -302,16 +379,18 @@ class LocalHeader(Local):
                     by an ir.Argument of type t
                     1b. A parameter x with type t that passes by reference is accompanied
                     by an ir.Argument of type t*
+                    1c. A free variable x with type t (see ClosureConverter) is
+                    accompanied by an extra ir.Argument of type t*
                 2. Register the function signature (ir.FunctionType)
                     2a. Check if forward f(...) : type is defined
                 3. Register the function to the symbol table (codegen value)
                 4. Open a scope
-                5. Register arguments as local variables (which are global wrt to
-                    the inside scopes)
+                5. Register arguments as local variables
                     5a. A parameter x with type t that passes by value is copied
-                    within the ir.Function body
-                    5b. A parameter x with type t that passes by value has its pointer
-                    stored
+                    to the activation frame of the ir.Function
+                    5b. A parameter x with type t that passes by reference has its
+                    pointer stored
+                    5c. A free variable has its pointer stored
                 6. Close scope
         '''
 
@@ -335,6 +414,11 @@ class LocalHeader(Local):
                 else:
                     formal_types_cvalues.append(formal.type_.cvalue)
 
+        # Free variables pass by reference
+        for free in self.free or []:
+            free.type_.codegen()
+            formal_types_cvalues.append(free.type_.cvalue.as_pointer())
+
         header_type_cvalue = ir.FunctionType(
             header_return_cvalue, formal_types_cvalues, var_arg=False)
 
@@ -366,6 +450,13 @@ class LocalHeader(Local):
 
         header_args = header_cvalue.args
 
+        # Procedures are only called from this module
+        header_cvalue.linkage = 'internal'
+        LLVMAttributes.add(
+            header_cvalue.attributes, LLVMAttributes.of(self.effects))
+        LLVMAttributes.add(header_cvalue.attributes,
+                           LLVMDirectives.attributes(self.header.directives))
+
         header_block = header_cvalue.append_basic_block(
             self.header.id_ + '_entry')
 
@@ -385,27 +476,42 @@ class LocalHeader(Local):
                     counter += 1
 
             # Open a named scope
-            self.symbol_table.open_scope(self.header.id_)
+            scope = self.symbol_table.open_scope(self.header.id_)
+            scope.header = self
+            if self.free is None:
+                # Closure conversion has not run, keep the
+                # locals used by nested procedures static
+                scope.captured = self.captured_ids()
+            else:
+                scope.captured = set()
 
             # Process the header
             self.header.codegen()
 
+            tail_calls = [call for call in self.tail_calls() if self.tail_safe(call)]
+            for call in tail_calls:
+                call.tail_of = self
+
             # Process arguments inside the function / proc.
+            self.tail_formals = []
             counter = 0
             for formal in self.header.formals:
                 for formal_id in formal.ids:
                     arg = header_args[counter]
                     if not formal.by_reference:
-                        arg_name = '{}_{}'.format(formal_id, self.symbol_table.auto(formal_id))
-                        arg_cvalue = ir.GlobalVariable(
-                            self.module, arg.type, name=arg_name)
+                        arg_cvalue = None
+                        if self.symbol_table.on_frame(formal_id):
+                            arg_cvalue = self.builder.alloca_frame(
+                                arg.type, name=formal_id)
 
-                        # If variable needs only local storage we can use alloca
-                        # arg_cvalue = self.builder.alloca(arg.type)
+                        if arg_cvalue is None:
+                            arg_name = '{}_{}'.format(formal_id, self.symbol_table.auto(formal_id))
+                            arg_cvalue = ir.GlobalVariable(
+                                self.module, arg.type, name=arg_name)
 
-                        # Set initializer to zeroinitializer ir.Constant(typ, None)
-                        arg_cvalue.initializer = ir.Constant(arg.type, None)
-                        arg_cvalue.linkage = 'internal'
+                            # Set initializer to zeroinitializer ir.Constant(typ, None)
+                            arg_cvalue.initializer = ir.Constant(arg.type, None)
+                            arg_cvalue.linkage = 'internal'
 
                         # Make a copy of the variable
                         self.builder.store(arg, arg_cvalue)
@@ -417,23 +523,144 @@ class LocalHeader(Local):
                         name_type=NameType.N_VAR,
                         cvalue=arg_cvalue)
                     self.symbol_table.insert(formal_id, arg_entry, lineno=self.lineno)
+                    self.tail_formals.append(arg_entry)
                     counter += 1
 
+            # Self-recursive tail calls assign the formals and jump back
+            # here, the locals are initialized again by the body
+            if any(call.callee is self for call in tail_calls):
+                entry_block = self.builder.block
+                self.tail_block = self.builder.append_basic_block('tailrecurse')
+                self.builder.branch(self.tail_block)
+                self.builder.position_at_end(self.tail_block)
+                for arg_entry in self.tail_formals:
+                    if arg_entry.cvalue in header_args:
+                        phi = self.builder.phi(arg_entry.cvalue.type)
+                        phi.add_incoming(arg_entry.cvalue, entry_block)
+                        arg_entry.cvalue = phi
+            else:
+                self.tail_block = None
+
+            # Register free variables. The ones referred to by name
+            # are also visible by name inside the body.
+            for free in self.free or []:
+                free_entry = SymbolEntry(
+                    stype=free.type_.stype,
+                    name_type=NameType.N_VAR,
+                    cvalue=header_args[counter])
+                scope.lifted[(free.id_, free.owner)] = free_entry
+                if free.direct:
+                    self.symbol_table.insert(free.id_, free_entry, lineno=self.lineno)
+                counter += 1
+
             # Run codegen to body
             self.body.codegen()
 
-            # Guardian return statements
-            try:
-                # Function
-                result_cvalue_ptr = self.symbol_table.lookup('result', lineno=self.lineno).cvalue
-                result_cvalue = self.builder.load(result_cvalue_ptr)
-                self.builder.ret(result_cvalue)
-            except PCLSymbolTableError:
-                # Procedure
-                self.builder.ret_void()
-
+            # Guardian return statements (unless the body
+            # ends with a return or a goto)
+            if not self.builder.terminated:
+                try:
+                    # Function
+                    result_cvalue_ptr = self.symbol_table.lookup('result', lineno=self.lineno).cvalue
+                    result_cvalue = self.builder.load(result_cvalue_ptr)
+                    self.builder.ret(result_cvalue)
+                except PCLSymbolTableError:
+                    # Procedure
+                    self.builder.ret_void()
+
+            self.builder.clean_cfg(header_cvalue)
             self.symbol_table.close_scope()
 
+    def tail_calls(self):
+        '''
+            Calls in tail position: procedure calls that are the last
+            statement of the body (or of the branches of an if at its end)
+            or are followed by a return, and result := call in such
+            positions for functions
+        '''
+        calls = []
+
+        def visit(stmt):
+            if isinstance(stmt, Block):
+                stmts = [s for s in stmt.stmt_list if not isinstance(s, Empty)]
+                for s, next_ in zip(stmts, stmts[1:]):
+                    if isinstance(next_, Return):
+                        visit(s)
+                if stmts:
+                    visit(stmts[-1])
+            elif isinstance(stmt, If):
+                visit(stmt.stmt)
+                if stmt.else_stmt:
+                    visit(stmt.else_stmt)
+            elif type(stmt) is Statement and stmt.name:
+                visit(stmt.stmt)
+            elif isinstance(stmt, Call) and not self.header.func_type:
+                calls.append(stmt)
+            elif isinstance(stmt, SetExpression) and self.header.func_type and \
+                    isinstance(stmt.lvalue, Result) and isinstance(stmt.expr, Call) and \
+                    stmt.expr.stype == self.header.func_type.stype:
+                calls.append(stmt.expr)
+
+        visit(self.body.block)
+        return [call for call in calls if call.callee is not None]
+
+    def frame_ids(self):
+        ''' Names of the variables on the frame (locals and by-value formals) '''
+        ids = {'result'}
+        for formal in self.header.formals:
+            if not formal.by_reference:
+                ids.update(formal.ids)
+        for local in self.body.locals_:
+            if isinstance(local, VarList):
+                for var in local.vars_:
+                    ids.update(var.ids)
+        return ids
+
+    def tail_safe(self, call):
+        '''
+            True if call cannot access the frame of this procedure (thus
+            the frame can be reused): no address of a local is taken and
+            no local is passed by reference (or as a free variable)
+        '''
+        frame = self.frame_ids()
+        for node in self.body.block.walk():
+            if isinstance(node, AddressOf) and node.lvalue.id_ in frame:
+                return False
+
+        formals = [formal for formal in call.callee.header.formals
+                   for _ in formal.ids]
+        for expr, formal in zip(call.exprs, formals):
+            if not formal.by_reference:
+                continue
+            while isinstance(expr, LBrack):
+                expr = expr.lvalue
+            if isinstance(expr, NameLValue) and expr.id_ in frame:
+                return False
+        return not any(free.owner is self for free in call.callee.free or [])
+
+    def tail_recurse(self, params):
+        ''' Self-recursive tail call with params: jumps back to the entry '''
+        for arg_entry, param in zip(self.tail_formals, params):
+            if isinstance(arg_entry.cvalue, ir.PhiInstr):
+                arg_entry.cvalue.add_incoming(param, self.builder.block)
+            else:
+                self.builder.store(param, arg_entry.cvalue)
+        self.builder.branch(self.tail_block)
+
+    def captured_ids(self):
+        '''
+            Names referenced inside the procedures nested in this one.
+            Locals with these names are shared with the nested
+            procedures, thus they cannot live on the activation frame.
+        '''
+        captured = set()
+        for local in self.body.locals_:
+            if isinstance(local, LocalHeader):
+                for node in local.walk():
+                    if isinstance(node, NameLValue):
+                        captured.add(node.id_)
+        return captured
+
 
 class VarList(Local):
 
@@ -468,37 +695,56 @@ class Var(Local):
         for id_ in self.ids:
             var_entry = SymbolEntry(
                 stype=self.type_.stype,
-                name_type=NameType.N_VAR)
+                name_type=NameType.N_VAR,
+                type_=self.type_)
             self.symbol_table.insert(id_, var_entry, lineno=self.lineno)
 
     def codegen(self):
         '''
-            Registers all the variables (as ir.GlobalVariable) at the
-            symbol table. The variable initializers are set to
-            zeroinitializer, provided by LLVM.
+            Registers all the variables at the symbol table. Procedure
+            locals are allocated on the activation frame (alloca at the entry
+            block). Variables of the main program, locals used by nested
+            procedures and locals that do not fit in the frame are
+            ir.GlobalVariable. In both cases they are set to zeroinitializer.
         '''
         self.type_.codegen()
         for id_ in self.ids:
-            # Global symbols
-
-            # Name is needed for initialization
-            # Should not be used by the programmer
-            # Naming convention is by definition unique
-            global_id_name = '{}_{}'.format(id_, self.symbol_table.auto(id_))
-            global_id_cvalue = ir.GlobalVariable(
-                self.module, self.type_.cvalue, name=global_id_name)
-
-            # Set initializer to zeroinitializer ir.Constant(typ, None)
-            global_id_cvalue.initializer = ir.Constant(self.type_.cvalue, None)
-
-            # Internal linkage means that these variables are not accessible if
-            # the module is imported
-            global_id_cvalue.linkage = 'internal'
+            id_cvalue = None
+            # Unsized arrays have no frame slot
+            if self.symbol_table.on_frame(id_) and is_composite(self.type_.stype):
+                # Local symbols
+                id_cvalue = self.builder.alloca_frame(
+                    self.type_.cvalue, name=id_)
+                if id_cvalue is not None:
+                    self.builder.store(
+                        ir.Constant(self.type_.cvalue, None), id_cvalue)
+
+            if id_cvalue is None:
+                # Global symbols
+
+                # Name is needed for initialization
+                # Should not be used by the programmer
+                # Naming convention is by definition unique
+                global_id_name = '{}_{}'.format(id_, self.symbol_table.auto(id_))
+                id_cvalue = ir.GlobalVariable(
+                    self.module, self.type_.cvalue, name=global_id_name)
+
+                # Set initializer to zeroinitializer ir.Constant(typ, None)
+                id_cvalue.initializer = ir.Constant(self.type_.cvalue, None)
+
+                # Internal linkage means that these variables are not accessible if
+                # the module is imported
+                id_cvalue.linkage = 'internal'
+
+                # Large arrays are aligned for wide vector loads
+                if LLVMTypeSize.sizeof(self.type_.cvalue) >= LLVMTypeSize.ARRAY_ALIGN and \
+                        isinstance(self.type_.cvalue, ir.ArrayType):
+                    id_cvalue.align = LLVMTypeSize.ARRAY_ALIGN
 
             var_entry = SymbolEntry(
                 stype=self.type_.stype,
                 name_type=NameType.N_VAR,
-                cvalue=global_id_cvalue)
+                cvalue=id_cvalue)
 
             # Register global symbol to symbol table
             self.symbol_table.insert(id_, var_entry, lineno=self.lineno)
@@ -524,7 +770,18 @@ class Label(Local):
             self.symbol_table.insert(id_, label_entry, lineno=self.lineno)
 
     def codegen(self):
-        pass
+        '''
+            Declares a basic block for every label, thus
+            gotos can jump forward to labels not yet reached
+        '''
+        for id_ in self.ids:
+            label_entry = SymbolEntry(
+                stype=(
+                    ComposerType.T_NO_COMP,
+                    BaseType.T_LABEL),
+                name_type=NameType.N_LABEL,
+                cvalue=self.builder.append_basic_block(id_))
+            self.symbol_table.insert(id_, label_entry, lineno=self.lineno)
 
 
 class Forward(Local):
@@ -533,11 +790,17 @@ class Forward(Local):
         super(Forward, self).__init__(builder, module, symbol_table, lineno)
         self.header = header
 
+        # The LocalHeader that defines the procedure (set by
+        # the closure conversion)
+        self.definition = None
+
     @AST.sem_decorator
     def sem(self):
         '''
             Registers forward declaration on symbol table
         '''
+        # Directives are taken from the definition
+        self.check_directives(self.header.directives, {})
         if self.header.func_type:
             self.header.func_type.sem()
             header_type = self.header.func_type.stype
@@ -545,7 +808,8 @@ class Forward(Local):
             header_type = (ComposerType.T_NO_COMP, BaseType.T_PROC)
         forward_entry = SymbolEntry(
             stype=header_type,
-            name_type=NameType.N_FORWARD)
+            name_type=NameType.N_FORWARD,
+            type_=self.header.func_type)
         self.symbol_table.insert('forward_' + self.header.id_, forward_entry, lineno=self.lineno)
 
         for formal in self.header.formals:
@@ -582,6 +846,11 @@ class Forward(Local):
                 else:
                     formal_types_cvalues.append(formal.type_.cvalue)
 
+        # Free variables of the definition pass by reference
+        for free in getattr(self.definition, 'free', None) or []:
+            free.type_.codegen()
+            formal_types_cvalues.append(free.type_.cvalue.as_pointer())
+
         header_type_cvalue = ir.FunctionType(
             header_return_cvalue, formal_types_cvalues, var_arg=False)
 
@@ -591,8 +860,7 @@ class Forward(Local):
             header_type_cvalue,
             name=self.header.id_ + '_' + str(header_counter))
 
-        header_cvalue.is_declaration = True
-
+        # A function without basic blocks is a declaration
         if self.header.func_type:
             header_entry = SymbolEntry(
                 stype=self.header.func_type.stype,
@@ -615,6 +883,7 @@ class Header(AST):
             header_type,
             id_,
             formals,
+            directives,
             func_type,
             builder,
             module,
@@ -623,12 +892,14 @@ class Header(AST):
         '''
             header_type: [function, procedure]
             formals: function / procedure inputs
+            directives: directive comments before the header
             func_type: return type
         '''
         super(Header, self).__init__(builder, module, symbol_table, lineno)
         self.header_type = header_type
         self.id_ = id_
         self.formals = formals
+        self.directives = directives
         self.func_type = func_type
 
     @AST.sem_decorator
@@ -639,7 +910,8 @@ class Header(AST):
         if self.func_type:
             result_entry = SymbolEntry(
                 stype=self.func_type.stype,
-                name_type=NameType.N_VAR)
+                name_type=NameType.N_VAR,
+                type_=self.func_type)
             self.symbol_table.insert('result', result_entry, lineno=self.lineno)
 
     def codegen(self):
@@ -784,10 +1056,14 @@ class ArrayType(Type):
 
     def codegen(self):
         '''
-            Declare an LLVM type of [length x type]
+            Declare an LLVM type of [length x type], or of the
+            words of the bits of a packed array of booleans
         '''
         self.type_.codegen()
-        self.cvalue = ir.ArrayType(self.type_.cvalue, self.length)
+        if self.builder.packed_booleans and self.type_.cvalue == LLVMTypes.T_BOOL:
+            self.cvalue = PackedArrayType(self.length)
+        else:
+            self.cvalue = ir.ArrayType(self.type_.cvalue, self.length)
 
 
 class Statement(AST):
@@ -809,28 +1085,17 @@ class Statement(AST):
 
     def codegen(self):
         '''
-            Register label inside the module (if statement is named)
-            and generate code inside the statement.
+            Generates the statement (if named) in the basic block of its
+            label (declared by Label). Falls through to the label unless
+            the preceding code ends with a goto or a return.
         '''
         if self.name:
-            # Declare labeled statement as a basic block
-            self.cvalue = self.builder.append_basic_block(self.name)
-            self.builder.branch(self.cvalue)
-            label_entry = SymbolEntry(
-                stype=(
-                    ComposerType.T_NO_COMP,
-                    BaseType.T_LABEL),
-                name_type=NameType.N_LABEL,
-                cvalue=self.cvalue)
-            self.symbol_table.insert(self.name, label_entry, lineno=self.lineno)
-            self.builder.position_at_start(self.cvalue)
-            next_block = self.builder.append_basic_block()
+            self.cvalue = self.symbol_table.lookup(self.name, lineno=self.lineno).cvalue
+            if not self.builder.terminated:
+                self.builder.branch(self.cvalue)
+            self.builder.position_at_end(self.cvalue)
             self.stmt.codegen()
 
-            # Branch to next block
-            self.builder.branch(next_block)
-            self.builder.position_at_start(next_block)
-
 
 class Block(Statement):
 
@@ -855,9 +1120,17 @@ class Block(Statement):
 
     def codegen(self):
         '''
-            Run codegen on statements.
+            Run codegen on statements. Statements that follow a goto or a
+            return are unreachable and are not generated, unless they
+            contain labels (which are generated in a new block).
         '''
         for stmt in self.stmt_list:
+            if self.builder.terminated:
+                if not stmt.labeled():
+                    continue
+                if not (type(stmt) is Statement and stmt.name):
+                    self.builder.position_at_end(
+                        self.builder.append_basic_block('dead'))
             stmt.codegen()
 
 
@@ -867,6 +1140,16 @@ class Call(Statement):
         self.id_ = id_
         self.exprs = exprs
 
+        # The LocalHeader of the called procedure, None for
+        # builtins (set by the closure conversion)
+        self.callee = None
+
+        # The LocalHeader that returns right after the call (tail call)
+        self.tail_of = None
+
+    # Builtins that only read their by-reference arguments
+    readonly_builtins = {'writeString'}
+
     @AST.sem_decorator
     def sem(self):
         '''
@@ -883,6 +1166,7 @@ class Call(Statement):
 
         formals = list(self.symbol_table.formal_generator(self.id_))
         self.stype = call_entry.stype
+        self.decl_type = call_entry.type_
 
         if len(formals) != len(self.exprs):
             msg = 'Invalid number of arguments: {}'.format(self.id_)
@@ -913,59 +1197,103 @@ class Call(Statement):
                 1. Call by reference passes pointer (performs bitcast if needed
                     for example *[n x type] -> *[0 x type])
                 2. Call by value passes expression codegen value
+                3. Free variables of the callee are passed by reference
+                4. Trivial builtins (abs, ord, chr, pi, trunc, round) are
+                    expanded to IR and math builtins with an LLVM intrinsic
+                    call the intrinsic instead of the runtime
         '''
         real_params = []
-        phantoms = []
         counter = 0
         try:
-            call_entry_cvalue = self.symbol_table.lookup(self.id_, lineno=self.lineno).cvalue
+            call_entry = self.symbol_table.lookup(self.id_, lineno=self.lineno)
         except PCLSymbolTableError:
-            call_entry_cvalue = self.symbol_table.lookup(
-                'forward_' + self.id_, lineno=self.lineno).cvalue,
+            call_entry = self.symbol_table.lookup(
+                'forward_' + self.id_, lineno=self.lineno)
         except BaseException:
             # Should never be reached
             msg = 'Unknown name: {}'.format(self.id_)
             self.raise_exception_helper(msg, PCLSemError)
 
+        call_entry_cvalue = call_entry.cvalue
+        builtin = self.symbol_table.is_builtin(self.id_, call_entry)
         formals = self.symbol_table.formal_generator(self.id_)
         for expr, formal_type, (formal_name, formal) in zip(
                 self.exprs, call_entry_cvalue.args, formals):
+            if formal.by_reference and isinstance(expr, LValue):
+                # Only the address is passed, the value is not needed
+                expr.load = False
+            if formal.by_reference and isinstance(expr, StringLiteral) and \
+                    not (builtin and self.id_ in self.readonly_builtins):
+                # The callee may write to the literal
+                expr.copy = True
             expr.codegen()
             if formal.by_reference:
                 if not hasattr(expr, 'ptr'):
                     msg = 'Expression at position {} cannot be passed by reference'.format(counter)
                     self.raise_exception_helper(msg, PCLCodegenError)
+                if getattr(expr, 'bit', None) is not None:
+                    msg = 'Element of a packed boolean array at position {} ' \
+                        'cannot be passed by reference'.format(counter)
+                    self.raise_exception_helper(msg, PCLCodegenError)
                 if expr.ptr:
                     ptr = expr.ptr
                     if ptr.type != formal_type.type:
-                        ptr = self.builder.bitcast(ptr, formal_type.type)
+                        if isinstance(ptr, ir.GlobalValue):
+                            # Constant expression, no instruction needed
+                            ptr = ptr.bitcast(formal_type.type)
+                        else:
+                            ptr = self.builder.bitcast(ptr, formal_type.type)
 
                     real_params.append(ptr)
                 else:
                     raise NotImplementedError()
             else:
-                try:
-                    var_cvalue = self.symbol_table.lookup(formal_name).cvalue
-                    phantom_ptr = self.builder.alloca(var_cvalue.type.pointee)
-                    val = self.builder.load(var_cvalue)
-                    self.builder.store(val, phantom_ptr)
-                    phantoms.append((counter, phantom_ptr))
-                except:
-                    pass
-                # import pdb; pdb.set_trace()
                 if isinstance(expr, StringLiteral):
                     ptr = expr.ptr
                     real_params.append(ptr)
+                elif formal_type.type == LLVMTypes.T_REAL and expr.cvalue.type == LLVMTypes.T_INT:
+                    real_params.append(self.builder.sitofp(
+                        expr.cvalue, LLVMTypes.T_REAL))
                 else:
                     real_params.append(expr.cvalue)
 
             counter += 1
-        self.cvalue = self.builder.call(call_entry_cvalue, real_params)
 
-        for pos, phantom_ptr in phantoms:
-            var_cvalue = self.symbol_table.lookup(formals[pos][0]).cvalue
-            temp = self.builder.load(phantom_ptr)
-            self.builder.store(temp, var_cvalue)
+        if self.callee is not None:
+            for free in self.callee.free or []:
+                free_entry = self.symbol_table.lookup_free(
+                    free.id_, free.owner, lineno=self.lineno)
+                real_params.append(free_entry.cvalue)
+
+        if self.tail_of is not None and self.callee is self.tail_of:
+            self.tail_of.tail_recurse(real_params)
+            return
+
+        # Builtins are expanded or lowered to intrinsics where possible
+        if builtin:
+            self.cvalue = LLVMExpansions.expand(
+                self.builder, self.id_, real_params)
+            if self.cvalue is None:
+                self.cvalue = LLVMIntrinsics.call(
+                    self.builder, self.id_, real_params)
+            if self.cvalue is not None:
+                return
+
+        tail = None
+        if self.tail_of is not None:
+            # Same prototype as the caller: the frame can be reused
+            same_type = call_entry_cvalue.function_type == self.builder.function.function_type
+            tail = 'musttail' if same_type else 'tail'
+        self.cvalue = self.builder.call(call_entry_cvalue, real_params, tail=tail)
+        if self.callee is not None:
+            LLVMAttributes.add(
+                self.cvalue.attributes, LLVMAttributes.of(self.callee.effects))
+
+        if self.tail_of is not None:
+            if self.tail_of.header.func_type:
+                self.builder.ret(self.cvalue)
+            else:
+                self.builder.ret_void()
 
 
 class If(Statement):
@@ -1003,8 +1331,14 @@ class If(Statement):
     def codegen(self):
         '''
             Creates code for the if statement using ir.IRBuilder's if_else or
-            if_then commands.
+            if_then commands. A chain of ifs that compare a variable to
+            constants is a switch (see cases).
         '''
+        cases = self.cases()
+        if cases is not None:
+            self.codegen_switch(*cases)
+            return
+
         self.expr.codegen()
 
         if self.else_stmt:
@@ -1017,40 +1351,359 @@ class If(Statement):
             with self.builder.if_then(self.expr.cvalue):
                 self.stmt.codegen()
 
+    @staticmethod
+    def case(expr):
+        ''' (variable, constant) if expr is variable = constant, else None '''
+        if not isinstance(expr, CompOp) or expr.op != '=':
+            return None
+        for name, const in [(expr.lhs, expr.rhs), (expr.rhs, expr.lhs)]:
+            if isinstance(name, NameLValue) and \
+                    isinstance(const, (IntegerConst, CharConst)) and \
+                    name.stype == const.stype:
+                return name, const
+        return None
+
+    def cases(self):
+        '''
+            The chain
+
+                if c = k1 then s1 else if c = k2 then s2 ... else s
+
+            of at least two ifs that compare the same integer or char
+            variable c to constants, as (c, [(k1, s1), (k2, s2), ...], s).
+            None for other ifs.
+        '''
+        name, cases, node = None, [], self
+        while isinstance(node, If):
+            case = self.case(node.expr)
+            if case is None or (name is not None and case[0].id_ != name.id_):
+                break
+            name = case[0]
+            cases.append((case[1], node.stmt))
+            node = node.else_stmt
+        if len(cases) < 2:
+            return None
+        return name, cases, node
+
+    def codegen_switch(self, name, cases, default):
+        '''
+            Emits a switch on the variable, thus LLVM can lower the
+            chain to a jump table or a binary search instead of a
+            comparison per if. If the same constant appears twice,
+            the first if wins and the later statement is generated
+            in a block that only the gotos to its labels can reach.
+        '''
+        name.codegen()
+        end_block = self.builder.append_basic_block('switch.end')
+        default_block = end_block
+        if default is not None:
+            default_block = self.builder.append_basic_block('switch.default')
+        switch = self.builder.switch(name.cvalue, default_block)
+
+        seen = set()
+        for const, stmt in cases:
+            const.codegen()
+            if const.cvalue.constant in seen:
+                case_block = self.builder.append_basic_block('switch.dead')
+            else:
+                seen.add(const.cvalue.constant)
+                case_block = self.builder.append_basic_block('switch.case')
+                switch.add_case(const.cvalue, case_block)
+            self.builder.position_at_end(case_block)
+            stmt.codegen()
+            if not self.builder.terminated:
+                self.builder.branch(end_block)
+
+        if default is not None:
+            self.builder.position_at_end(default_block)
+            default.codegen()
+            if not self.builder.terminated:
+                self.builder.branch(end_block)
+        self.builder.position_at_end(end_block)
+
 
 class While(Statement):
     '''
         While statement.
     '''
 
-    def __init__(self, expr, stmt, builder, module, symbol_table, lineno):
+    def __init__(self, expr, stmt, directives, builder, module, symbol_table, lineno):
         super(While, self).__init__(builder, module, symbol_table, lineno)
         self.expr = expr
         self.stmt = stmt
 
+        # Directive comments before the loop (unroll, vectorize, parallel)
+        self.directives = directives
+
+        # Array accesses of the body whose bounds checks
+        # are hoisted before the loop (set by the BoundsAnalyzer)
+        self.hoisted = []
+
+        # ParallelLoop if the iterations run in parallel
+        # (set by the ParallelAnalyzer)
+        self.parallel = None
+
+        # CountedLoop if the loop is counted (set by the LoopAnalyzer)
+        self.counted = None
+
     @AST.sem_decorator
     def sem(self):
         '''
             Similar to the if statement.
         '''
+        self.check_directives(self.directives, LLVMDirectives.loop)
         self.expr.sem()
         self.expr.type_check((ComposerType.T_NO_COMP, BaseType.T_BOOL))
         self.stmt.sem()
 
     def codegen(self):
         '''
-            Similar to the if statement.
-            Phi nodes are not needed.
+            Similar to the if statement. The condition is generated
+            once, in the header block of the loop. Hoisted bounds
+            checks run once, when the loop is entered: the header
+            tells the first iteration apart with a phi node. The
+            directives of the loop go to the metadata of the back edge.
         '''
-        w_body_block = self.builder.append_basic_block()
-        w_after_block = self.builder.append_basic_block()
+        if self.parallel is not None:
+            self.codegen_parallel()
+            return
+        if self.counted is not None:
+            self.codegen_counted()
+            return
+
+        entry_block = self.builder.block
+        w_cond_block = self.builder.append_basic_block('while.cond')
+        w_body_block = self.builder.append_basic_block('while.body')
+        w_after_block = self.builder.append_basic_block('while.end')
+        self.builder.branch(w_cond_block)
+        self.builder.position_at_end(w_cond_block)
+        if self.hoisted:
+            first = self.builder.phi(LLVMTypes.T_BOOL)
+            first.add_incoming(LLVMConstants.TRUE, entry_block)
         self.expr.codegen()
-        self.builder.cbranch(self.expr.cvalue, w_body_block, w_after_block)
-        self.builder.position_at_start(w_body_block)
+        if self.hoisted:
+            w_pre_block = self.builder.append_basic_block('while.pre')
+            w_enter_block = self.builder.append_basic_block('while.enter')
+            self.builder.cbranch(self.expr.cvalue, w_enter_block, w_after_block)
+            self.builder.position_at_end(w_enter_block)
+            self.builder.cbranch(first, w_pre_block, w_body_block)
+            self.builder.position_at_end(w_pre_block)
+            for access in self.hoisted:
+                access.expr.codegen()
+                access.lvalue.codegen()
+                access.check_bounds(kind='hoisted')
+            self.builder.branch(w_body_block)
+        else:
+            self.builder.cbranch(self.expr.cvalue, w_body_block, w_after_block)
+        self.builder.position_at_end(w_body_block)
         self.stmt.codegen()
-        self.expr.codegen()
-        self.builder.cbranch(self.expr.cvalue, w_body_block, w_after_block)
-        self.builder.position_at_start(w_after_block)
+        if not self.builder.terminated:
+            if self.hoisted:
+                first.add_incoming(LLVMConstants.FALSE, self.builder.block)
+            self.latch(w_cond_block)
+        self.builder.position_at_end(w_after_block)
+
+    def codegen_counted(self):
+        '''
+            Counted loop (see LoopAnalyzer) in the canonical form of the
+            LLVM loop passes. The bound is evaluated once and the loop is
+            entered only if it runs at least once, through a preheader
+            (which runs the hoisted bounds checks). The induction variable
+            is a phi of the body and the single latch increments it (nsw)
+            and tests the bound, thus the trip count is known to LLVM
+            (constant trip counts also go to the branch weights).
+        '''
+        loop = self.counted
+        counter = self.symbol_table.lookup(loop.id_, lineno=self.lineno).cvalue
+        op = '<=' if loop.inclusive else '<'
+        lo = self.builder.load(counter)
+        loop.bound.codegen()
+        hi = loop.bound.cvalue
+
+        w_pre_block = self.builder.append_basic_block('while.pre')
+        w_body_block = self.builder.append_basic_block('while.body')
+        w_after_block = self.builder.append_basic_block('while.end')
+        self.builder.cbranch(
+            self.builder.icmp_signed(op, lo, hi), w_pre_block, w_after_block)
+        self.builder.position_at_end(w_pre_block)
+        for access in self.hoisted:
+            access.expr.codegen()
+            access.lvalue.codegen()
+            access.check_bounds(kind='hoisted')
+        # The checks split the preheader, its last block enters the body
+        w_pre_block = self.builder.block
+        self.builder.branch(w_body_block)
+
+        self.builder.position_at_end(w_body_block)
+        index = self.builder.phi(LLVMTypes.T_INT)
+        index.add_incoming(lo, w_pre_block)
+        # The body does not assign the variable, it holds index
+        self.builder.holds(counter, index)
+        stmts = self.stmt.stmt_list if isinstance(self.stmt, Block) else [self.stmt]
+        for stmt in list(stmts)[:-1]:
+            if self.builder.terminated:
+                break
+            stmt.codegen()
+        if self.builder.terminated:
+            self.builder.position_at_end(w_after_block)
+            return
+
+        next_index = self.builder.add(
+            index, ir.Constant(LLVMTypes.T_INT, 1), flags=['nsw'])
+        self.builder.store(next_index, counter)
+        index.add_incoming(next_index, self.builder.block)
+        latch = self.builder.cbranch(
+            self.builder.icmp_signed(op, next_index, hi),
+            w_body_block, w_after_block)
+        properties = LLVMDirectives.loop_properties(self.directives)
+        if properties:
+            latch.set_metadata('llvm.loop', self.builder.loop_metadata(properties))
+        if loop.trips:
+            latch.set_metadata('prof', self.builder.branch_weights(
+                loop.trips - 1, 1))
+        self.builder.position_at_end(w_after_block)
+
+    def latch(self, w_cond_block):
+        ''' The back edge of the loop, with the metadata of the directives '''
+        latch = self.builder.branch(w_cond_block)
+        properties = LLVMDirectives.loop_properties(self.directives)
+        if properties:
+            latch.set_metadata(
+                'llvm.loop', self.builder.loop_metadata(properties))
+
+    def shared(self):
+        '''
+            Symbol entries of the variables of the body of a parallel loop,
+            keyed by name (or by (name, owner) for the free variables of the
+            callees), which are not globals and are passed to the outlined
+            body. The induction variable is not shared.
+        '''
+        entries = OrderedDict()
+        for node in self.stmt.walk():
+            if isinstance(node, NameLValue) and node.id_ not in entries and \
+                    node.id_ != self.parallel.id_:
+                entries[node.id_] = self.symbol_table.lookup(
+                    node.id_, lineno=self.lineno)
+            elif isinstance(node, Call) and node.callee is not None:
+                for free in node.callee.free or []:
+                    entries[(free.id_, free.owner)] = self.symbol_table.lookup_free(
+                        free.id_, free.owner, lineno=self.lineno)
+        return OrderedDict((key, entry) for key, entry in entries.items()
+                           if not isinstance(entry.cvalue, ir.GlobalValue))
+
+    def codegen_parallel(self):
+        '''
+            Parallel loop (see ParallelAnalyzer). The body is outlined to a
+            function body(env, lo, hi) that runs the iterations [lo, hi),
+            where env points to the shared variables of the loop. The
+            induction variable and the private scalars are locals of the
+            outlined function; the one that runs the last iteration copies
+            the private scalars back. The runtime (pcl_parallel_for) splits
+            the iterations among its threads.
+        '''
+        loop = self.parallel
+        shared = self.shared()
+        env_type = ir.LiteralStructType(
+            [entry.cvalue.type for entry in shared.values()] + [LLVMTypes.T_INT])
+        lineno = self.lineno
+
+        # The range of the iterations, evaluated once as the bound is invariant
+        counter = self.symbol_table.lookup(loop.id_, lineno=lineno).cvalue
+        lo = self.builder.load(counter)
+        loop.bound.codegen()
+        hi = loop.bound.cvalue
+        if loop.inclusive:
+            hi = self.builder.add(hi, ir.Constant(LLVMTypes.T_INT, 1))
+        nonempty = self.builder.icmp_signed('<', lo, hi)
+
+        env = self.builder.alloca_frame(env_type)
+        if env is None:
+            with self.builder.goto_entry_block():
+                env = self.builder.alloca(env_type)
+        zero = ir.Constant(ir.IntType(32), 0)
+        for k, entry in enumerate(shared.values()):
+            self.builder.store(entry.cvalue, self.builder.gep(
+                env, [zero, ir.Constant(ir.IntType(32), k)]))
+        self.builder.store(hi, self.builder.gep(
+            env, [zero, ir.Constant(ir.IntType(32), len(shared))]))
+
+        if self.hoisted:
+            with self.builder.if_then(nonempty):
+                for access in self.hoisted:
+                    access.expr.codegen()
+                    access.lvalue.codegen()
+                    access.check_bounds(kind='hoisted')
+
+        # The outlined body
+        body = ir.Function(
+            self.module, LLVMRuntime.parallel_body,
+            name=self.module.get_unique_name(self.builder.function.name + '.parallel'))
+        body.linkage = 'internal'
+        body.attributes.add('nounwind')
+        with self.builder.goto_block(body.append_basic_block('entry')):
+            scope = self.symbol_table.open_scope()
+            scope.captured = set()
+            env_arg, lo_arg, hi_arg = body.args
+            body_env = self.builder.bitcast(env_arg, env_type.as_pointer())
+            ptrs = {}
+            for k, (key, entry) in enumerate(shared.items()):
+                ptrs[key] = self.builder.load(self.builder.gep(
+                    body_env, [zero, ir.Constant(ir.IntType(32), k)]))
+                if key in loop.private:
+                    continue
+                body_entry = SymbolEntry(
+                    stype=entry.stype,
+                    name_type=entry.name_type,
+                    cvalue=ptrs[key],
+                    by_reference=entry.by_reference)
+                if isinstance(key, tuple):
+                    scope.lifted[key] = body_entry
+                else:
+                    self.symbol_table.insert(key, body_entry, lineno=lineno)
+            end = self.builder.load(self.builder.gep(
+                body_env, [zero, ir.Constant(ir.IntType(32), len(shared))]))
+
+            # Private copies and the variables they are copied back to
+            copies = []
+            for id_ in [loop.id_] + sorted(loop.private):
+                entry = self.symbol_table.lookup(id_, lineno=lineno)
+                ptr = self.builder.alloca_frame(entry.cvalue.type.pointee, name=id_)
+                self.symbol_table.insert(id_, SymbolEntry(
+                    stype=entry.stype,
+                    name_type=entry.name_type,
+                    cvalue=ptr), lineno=lineno)
+                if id_ != loop.id_:
+                    copies.append((ptr, ptrs.get(id_, entry.cvalue)))
+            self.builder.store(lo_arg, self.symbol_table.lookup(
+                loop.id_, lineno=lineno).cvalue)
+
+            w_cond_block = self.builder.append_basic_block('while.cond')
+            w_body_block = self.builder.append_basic_block('while.body')
+            w_after_block = self.builder.append_basic_block('while.end')
+            self.builder.branch(w_cond_block)
+            self.builder.position_at_end(w_cond_block)
+            i = self.builder.load(self.symbol_table.lookup(loop.id_, lineno=lineno).cvalue)
+            self.builder.cbranch(self.builder.icmp_signed('<', i, hi_arg),
+                                 w_body_block, w_after_block)
+            self.builder.position_at_end(w_body_block)
+            self.stmt.codegen()
+            if not self.builder.terminated:
+                self.latch(w_cond_block)
+
+            # The last iteration has run here
+            self.builder.position_at_end(w_after_block)
+            if copies:
+                with self.builder.if_then(self.builder.icmp_signed('==', hi_arg, end)):
+                    for ptr, target in copies:
+                        self.builder.store(self.builder.load(ptr), target)
+            self.builder.ret_void()
+            self.builder.clean_cfg(body)
+            self.symbol_table.close_scope()
+
+        self.builder.call(LLVMRuntime.get(self.module, 'pcl_parallel_for'), [
+            body, self.builder.bitcast(env, LLVMTypes.T_NIL), lo, hi,
+            ir.Constant(LLVMTypes.T_INT, loop.chunk)])
+        self.builder.store(self.builder.select(nonempty, hi, lo), counter)
 
 
 class Goto(Statement):
@@ -1074,16 +1727,12 @@ class Goto(Statement):
 
     def codegen(self):
         '''
-            Jumps to the declared label.
+            Jumps to the declared label. The block is terminated
+            thus the statements that follow are not generated.
         '''
-        # TODO fix non terminating block
-        helper_block = self.builder.append_basic_block()
-        self.builder.branch(helper_block)
-        self.builder.position_at_start(helper_block)
-        goto_block = self.symbol_table.lookup(self.id_, lineno=self.lineno).cvalue
-        self.builder.branch(goto_block)
-        next_block = self.builder.append_basic_block()
-        self.builder.position_at_start(next_block)
+        if not self.builder.terminated:
+            goto_block = self.symbol_table.lookup(self.id_, lineno=self.lineno).cvalue
+            self.builder.branch(goto_block)
 
 
 class Return(Statement):
@@ -1110,9 +1759,8 @@ class Return(Statement):
             Adds the return command (ret_void) for a function and
             returns "result" (with ret) for a function.
         '''
-        return_block = self.builder.append_basic_block()
-        self.builder.branch(return_block)
-        self.builder.position_at_start(return_block)
+        if self.builder.terminated:
+            return
         try:
             # Function
             result_cvalue_ptr = self.symbol_table.lookup('result', lineno=self.lineno).cvalue
@@ -1121,8 +1769,6 @@ class Return(Statement):
         except PCLSymbolTableError:
             # Procedure
             self.builder.ret_void()
-        next_block = self.builder.append_basic_block()
-        self.builder.position_at_start(next_block)
 
 
 class Empty(Statement):
@@ -1180,15 +1826,30 @@ class New(Statement):
 
     def codegen(self):
         '''
-            Creates a new value and sets lvalue's pointer to point there.
+            Allocates a new value on the heap (pcl_new of the runtime)
+            and sets lvalue's pointer to point there. The size is
+            computed with a getelementptr on null.
         '''
         self.lvalue.codegen()
+        ptr_type = self.lvalue.ptr.type.pointee
+        size_type = ir.IntType(64)
+        null = ir.Constant(ptr_type, None)
         if self.expr:
             # Creates n x [0 x type]
             self.expr.codegen()
-            self.cvalue = self.builder.alloca(self.lvalue.ptr.type.pointee.pointee, self.expr.cvalue)
+            n = self.builder.sext(self.expr.cvalue, size_type)
+            if isinstance(ptr_type.pointee, PackedArrayType):
+                # The words of n booleans
+                n = self.builder.lshr(self.builder.add(n, ir.Constant(
+                    size_type, PackedArrayType.BITS - 1)), ir.Constant(size_type, 6))
+            end = self.builder.gep(null, [ir.Constant(size_type, 0), n])
         else:
-            self.cvalue = self.builder.alloca(self.lvalue.ptr.type.pointee.pointee)
+            end = self.builder.gep(null, [ir.Constant(size_type, 1)])
+        size = self.builder.ptrtoint(end, size_type)
+
+        pcl_new = LLVMRuntime.get(self.module, 'pcl_new')
+        raw = self.builder.call(pcl_new, [size])
+        self.cvalue = self.builder.bitcast(raw, ptr_type)
         self.builder.store(self.cvalue, self.lvalue.ptr)
 
 
@@ -1230,9 +1891,14 @@ class Dispose(Statement):
 
     def codegen(self):
         '''
-            Set lvalue to nil.
+            Return the value to the heap (pcl_dispose of the runtime)
+            and set lvalue to nil.
         '''
         self.lvalue.codegen()
+        ptr = self.builder.load(self.lvalue.ptr)
+        raw = self.builder.bitcast(ptr, LLVMTypes.T_NIL)
+        pcl_dispose = LLVMRuntime.get(self.module, 'pcl_dispose')
+        self.builder.call(pcl_dispose, [raw])
         self.lvalue.set_nil()
 
 
@@ -1336,6 +2002,9 @@ class BoolConst(RValue):
     def codegen(self):
         self.cvalue = ir.Constant(LLVMTypes.T_BOOL, self.value)
 
+    def likely(self):
+        return bool(self.value)
+
 
 class Ref(RValue):
     '''
@@ -1428,10 +2097,16 @@ class LogicUnOp(RValue):
         self.rhs.codegen()
         self.cvalue = self.builder.not_(self.rhs.cvalue)
 
+    def likely(self):
+        likely = self.rhs.likely()
+        return None if likely is None else not likely
+
 
 class ArOp(RValue):
     '''
-        Arithmetic operation between two sides (lhs, rhs)
+        Arithmetic operation between two sides (lhs, rhs). Either side may
+        be an array of integers or reals (elementwise operation), as long
+        as the operation is assigned to an array (see SetExpression).
     '''
 
     def __init__(self, op, lhs, rhs, builder, module, symbol_table, lineno):
@@ -1440,8 +2115,18 @@ class ArOp(RValue):
         self.lhs = lhs
         self.rhs = rhs
 
+        # True if the operation is assigned to a variable (or is a
+        # side of such an operation), where it can be elementwise
+        self.assigned = False
+        # True if a side is an array, the result is the array
+        # of the operation on the elements of the sides
+        self.elementwise = False
+
     @AST.sem_decorator
     def sem(self):
+        for side in [self.lhs, self.rhs]:
+            if isinstance(side, ArOp):
+                side.assigned = self.assigned
         self.lhs.sem()
         self.rhs.sem()
 
@@ -1458,62 +2143,121 @@ class ArOp(RValue):
                     self.rhs.id_)
                 self.raise_exception_helper(msg, PCLSemError)
 
-        self.lhs.type_check(arithmetic_types)
-        self.rhs.type_check(arithmetic_types)
+        lhs, rhs = self.element_stype(self.lhs), self.element_stype(self.rhs)
+        self.elementwise = (lhs, rhs) != (self.lhs.stype, self.rhs.stype)
+        if self.elementwise and not self.assigned:
+            msg = 'Elementwise operation on arrays can only be assigned to an array'
+            self.raise_exception_helper(msg, PCLSemError)
+        for side, stype in [(self.lhs, lhs), (self.rhs, rhs)]:
+            if stype[0] == ComposerType.T_VAR_ARRAY:
+                msg = 'Elementwise operation on an array of unknown length'
+                self.raise_exception_helper(msg, PCLSemError)
+            if stype not in arithmetic_types:
+                side.type_check(arithmetic_types)
 
         if self.op == '/':
-            self.stype = real_type
-            return
-
-        if self.op == 'div' or self.op == 'mod':
-            self.lhs.type_check(int_type)
-            self.rhs.type_check(int_type)
+            stype = real_type
+        elif self.op == 'div' or self.op == 'mod':
+            for side, stype in [(self.lhs, lhs), (self.rhs, rhs)]:
+                if stype != int_type:
+                    side.type_check(int_type)
+            stype = int_type
+        elif lhs == real_type or rhs == real_type:
+            stype = real_type
+        else:
+            stype = int_type
 
-        if self.lhs.stype == real_type or self.rhs.stype == real_type:
-            self.stype = real_type
-            return
+        if self.elementwise:
+            self.stype = (ComposerType.T_CONST_ARRAY, stype)
+        else:
+            self.stype = stype
 
-        self.stype = int_type
+    @staticmethod
+    def element_stype(side):
+        ''' Type of the elements of side if it is an array of constant length '''
+        if side.stype[0] == ComposerType.T_CONST_ARRAY and \
+                side.stype[1] in arithmetic_types:
+            return side.stype[1]
+        return side.stype
 
     def codegen(self):
         self.lhs.codegen()
         self.rhs.codegen()
-
-        if self.lhs.stype == real_type and self.rhs.stype == int_type:
-            lhs_cvalue = self.lhs.cvalue
-            rhs_cvalue = self.builder.sitofp(self.rhs.cvalue, LLVMTypes.T_REAL)
-        elif self.lhs.stype == int_type and self.rhs.stype == real_type:
-            lhs_cvalue = self.builder.sitofp(self.lhs.cvalue, LLVMTypes.T_REAL)
-            rhs_cvalue = self.rhs.cvalue
+        self.cvalue = self.operate(self.lhs.cvalue, self.rhs.cvalue)
+
+    def lengths(self):
+        ''' Lengths of the array operands of an elementwise operation (None if unknown) '''
+        lengths = []
+        for side in [self.lhs, self.rhs]:
+            if isinstance(side, ArOp) and side.elementwise:
+                lengths += side.lengths()
+            elif side.stype[0] == ComposerType.T_CONST_ARRAY:
+                lengths.append(side.length())
+        return lengths
+
+    def codegen_operands(self):
+        '''
+            Operands of an elementwise operation, before its loop: the
+            pointers to the arrays (returned) and the values of the scalars
+        '''
+        arrays = []
+        for side in [self.lhs, self.rhs]:
+            if isinstance(side, ArOp) and side.elementwise:
+                arrays += side.codegen_operands()
+            elif side.stype[0] == ComposerType.T_CONST_ARRAY:
+                side.load = False
+                side.codegen()
+                arrays.append(side.ptr)
+            else:
+                side.codegen()
+        return arrays
+
+    def codegen_element(self, index):
+        ''' Element index of an elementwise operation, in its loop '''
+        values = []
+        for side in [self.lhs, self.rhs]:
+            if isinstance(side, ArOp) and side.elementwise:
+                values.append(side.codegen_element(index))
+            elif side.stype[0] == ComposerType.T_CONST_ARRAY:
+                values.append(self.builder.load(self.builder.gep(
+                    side.ptr, [LLVMConstants.ZERO_INT, index])))
+            else:
+                values.append(side.cvalue)
+        return self.operate(*values)
+
+    def operate(self, lhs_cvalue, rhs_cvalue):
+        ''' The operation on values of the (element) types of the sides '''
+        lhs, rhs = self.element_stype(self.lhs), self.element_stype(self.rhs)
+        if lhs == real_type and rhs == int_type:
+            rhs_cvalue = self.builder.sitofp(rhs_cvalue, LLVMTypes.T_REAL)
+        elif lhs == int_type and rhs == real_type:
+            lhs_cvalue = self.builder.sitofp(lhs_cvalue, LLVMTypes.T_REAL)
         elif self.op == '/':
-            lhs_cvalue = self.builder.sitofp(self.lhs.cvalue, LLVMTypes.T_REAL)
-            rhs_cvalue = self.builder.sitofp(self.rhs.cvalue, LLVMTypes.T_REAL)
-        else:
-            lhs_cvalue = self.lhs.cvalue
-            rhs_cvalue = self.rhs.cvalue
+            lhs_cvalue = self.builder.sitofp(lhs_cvalue, LLVMTypes.T_REAL)
+            rhs_cvalue = self.builder.sitofp(rhs_cvalue, LLVMTypes.T_REAL)
 
-        if self.lhs.stype == int_type and self.rhs.stype == int_type:
+        if lhs == int_type and rhs == int_type:
             if self.op == '+':
-                self.cvalue = self.builder.add(lhs_cvalue, rhs_cvalue)
+                return self.builder.add(lhs_cvalue, rhs_cvalue)
             elif self.op == '-':
-                self.cvalue = self.builder.sub(lhs_cvalue, rhs_cvalue)
+                return self.builder.sub(lhs_cvalue, rhs_cvalue)
             elif self.op == '*':
-                self.cvalue = self.builder.mul(lhs_cvalue, rhs_cvalue)
+                return self.builder.mul(lhs_cvalue, rhs_cvalue)
             elif self.op == '/':
-                self.cvalue = self.builder.fdiv(lhs_cvalue, rhs_cvalue)
+                return self.builder.fdiv(lhs_cvalue, rhs_cvalue)
             elif self.op == 'div':
-                self.cvalue = self.builder.sdiv(lhs_cvalue, rhs_cvalue)
+                return self.builder.sdiv(lhs_cvalue, rhs_cvalue)
             elif self.op == 'mod':
-                self.cvalue = self.builder.srem(lhs_cvalue, rhs_cvalue)
+                return self.builder.srem(lhs_cvalue, rhs_cvalue)
         else:
             if self.op == '+':
-                self.cvalue = self.builder.fadd(lhs_cvalue, rhs_cvalue)
+                return self.builder.fadd(lhs_cvalue, rhs_cvalue)
             elif self.op == '-':
-                self.cvalue = self.builder.fsub(lhs_cvalue, rhs_cvalue)
+                return self.builder.fsub(lhs_cvalue, rhs_cvalue)
             elif self.op == '*':
-                self.cvalue = self.builder.fmul(lhs_cvalue, rhs_cvalue)
+                return self.builder.fmul(lhs_cvalue, rhs_cvalue)
             elif self.op == '/':
-                self.cvalue = self.builder.fdiv(lhs_cvalue, rhs_cvalue)
+                return self.builder.fdiv(lhs_cvalue, rhs_cvalue)
 
 
 class CompOp(RValue):
@@ -1587,6 +2331,14 @@ class CompOp(RValue):
             self.cvalue = self.builder.icmp_signed(
                 cmp_op, self.lhs.cvalue, self.rhs.cvalue)
 
+    def likely(self):
+        ''' Equality is unlikely to hold, inequality is likely '''
+        if self.op == '=':
+            return False
+        elif self.op == '<>':
+            return True
+        return None
+
 
 class LogicOp(RValue):
     '''
@@ -1610,14 +2362,78 @@ class LogicOp(RValue):
 
         self.stype = bool_type
 
+    # Largest cost of a right hand side that is evaluated
+    # speculatively with a select instead of a branch
+    max_select_cost = 8
+
     def codegen(self):
+        '''
+            Short-circuit evaluation. The right hand side is evaluated only
+            if the left hand side does not determine the result:
+                1. A constant left hand side is folded
+                2. A cheap right hand side without side effects is evaluated
+                unconditionally and the result is a select
+                3. Otherwise the right hand side gets its own block and the
+                result is a phi. The branch carries weights if the outcome
+                of the left hand side can be predicted.
+        '''
+        # Value of the result if the rhs is not evaluated
+        short_value = ir.Constant(LLVMTypes.T_BOOL, int(self.op == 'or'))
+
+        if isinstance(self.lhs, BoolConst):
+            if self.lhs.value == short_value.constant:
+                self.cvalue = short_value
+            else:
+                self.rhs.codegen()
+                self.cvalue = self.rhs.cvalue
+            return
+
         self.lhs.codegen()
-        self.rhs.codegen()
+
+        if self.rhs.side_effect_free() and self.rhs.cost() <= self.max_select_cost:
+            self.rhs.codegen()
+            if self.op == 'and':
+                self.cvalue = self.builder.select(
+                    self.lhs.cvalue, self.rhs.cvalue, short_value)
+            elif self.op == 'or':
+                self.cvalue = self.builder.select(
+                    self.lhs.cvalue, short_value, self.rhs.cvalue)
+            return
+
+        lhs_block = self.builder.block
+        rhs_block = self.builder.append_basic_block(self.op + '.rhs')
+        end_block = self.builder.append_basic_block(self.op + '.end')
 
         if self.op == 'and':
-            self.cvalue = self.builder.and_(self.lhs.cvalue, self.rhs.cvalue)
+            branch = self.builder.cbranch(self.lhs.cvalue, rhs_block, end_block)
         elif self.op == 'or':
-            self.cvalue = self.builder.or_(self.lhs.cvalue, self.rhs.cvalue)
+            branch = self.builder.cbranch(self.lhs.cvalue, end_block, rhs_block)
+
+        likely = self.lhs.likely()
+        if likely is not None:
+            if likely:
+                weights = [LLVMBranchWeights.LIKELY, LLVMBranchWeights.UNLIKELY]
+            else:
+                weights = [LLVMBranchWeights.UNLIKELY, LLVMBranchWeights.LIKELY]
+            branch.set_weights(weights)
+
+        self.builder.position_at_end(rhs_block)
+        self.rhs.codegen()
+        rhs_end_block = self.builder.block
+        self.builder.branch(end_block)
+
+        self.builder.position_at_end(end_block)
+        self.cvalue = self.builder.phi(LLVMTypes.T_BOOL)
+        self.cvalue.add_incoming(short_value, lhs_block)
+        self.cvalue.add_incoming(self.rhs.cvalue, rhs_end_block)
+
+    def likely(self):
+        lhs, rhs = self.lhs.likely(), self.rhs.likely()
+        if self.op == 'and' and (lhs is False or rhs is False):
+            return False
+        elif self.op == 'or' and (lhs is True or rhs is True):
+            return True
+        return None
 
 
 class AddressOf(RValue):
@@ -1652,6 +2468,14 @@ class LValue(Expr):
         super(LValue, self).__init__(builder, module, symbol_table, lineno)
         self.load = False
         self.ptr = None
+        # Type of the declaration of the lvalue, if known (set by sem)
+        self.decl_type = None
+
+    def length(self):
+        ''' Length of the array lvalue if its declaration is known, else None '''
+        if isinstance(self.decl_type, ArrayType) and self.decl_type.length > 0:
+            return self.decl_type.length
+        return None
 
 
 class NameLValue(LValue):
@@ -1667,6 +2491,7 @@ class NameLValue(LValue):
     def sem(self):
         result = self.symbol_table.lookup(self.id_, lineno=self.lineno)
         self.stype = result.stype
+        self.decl_type = result.type_
         self.changeable = result.name_type not in [NameType.N_FUNCTION, NameType.N_PROCEDURE]
         if self.load and result.num_queries <= 1:
             msg = 'Uniitialized lvalue: {}'.format(self.id_)
@@ -1674,7 +2499,7 @@ class NameLValue(LValue):
 
     def codegen(self):
         self.ptr = self.symbol_table.lookup(self.id_, lineno=self.lineno).cvalue
-        # OPTIMIZE remove redundant loads
+        # Redundant loads are reused by the builder (value numbering)
         if self.load:
             self.cvalue = self.builder.load(self.ptr)
 
@@ -1711,6 +2536,7 @@ class Result(NameLValue):
     def sem(self):
         result = self.symbol_table.lookup('result', lineno=self.lineno)
         self.stype = result.stype
+        self.decl_type = result.type_
 
     def codegen(self):
         self.ptr = self.symbol_table.lookup('result', lineno=self.lineno).cvalue
@@ -1736,6 +2562,10 @@ class StringLiteral(LValue):
         self.literal = fix_escape(literal) + '\0'
         self.length = len(self.literal)
 
+        # Whether the literal is written to (e.g. "abc"[0] := 'x')
+        # and needs a private copy
+        self.copy = False
+
     @AST.sem_decorator
     def sem(self):
         self.stype = (
@@ -1744,12 +2574,22 @@ class StringLiteral(LValue):
              BaseType.T_CHAR))
 
     def codegen(self):
+        '''
+            String literals are pooled as private constants of the
+            module, unless a copy is needed.
+        '''
         self.cvalue = ir.Constant(
             ir.ArrayType(
                 LLVMTypes.T_CHAR, self.length), bytearray(
                 self.literal.encode("utf-8")))
-        self.ptr = self.builder.alloca(self.cvalue.type)
-        self.builder.store(self.cvalue, self.ptr)
+        if self.copy:
+            self.ptr = self.builder.alloca_frame(self.cvalue.type)
+            if self.ptr is None:
+                self.ptr = self.builder.alloca(self.cvalue.type)
+            self.builder.memcpy(self.ptr, self.builder.literal(self.cvalue),
+                                LLVMTypeSize.sizeof(self.cvalue.type))
+        else:
+            self.ptr = self.builder.literal(self.cvalue)
 
 
 class Deref(LValue):
@@ -1777,11 +2617,16 @@ class Deref(LValue):
             self.raise_exception_helper(msg, PCLSemError)
 
         self.stype = self.expr.stype[1]
+        if isinstance(self.expr, AddressOf):
+            self.decl_type = self.expr.lvalue.decl_type
+        elif isinstance(getattr(self.expr, 'decl_type', None), PointerType):
+            self.decl_type = self.expr.decl_type.type_
 
     def codegen(self):
         self.expr.codegen()
         self.ptr = self.expr.cvalue
-        self.cvalue = self.builder.load(self.expr.cvalue)
+        if self.load:
+            self.cvalue = self.builder.load(self.expr.cvalue)
 
 
 class SetExpression(LValue):
@@ -1800,8 +2645,17 @@ class SetExpression(LValue):
         self.lvalue = lvalue
         self.expr = expr
 
+        # Literals are constant, writing to one needs a copy
+        base = lvalue
+        while isinstance(base, LBrack):
+            base = base.lvalue
+        if isinstance(base, StringLiteral):
+            base.copy = True
+
     @AST.sem_decorator
     def sem(self):
+        if isinstance(self.expr, ArOp):
+            self.expr.assigned = True
         self.expr.sem()
         self.lvalue.sem()
 
@@ -1814,9 +2668,20 @@ class SetExpression(LValue):
 
         if self.expr.stype == self.lvalue.stype and is_composite(
                 self.expr.stype):
+            if getattr(self.expr, 'elementwise', False):
+                self.check_lengths()
             return
         elif self.lvalue.stype[1] == BaseType.T_REAL and self.expr.stype[1] == BaseType.T_INT:
             return
+        elif getattr(self.expr, 'elementwise', False) and \
+                self.lvalue.stype == (ComposerType.T_CONST_ARRAY, real_type):
+            self.check_lengths()
+            return
+        elif getattr(self.expr, 'elementwise', False) and \
+                self.lvalue.stype[0] == ComposerType.T_VAR_ARRAY:
+            msg = 'Elementwise expression cannot be assigned to {}, ' \
+                  'its length is unknown'.format(str_type(self.lvalue.stype))
+            self.raise_exception_helper(msg, PCLSemError)
         elif self.lvalue.stype[0] == ComposerType.T_VAR_ARRAY and self.expr.stype[0] == ComposerType.T_CONST_ARRAY:
             return
         elif self.expr.stype[1] == BaseType.T_NIL:
@@ -1828,12 +2693,38 @@ class SetExpression(LValue):
                 str_type(self.lvalue.stype), str_type(self.expr.stype))
             self.raise_exception_helper(msg, PCLSemError)
 
+    def check_lengths(self):
+        ''' The arrays of an elementwise assignment must have the same length '''
+        length = self.lvalue.length()
+        if any(other != length for other in self.expr.lengths()):
+            msg = 'Elementwise operation on arrays of different lengths'
+            self.raise_exception_helper(msg, PCLSemError)
+
     def codegen(self):
+        if getattr(self.expr, 'elementwise', False):
+            self.codegen_elementwise()
+            return
+        copy = self.expr.stype[0] in [
+            ComposerType.T_CONST_ARRAY, ComposerType.T_VAR_ARRAY]
+        if copy:
+            # Arrays are copied with memcpy, their value is not needed
+            self.expr.load = False
         self.expr.codegen()
+        if getattr(self.expr, 'tail_of', None) is not None:
+            # result := call in tail position, the call returns
+            return
         self.lvalue.codegen()
 
         if self.expr.stype[1] == BaseType.T_NIL:
             self.lvalue.set_nil()
+        elif copy:
+            # The source if the length of the destination is unknown, or
+            # the shorter one (string literals into arrays of char)
+            size = LLVMTypeSize.sizeof(self.expr.ptr.type.pointee)
+            lvalue_size = LLVMTypeSize.sizeof(self.lvalue.ptr.type.pointee)
+            if lvalue_size:
+                size = min(size, lvalue_size)
+            self.builder.memcpy(self.lvalue.ptr, self.expr.ptr, size)
         elif self.lvalue.ptr:
             if self.lvalue.stype == (
                     ComposerType.T_NO_COMP,
@@ -1844,7 +2735,47 @@ class SetExpression(LValue):
                     self.expr.cvalue, LLVMTypes.T_REAL)
             else:
                 expr_cvalue = self.expr.cvalue
-            self.builder.store(expr_cvalue, self.lvalue.ptr)
+            if getattr(self.lvalue, 'bit', None) is not None:
+                self.builder.store_bit(expr_cvalue, self.lvalue.ptr, self.lvalue.bit)
+            else:
+                self.builder.store(expr_cvalue, self.lvalue.ptr)
+
+    def codegen_elementwise(self):
+        '''
+            c := a + b * k for arrays a, b and c of the same length is a
+            single loop that computes c[i] := a[i] + b[i] * k, thus it
+            needs no temporary arrays. Each element is read before it is
+            written, so c may be a or b. The scalars (k) are evaluated
+            once, before the loop, which is marked for vectorization.
+        '''
+        self.lvalue.codegen()
+        self.expr.codegen_operands()
+        length = self.lvalue.ptr.type.pointee.count
+
+        index_type = ir.IntType(64)
+        entry_block = self.builder.block
+        body_block = self.builder.append_basic_block('elementwise.body')
+        end_block = self.builder.append_basic_block('elementwise.end')
+        self.builder.branch(body_block)
+        self.builder.position_at_end(body_block)
+        index = self.builder.phi(index_type)
+        index.add_incoming(ir.Constant(index_type, 0), entry_block)
+
+        value = self.expr.codegen_element(index)
+        if self.lvalue.stype[1] == real_type and self.expr.stype[1] == int_type:
+            value = self.builder.sitofp(value, LLVMTypes.T_REAL)
+        self.builder.store(value, self.builder.gep(
+            self.lvalue.ptr, [LLVMConstants.ZERO_INT, index]))
+
+        next_index = self.builder.add(
+            index, ir.Constant(index_type, 1), flags=['nuw', 'nsw'])
+        index.add_incoming(next_index, self.builder.block)
+        done = self.builder.icmp_unsigned(
+            '==', next_index, ir.Constant(index_type, length))
+        latch = self.builder.cbranch(done, end_block, body_block)
+        latch.set_metadata('llvm.loop', self.builder.loop_metadata(
+            [('llvm.loop.vectorize.enable', True)]))
+        self.builder.position_at_end(end_block)
 
 
 class LBrack(LValue):
@@ -1857,6 +2788,17 @@ class LBrack(LValue):
         self.lvalue = lvalue
         self.expr = expr
 
+        # Bounds checking (set by the BoundsAnalyzer): whether to check the
+        # access, the proven range [lo, hi) of the index (or None) and
+        # whether the check is hoisted out of the enclosing loop
+        self.check = False
+        self.range = None
+        self.hoisted = False
+
+        # Bit of the word at ptr that holds the element of a
+        # packed boolean array (see PackedArrayType), else None
+        self.bit = None
+
     @AST.sem_decorator
     def sem(self):
         self.expr.sem()
@@ -1869,13 +2811,62 @@ class LBrack(LValue):
             self.raise_exception_helper(msg, PCLSemError)
 
         self.stype = self.lvalue.stype[1]
+        if isinstance(self.lvalue.decl_type, ArrayType):
+            self.decl_type = self.lvalue.decl_type.type_
 
     def codegen(self):
         self.expr.codegen()
         self.lvalue.codegen()
 
+        if self.check and not self.hoisted:
+            self.check_bounds()
+
+        if self.builder.packed(self.lvalue.ptr):
+            self.ptr, self.bit = self.builder.bit_address(
+                self.lvalue.ptr, self.expr.cvalue)
+            if self.load:
+                self.cvalue = self.builder.load_bit(self.ptr, self.bit)
+            return
+
         self.ptr = self.builder.gep(
             self.lvalue.ptr, [
                 LLVMConstants.ZERO_INT, self.expr.cvalue])
 
-        self.cvalue = self.builder.load(self.ptr)
+        if self.load:
+            self.cvalue = self.builder.load(self.ptr)
+
+    def check_bounds(self, kind='checked'):
+        '''
+            Checks the index against the length of the array type or, for
+            arrays reached through a pointer, the length recorded by new.
+            Constant indices and indices of proven range in bounds need
+            no check, arrays of unknown length (array of parameters and
+            pointers to arrays that new did not allocate) are not checked.
+        '''
+        stats = self.builder.bounds_stats
+        array_type = self.lvalue.ptr.type.pointee
+        if self.builder.packed(self.lvalue.ptr):
+            length = array_type.length
+        else:
+            length = array_type.count
+        index = self.expr.cvalue
+        size_type = ir.IntType(64)
+        if length > 0:
+            range_ = self.range
+            if isinstance(index, ir.Constant):
+                range_ = (index.constant, index.constant + 1)
+            if range_ is not None and 0 <= range_[0] and range_[1] <= length:
+                stats['eliminated'] += 1
+                return
+            self.builder.check_bounds(
+                index, ir.Constant(size_type, length), self.lineno)
+        elif isinstance(self.lvalue, Deref):
+            length, known = self.builder.heap_length(self.lvalue.ptr)
+            self.builder.check_bounds(index, length, self.lineno, known)
+        else:
+            stats['unknown'] += 1
+            return
+
+        stats[kind] += 1
+        if kind == 'checked':
+            self.builder.bounds_lines.append(self.lineno)
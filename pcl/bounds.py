@@ -0,0 +1,342 @@
+from collections import deque
+from pcl.ast import *
+
+
+class BoundsAnalyzer:
+    '''
+        Range analysis for array bounds checking (--bounds-check). Runs
+        between sem and codegen and marks every array access to be checked.
+        Checks that are provably redundant are eliminated and invariant ones
+        are hoisted out of loops:
+
+            1. The integer constants assigned to locals are propagated
+            to the following statements of the same block and to the while
+            loops among them (if not modified in the loop).
+            2. A loop while (i < e) and ... do, where i only increases in the
+            body and e is constant, bounds i by [i0, e) in the rest of the
+            condition and in the statements of the body before i is
+            increased. Accesses a[i + k] in that region get the range
+            [i0 + k, e + k), which codegen compares to the length of a.
+            3. Accesses with a loop invariant index to an array variable
+            that are executed in every iteration are checked once, when
+            the loop is entered. Only accesses that nothing before them in
+            the body can observe are hoisted (no stores, input / output or
+            checks kept in place), thus a failing check exits at the same
+            point of the program.
+
+        Loops that call procedures, assign through pointers or
+        by-reference parameters or contain labels are not analyzed.
+    '''
+
+    def __init__(self, program):
+        self.program = program
+
+        # Stack of scopes, each maps a name to (declaring node, owner)
+        self.scopes = deque([])
+
+    def run(self):
+        for node in self.program.walk():
+            if isinstance(node, LBrack):
+                node.check = True
+        self.visit_body(self.program.body, self.program, [])
+
+    def resolve(self, name):
+        for scope in reversed(self.scopes):
+            if name in scope:
+                return scope[name]
+        return None, None
+
+    def visit_body(self, body, owner, formals):
+        scope = {}
+        for formal in formals:
+            for id_ in formal.ids:
+                scope[id_] = (formal, owner)
+        for local in body.locals_:
+            if isinstance(local, VarList):
+                for var in local.vars_:
+                    for id_ in var.ids:
+                        scope[id_] = (var, owner)
+            elif isinstance(local, Forward):
+                scope[local.header.id_] = (local, owner)
+            elif isinstance(local, LocalHeader):
+                scope[local.header.id_] = (local, owner)
+
+        self.scopes.append(scope)
+        for local in body.locals_:
+            if isinstance(local, LocalHeader):
+                self.visit_body(local.body, local, local.header.formals)
+        self.visit_stmt(body.block, owner)
+        self.scopes.pop()
+
+    def visit_stmt(self, stmt, owner):
+        if isinstance(stmt, Block):
+            self.visit_block(stmt.stmt_list, owner)
+        elif isinstance(stmt, If):
+            self.visit_stmt(stmt.stmt, owner)
+            if stmt.else_stmt:
+                self.visit_stmt(stmt.else_stmt, owner)
+        elif isinstance(stmt, While):
+            self.visit_loop(stmt, {}, owner)
+        elif type(stmt) is Statement and stmt.name:
+            self.visit_stmt(stmt.stmt, owner)
+
+    def visit_block(self, stmts, owner):
+        # Constants known at each statement
+        env = {}
+        for stmt in stmts:
+            if type(stmt) is Statement and stmt.name:
+                # Target of a goto, anything may hold
+                env = {}
+                stmt = stmt.stmt
+
+            if isinstance(stmt, While):
+                self.visit_loop(stmt, env, owner)
+            else:
+                if isinstance(stmt, (SetExpression, Call)):
+                    self.propagate(stmt, env)
+                elif isinstance(stmt, If):
+                    self.propagate(stmt.expr, env)
+                self.visit_stmt(stmt, owner)
+
+            self.transfer(stmt, env, owner)
+
+    def transfer(self, stmt, env, owner):
+        ''' Updates the constants of env after stmt '''
+        if self.clobbers(stmt):
+            env.clear()
+            return
+
+        for id_ in self.modified(stmt):
+            env.pop(id_, None)
+
+        if isinstance(stmt, SetExpression) and self.is_scalar(stmt.lvalue, owner):
+            value = self.const(stmt.expr, env)
+            if value is not None:
+                env[stmt.lvalue.id_] = value
+
+    def propagate(self, node, env):
+        ''' Accesses of node with a constant index (under env) '''
+        for access in node.walk():
+            if isinstance(access, LBrack) and access.range is None:
+                value = self.const(access.expr, env)
+                if value is not None:
+                    access.range = (value, value + 1)
+
+    def is_scalar(self, lvalue, owner):
+        '''
+            True if lvalue names a local of owner that can only be
+            modified by name (thus not by-reference parameters)
+        '''
+        if not isinstance(lvalue, NameLValue) or isinstance(lvalue, Result):
+            return False
+        decl, decl_owner = self.resolve(lvalue.id_)
+        if decl_owner is not owner:
+            return False
+        return isinstance(decl, Var) or (
+            isinstance(decl, Formal) and not decl.by_reference)
+
+    def clobbers(self, stmt):
+        '''
+            True if stmt may modify locals not by name (calls, assignments
+            through pointers and by-reference parameters) or contains labels
+        '''
+        for node in stmt.walk():
+            if isinstance(node, Call):
+                decl, _ = self.resolve(node.id_)
+                if isinstance(decl, (LocalHeader, Forward)):
+                    return True
+            elif isinstance(node, SetExpression):
+                base = node.lvalue
+                while isinstance(base, LBrack):
+                    base = base.lvalue
+                if isinstance(base, Deref):
+                    return True
+                decl, _ = self.resolve(getattr(base, 'id_', None))
+                if isinstance(decl, Formal) and decl.by_reference:
+                    return True
+            elif type(node) is Statement and node.name:
+                return True
+        return False
+
+    @staticmethod
+    def modified(stmt):
+        ''' Names assigned in stmt '''
+        return {node.lvalue.id_ for node in stmt.walk()
+                if isinstance(node, SetExpression) and
+                isinstance(node.lvalue, NameLValue)}
+
+    @staticmethod
+    def const(expr, env):
+        ''' Value of the integer expression expr if it is constant '''
+        if isinstance(expr, IntegerConst):
+            return expr.value
+        elif isinstance(expr, NameLValue) and not isinstance(expr, Result):
+            return env.get(expr.id_, None)
+        elif isinstance(expr, ArUnOp):
+            value = BoundsAnalyzer.const(expr.rhs, env)
+            if value is not None:
+                return -value if expr.op == '-' else value
+        elif isinstance(expr, ArOp) and expr.op in ['+', '-', '*']:
+            lhs = BoundsAnalyzer.const(expr.lhs, env)
+            rhs = BoundsAnalyzer.const(expr.rhs, env)
+            if lhs is not None and rhs is not None:
+                if expr.op == '+':
+                    return lhs + rhs
+                elif expr.op == '-':
+                    return lhs - rhs
+                return lhs * rhs
+        return None
+
+    @staticmethod
+    def linear(expr, id_):
+        ''' Offset k if expr is id_ + k, None otherwise '''
+        if isinstance(expr, NameLValue) and expr.id_ == id_:
+            return 0
+        elif isinstance(expr, ArOp) and expr.op in ['+', '-']:
+            k = BoundsAnalyzer.const(expr.rhs, {})
+            if k is not None and BoundsAnalyzer.linear(expr.lhs, id_) == 0:
+                return k if expr.op == '+' else -k
+            k = BoundsAnalyzer.const(expr.lhs, {})
+            if k is not None and expr.op == '+' and \
+                    BoundsAnalyzer.linear(expr.rhs, id_) == 0:
+                return k
+        return None
+
+    @staticmethod
+    def conjuncts(expr):
+        if isinstance(expr, LogicOp) and expr.op == 'and':
+            return BoundsAnalyzer.conjuncts(expr.lhs) + \
+                BoundsAnalyzer.conjuncts(expr.rhs)
+        return [expr]
+
+    @staticmethod
+    def statements(stmt):
+        if isinstance(stmt, Block):
+            return list(stmt.stmt_list)
+        return [stmt]
+
+    @staticmethod
+    def unconditional(node):
+        '''
+            Array accesses evaluated whenever node is, in
+            evaluation order (right hand sides of and / or excluded)
+        '''
+        if isinstance(node, LogicOp):
+            return BoundsAnalyzer.unconditional(node.lhs)
+        elif isinstance(node, (If, While)):
+            return BoundsAnalyzer.unconditional(node.expr)
+        elif isinstance(node, Block):
+            accesses = []
+            for stmt in node.stmt_list:
+                if isinstance(stmt, (Goto, Return)) or type(stmt) is Statement:
+                    break
+                accesses += BoundsAnalyzer.unconditional(stmt)
+            return accesses
+        elif isinstance(node, SetExpression):
+            # The value is evaluated before the target
+            return BoundsAnalyzer.unconditional(node.expr) + \
+                BoundsAnalyzer.unconditional(node.lvalue)
+        elif isinstance(node, Statement) and not isinstance(node, Call):
+            return []
+
+        accesses = []
+        for k, v in vars(node).items():
+            if k in ['module', 'builder', 'symbol_table', 'callee', 'definition']:
+                continue
+            if isinstance(v, AST):
+                accesses += BoundsAnalyzer.unconditional(v)
+            elif isinstance(v, deque):
+                for x in v:
+                    if isinstance(x, AST):
+                        accesses += BoundsAnalyzer.unconditional(x)
+        if isinstance(node, LBrack):
+            accesses.append(node)
+        return accesses
+
+    def visit_loop(self, loop, env, owner):
+        if self.clobbers(loop.stmt) or self.clobbers(loop.expr):
+            self.visit_stmt(loop.stmt, owner)
+            return
+
+        modified = self.modified(loop.stmt)
+        invariant = {id_: value for id_, value in env.items()
+                     if id_ not in modified}
+        conjuncts = self.conjuncts(loop.expr)
+        stmts = self.statements(loop.stmt)
+        self.propagate(loop.expr, invariant)
+        self.propagate(loop.stmt, invariant)
+
+        for k, cond in enumerate(conjuncts):
+            if not isinstance(cond, CompOp) or cond.op not in ['<', '<=']:
+                continue
+            if not self.is_scalar(cond.lhs, owner):
+                continue
+            id_ = cond.lhs.id_
+            lo, hi = env.get(id_, None), self.const(cond.rhs, invariant)
+            if lo is None or hi is None or not self.increases(id_, loop.stmt):
+                continue
+            if cond.op == '<=':
+                hi += 1
+
+            # The guarded region: the rest of the condition and the
+            # body up to the first statement that increases id_
+            region = conjuncts[k + 1:]
+            for stmt in stmts:
+                if id_ in self.modified(stmt):
+                    break
+                region.append(stmt)
+
+            for node in region:
+                for access in node.walk():
+                    if not isinstance(access, LBrack) or access.range is not None:
+                        continue
+                    offset = self.linear(access.expr, id_)
+                    if offset is not None:
+                        access.range = (lo + offset, hi + offset)
+
+        # Checks of invariant accesses run in every iteration, they move
+        # to the first one as long as nothing before them is observable
+        for stmt in stmts:
+            if isinstance(stmt, (Goto, Return)) or type(stmt) is Statement:
+                break
+            observable = False
+            for access in self.unconditional(stmt):
+                if self.in_bounds(access):
+                    continue
+                names = {node.id_ for node in access.expr.walk()
+                         if isinstance(node, NameLValue)}
+                if access.hoisted or not isinstance(access.lvalue, NameLValue) or \
+                        not access.expr.side_effect_free() or names & modified:
+                    observable = True
+                    break
+                access.hoisted = True
+                loop.hoisted.append(access)
+            if observable or self.effects(stmt):
+                break
+
+        self.visit_stmt(loop.stmt, owner)
+
+    def in_bounds(self, access):
+        ''' True if the range of access is within the length of its array '''
+        if access.range is None or not isinstance(access.lvalue, NameLValue):
+            return False
+        decl, _ = self.resolve(access.lvalue.id_)
+        type_ = getattr(decl, 'type_', None)
+        return isinstance(type_, ArrayType) and \
+            0 <= access.range[0] and access.range[1] <= type_.length
+
+    @staticmethod
+    def effects(stmt):
+        ''' True if stmt may store to memory or perform input / output '''
+        return any(isinstance(node, (SetExpression, Call, New, Dispose))
+                   for node in stmt.walk())
+
+    def increases(self, id_, stmt):
+        ''' True if every assignment to id_ in stmt is id_ := id_ + c, c >= 0 '''
+        for node in stmt.walk():
+            if isinstance(node, SetExpression) and \
+                    isinstance(node.lvalue, NameLValue) and node.lvalue.id_ == id_:
+                step = self.linear(node.expr, id_)
+                if step is None or step < 0:
+                    return False
+        return True
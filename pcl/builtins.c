@@ -1,135 +1,387 @@
-/* Built-in functions for PCL
-  Most functionality wraps existing C functionality
+/* Native part of the PCL runtime
+  The builtins (write*, read*, math and pcl_bounds_error) are generated as
+  an LLVM module by pcl/runtime.py, which pclc.py links into every program
+  and the Makefile compiles into libbuiltins.so next to this file. The
+  allocator and the thread pool stay in C: they depend on the mmap flags,
+  the pthread types and their static initializers and on thread-local
+  storage, whose definitions come from the system headers.
 */
 #include <stdio.h>
 #include <stdlib.h>
-#include <math.h>
-#include <string.h>
-#include <stdarg.h>
+#include <stdint.h>
+#include <sys/mman.h>
+#include <pthread.h>
+#include <unistd.h>
 
 typedef int32_t integer;
 typedef double real;
 typedef int8_t boolean;
 typedef int8_t character;
 
-// write
-character* writeInteger(integer n) {
-  printf("%d", n);
-  return NULL;
-}
+// new / dispose allocator
+//
+// Small objects are served from per size class free lists, refilled by
+// bumping a pointer into an mmap'ed arena. Large objects get their own
+// mapping which is returned to the OS on dispose. Every block is preceded
+// by a header that records its size class (or its mapping length).
+// Setting PCL_ALLOC_STATS prints allocation statistics at exit.
+
+#define PCL_ALIGN 16
+#define PCL_NUM_CLASSES 9
+#define PCL_MAX_SMALL (PCL_ALIGN << (PCL_NUM_CLASSES - 1))
+#define PCL_ARENA_SIZE (1 << 20)
+#define PCL_LARGE ((size_t) -1)
+
+typedef struct pcl_header {
+  size_t size_class;
+  size_t length;
+} pcl_header;
+
+typedef struct pcl_free_block {
+  struct pcl_free_block *next;
+} pcl_free_block;
+
+static pcl_free_block *pcl_free_lists[PCL_NUM_CLASSES];
+static char *pcl_arena = NULL;
+static char *pcl_arena_end = NULL;
+
+// Live blocks and their requested sizes, for the bounds checks of arrays
+// reached through pointers (pcl_heap_length). A pointer may hold the
+// address of any array, thus only the blocks found here have a known
+// length. Open addressing with linear probing, disposed blocks leave a
+// tombstone until the table is rebuilt.
+
+typedef struct pcl_block {
+  void *p;
+  int64_t size;
+} pcl_block;
+
+static pcl_block *pcl_blocks = NULL;
+static size_t pcl_blocks_capacity = 0;
+static size_t pcl_blocks_live = 0;
+static size_t pcl_blocks_used = 0;
+static char pcl_tombstone;
 
-character* writeBoolean(boolean b) {
-  if (b == 0) {
-    printf("false");
+static struct {
+  size_t news;
+  size_t disposes;
+  size_t large;
+  size_t reused;
+  size_t arenas;
+  size_t live_bytes;
+  size_t peak_bytes;
+  size_t class_news[PCL_NUM_CLASSES];
+} pcl_stats;
+
+static void pcl_alloc_report(void) {
+  integer i;
+  fflush(stdout);
+  fprintf(stderr, "\n=== PCL allocation statistics ===\n");
+  fprintf(stderr, "new: %zu (large: %zu, reused: %zu)\n",
+          pcl_stats.news, pcl_stats.large, pcl_stats.reused);
+  fprintf(stderr, "dispose: %zu\n", pcl_stats.disposes);
+  fprintf(stderr, "arenas: %zu x %d bytes\n", pcl_stats.arenas, PCL_ARENA_SIZE);
+  fprintf(stderr, "live bytes: %zu, peak bytes: %zu\n",
+          pcl_stats.live_bytes, pcl_stats.peak_bytes);
+  for (i = 0; i < PCL_NUM_CLASSES; i++) {
+    if (pcl_stats.class_news[i] > 0) {
+      fprintf(stderr, "  class %6d: %zu\n", PCL_ALIGN << i, pcl_stats.class_news[i]);
+    }
   }
-  else {
-    printf("true");
+}
+
+static void pcl_alloc_init(void) {
+  static int initialized = 0;
+  if (!initialized) {
+    initialized = 1;
+    if (getenv("PCL_ALLOC_STATS") != NULL) {
+      atexit(pcl_alloc_report);
+    }
   }
-  return NULL;
 }
 
-character* writeChar(character c) {
-  printf("%c", c);
-  return NULL;
+static void* pcl_map(size_t length) {
+  void *p = mmap(NULL, length, PROT_READ | PROT_WRITE,
+                 MAP_PRIVATE | MAP_ANONYMOUS, -1, 0);
+  if (p == MAP_FAILED) {
+    fprintf(stderr, "new: out of memory\n");
+    exit(1);
+  }
+  return p;
 }
 
-character* writeReal(real x) {
-  printf("%f", x);
-  return NULL;
+static size_t pcl_size_class(size_t size) {
+  size_t c = 0;
+  while ((size_t) (PCL_ALIGN << c) < size) {
+    c++;
+  }
+  return c;
 }
 
-character* writeString(character *s) {
-  printf("%s", s);
-  return NULL;
+static size_t pcl_block_slot(void *p) {
+  size_t i = (((uintptr_t) p >> 4) * 0x9e3779b97f4a7c15ull) & (pcl_blocks_capacity - 1);
+  while (pcl_blocks[i].p != NULL && pcl_blocks[i].p != p) {
+    i = (i + 1) & (pcl_blocks_capacity - 1);
+  }
+  return i;
 }
 
+static void pcl_block_insert(void *p, int64_t size) {
+  pcl_block *old = pcl_blocks;
+  size_t i, capacity = pcl_blocks_capacity;
 
-// read
-integer readInteger() {
-  integer n;
-  scanf("%d", &n);
-  return n;
+  if (2 * (pcl_blocks_used + 1) > pcl_blocks_capacity) {
+    // Rebuild without the tombstones, at most half full
+    pcl_blocks_capacity = 64;
+    while (pcl_blocks_capacity < 4 * (pcl_blocks_live + 1)) {
+      pcl_blocks_capacity *= 2;
+    }
+    pcl_blocks = (pcl_block *) calloc(pcl_blocks_capacity, sizeof(pcl_block));
+    if (pcl_blocks == NULL) {
+      fprintf(stderr, "new: out of memory\n");
+      exit(1);
+    }
+    pcl_blocks_used = pcl_blocks_live;
+    for (i = 0; i < capacity; i++) {
+      if (old[i].p != NULL && old[i].p != &pcl_tombstone) {
+        pcl_blocks[pcl_block_slot(old[i].p)] = old[i];
+      }
+    }
+    free(old);
+  }
+  i = pcl_block_slot(p);
+  pcl_blocks[i].p = p;
+  pcl_blocks[i].size = size;
+  pcl_blocks_live++;
+  pcl_blocks_used++;
 }
 
-boolean readBoolean() {
-  integer n;
-  scanf("%d", &n);
-  return (boolean)n;
+static void pcl_block_remove(void *p) {
+  size_t i;
+  if (pcl_blocks_capacity == 0) {
+    return;
+  }
+  i = pcl_block_slot(p);
+  if (pcl_blocks[i].p == p) {
+    pcl_blocks[i].p = &pcl_tombstone;
+    pcl_blocks_live--;
+  }
 }
 
-character readChar() {
-  character n;
-  n = getchar();
-  return n;
+// Size in bytes of the block of pcl_new at p, -1 if p is not one
+int64_t pcl_heap_length(void *p) {
+  size_t i;
+  if (pcl_blocks_capacity == 0 || p == NULL) {
+    return -1;
+  }
+  i = pcl_block_slot(p);
+  return pcl_blocks[i].p == p ? pcl_blocks[i].size : -1;
 }
 
-real readReal() {
-  float n;
-  scanf("%f", &n);
-  return (double)n;
-}
+void* pcl_new(int64_t size) {
+  pcl_header *h;
+  size_t total, c;
+
+  pcl_alloc_init();
+  if (size < 0) {
+    size = 0;
+  }
+  total = (size_t) size + sizeof(pcl_header);
 
-character* readString(integer size, character *s) {
-    if (size <= 0) {
-      return NULL;
+  if (total > PCL_MAX_SMALL) {
+    h = (pcl_header *) pcl_map(total);
+    h->size_class = PCL_LARGE;
+    h->length = total;
+    pcl_stats.large++;
+  }
+  else {
+    c = pcl_size_class(total);
+    if (pcl_free_lists[c] != NULL) {
+      h = (pcl_header *) pcl_free_lists[c];
+      pcl_free_lists[c] = pcl_free_lists[c]->next;
+      pcl_stats.reused++;
+    }
+    else {
+      if (pcl_arena + (PCL_ALIGN << c) > pcl_arena_end) {
+        pcl_arena = (char *) pcl_map(PCL_ARENA_SIZE);
+        pcl_arena_end = pcl_arena + PCL_ARENA_SIZE;
+        pcl_stats.arenas++;
+      }
+      h = (pcl_header *) pcl_arena;
+      pcl_arena += PCL_ALIGN << c;
     }
+    h->size_class = c;
+    h->length = PCL_ALIGN << c;
+    pcl_stats.class_news[c]++;
+  }
 
-    // Create safeguard buffer
-    character buf[size];
+  pcl_stats.news++;
+  pcl_stats.live_bytes += h->length;
+  if (pcl_stats.live_bytes > pcl_stats.peak_bytes) {
+    pcl_stats.peak_bytes = pcl_stats.live_bytes;
+  }
+  pcl_block_insert((void *) (h + 1), size);
+  return (void *) (h + 1);
+}
 
-    // Sets the sequence to 0
-    memset(buf, 0, size);
+void pcl_dispose(void *p) {
+  pcl_header *h;
+  pcl_free_block *b;
+  size_t c;
 
-    if (size == 1) {
-      return NULL;
-    }
+  if (p == NULL) {
+    return;
+  }
+  pcl_block_remove(p);
+  h = ((pcl_header *) p) - 1;
+  pcl_stats.disposes++;
+  pcl_stats.live_bytes -= h->length;
 
-    size--; // Nead to read size - 1 chars
+  if (h->size_class == PCL_LARGE) {
+    munmap((void *) h, h->length);
+  }
+  else {
+    c = h->size_class;
+    b = (pcl_free_block *) h;
+    b->next = pcl_free_lists[c];
+    pcl_free_lists[c] = b;
+  }
+}
 
-    // Counter
-    integer i = 0;
+// Parallel loops ((*$parallel*) directive)
+//
+// pcl_parallel_for runs body(env, lo, hi) over the iterations [lo, hi) on
+// a pool of threads, which is started on first use. The calling thread
+// takes part as thread 0. PCL_NUM_THREADS sets the size of the pool
+// (default: the number of online processors). With chunk == 0 the range
+// is split into one contiguous block per thread (static scheduling),
+// otherwise the threads take chunks of chunk iterations from a shared
+// counter (dynamic scheduling). Parallel loops nested in the body of a
+// parallel loop run serially.
 
-    character c = getchar();
+#define PCL_MAX_THREADS 256
 
-    // Read the string until EOF or newline
+typedef void (*pcl_body)(void *, integer, integer);
 
-    for (i = 0; i < size; i++) {
-      buf[i] = c;
-      c = getchar();
-      if (c == EOF || c == '\n') break;
-    }
+static struct {
+  pthread_mutex_t lock;
+  pthread_cond_t start;
+  pthread_cond_t done;
+  integer threads;
+  unsigned long generation;
+  integer pending;
+  pcl_body body;
+  void *env;
+  integer lo;
+  integer hi;
+  integer chunk;
+  int64_t next;
+} pcl_pool = {
+  PTHREAD_MUTEX_INITIALIZER, PTHREAD_COND_INITIALIZER, PTHREAD_COND_INITIALIZER
+};
 
-    // Copy from safeguard buffer
-    strcpy((char *)s, (char *)buf);
-    return NULL;
-}
+static pthread_once_t pcl_pool_once = PTHREAD_ONCE_INIT;
+static __thread int pcl_in_parallel = 0;
 
-// ln
-real ln(real x) {
-  return log(x);
-}
+static void pcl_run_share(integer id) {
+  int64_t size, begin, end;
 
-// arctan
-real arctan(real x) {
-  return (real) atan(x);
+  pcl_in_parallel = 1;
+  if (pcl_pool.chunk == 0) {
+    size = (int64_t) pcl_pool.hi - pcl_pool.lo;
+    begin = pcl_pool.lo + size * id / pcl_pool.threads;
+    end = pcl_pool.lo + size * (id + 1) / pcl_pool.threads;
+    if (begin < end) {
+      pcl_pool.body(pcl_pool.env, (integer) begin, (integer) end);
+    }
+  }
+  else {
+    for (;;) {
+      begin = __atomic_fetch_add(&pcl_pool.next, pcl_pool.chunk, __ATOMIC_RELAXED);
+      if (begin >= pcl_pool.hi) {
+        break;
+      }
+      end = begin + pcl_pool.chunk;
+      if (end > pcl_pool.hi) {
+        end = pcl_pool.hi;
+      }
+      pcl_pool.body(pcl_pool.env, (integer) begin, (integer) end);
+    }
+  }
+  pcl_in_parallel = 0;
 }
 
-real pi() {
-  return (real) M_PI;
-}
+static void* pcl_worker(void *arg) {
+  integer id = (integer) (intptr_t) arg;
+  unsigned long seen = 0;
 
-integer trunc2(real x) {
-  return (integer) trunc(x);
-}
+  pthread_mutex_lock(&pcl_pool.lock);
+  for (;;) {
+    while (pcl_pool.generation == seen) {
+      pthread_cond_wait(&pcl_pool.start, &pcl_pool.lock);
+    }
+    seen = pcl_pool.generation;
+    pthread_mutex_unlock(&pcl_pool.lock);
+
+    pcl_run_share(id);
 
-integer round2(real x){
-  return (integer) round(x);
+    pthread_mutex_lock(&pcl_pool.lock);
+    if (--pcl_pool.pending == 0) {
+      pthread_cond_signal(&pcl_pool.done);
+    }
+  }
+  return NULL;
 }
 
-character chr(integer x){
-  return (character) x;
+static void pcl_pool_init(void) {
+  char *s = getenv("PCL_NUM_THREADS");
+  long n = s != NULL ? strtol(s, NULL, 10) : sysconf(_SC_NPROCESSORS_ONLN);
+  pthread_t thread;
+  integer i;
+
+  if (n < 1) {
+    n = 1;
+  }
+  if (n > PCL_MAX_THREADS) {
+    n = PCL_MAX_THREADS;
+  }
+  pcl_pool.threads = 1;
+  for (i = 1; i < n; i++) {
+    if (pthread_create(&thread, NULL, pcl_worker, (void *) (intptr_t) i) != 0) {
+      break;
+    }
+    pthread_detach(thread);
+    pcl_pool.threads++;
+  }
 }
 
-integer ord(character x){
-  return (integer) x;
+void pcl_parallel_for(pcl_body body, void *env, integer lo, integer hi, integer chunk) {
+  if (lo >= hi) {
+    return;
+  }
+  pthread_once(&pcl_pool_once, pcl_pool_init);
+  if (pcl_in_parallel || pcl_pool.threads == 1 || hi - lo == 1) {
+    body(env, lo, hi);
+    return;
+  }
+
+  pthread_mutex_lock(&pcl_pool.lock);
+  pcl_pool.body = body;
+  pcl_pool.env = env;
+  pcl_pool.lo = lo;
+  pcl_pool.hi = hi;
+  pcl_pool.chunk = chunk;
+  pcl_pool.next = lo;
+  pcl_pool.pending = pcl_pool.threads - 1;
+  pcl_pool.generation++;
+  pthread_cond_broadcast(&pcl_pool.start);
+  pthread_mutex_unlock(&pcl_pool.lock);
+
+  pcl_run_share(0);
+
+  pthread_mutex_lock(&pcl_pool.lock);
+  while (pcl_pool.pending > 0) {
+    pthread_cond_wait(&pcl_pool.done, &pcl_pool.lock);
+  }
+  pthread_mutex_unlock(&pcl_pool.lock);
 }
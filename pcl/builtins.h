@@ -15,4 +15,10 @@ extern integer trunc2(real);
 extern integer round2(real);
 extern character chr(integer);
 extern integer ord(character);
+extern void* pcl_new(int64_t);
+extern void pcl_dispose(void*);
+extern int64_t pcl_heap_length(void*);
+extern void pcl_bounds_error(integer, integer, int64_t);
+extern void pcl_parallel_for(void (*)(void *, integer, integer), void *,
+                             integer, integer, integer);
 #endif
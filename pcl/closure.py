@@ -0,0 +1,135 @@
+from collections import namedtuple, defaultdict, OrderedDict
+from pcl.ast import *
+
+# A variable that a procedure uses but does not declare.
+#   id_: name of the variable
+#   owner: the LocalHeader that declares it
+#   type_: the Type node of the declaration
+#   direct: True if the procedure body refers to it by name (and not only
+#       through the procedures it calls)
+FreeVar = namedtuple('FreeVar', ['id_', 'owner', 'type_', 'direct'])
+
+
+class ClosureConverter:
+    '''
+        Closure conversion (lambda lifting) of nested procedures. Runs
+        between sem and codegen. The free variables of every procedure,
+        including the ones needed by the procedures it calls, are computed
+        and the procedure is annotated with them. At codegen they are passed
+        as extra by-reference arguments, thus the locals of all procedures
+        can live on their activation frames.
+
+        Variables of the main program are never lifted; the ones used by
+        procedures remain globals and the rest live on the frame of main.
+    '''
+
+    def __init__(self, program):
+        self.program = program
+
+        # Stack of scopes, each maps a name to (declaring node, owner)
+        self.scopes = deque([])
+
+        # Variables used by name in the body of each procedure
+        self.uses = defaultdict(OrderedDict)
+
+        # Procedures called from the body of each procedure
+        self.calls = defaultdict(list)
+
+        # Call nodes and the declaration they refer to
+        self.call_sites = []
+
+        self.headers = []
+        self.captured = set()
+
+    def run(self):
+        self.scopes.append({})
+        self.visit_body(self.program.body, self.program)
+        self.scopes.pop()
+
+        # Resolve calls to forward declarations
+        for call, decl in self.call_sites:
+            call.callee = self.definition(decl)
+
+        free = {header: OrderedDict(
+            (key, FreeVar(key[0], key[1], type_, True))
+            for key, type_ in self.uses[header].items())
+            for header in self.headers}
+
+        # A procedure must also provide the free variables
+        # of its callees, unless it declares them itself
+        changed = True
+        while changed:
+            changed = False
+            for header in self.headers:
+                for callee in self.calls[header]:
+                    callee = self.definition(callee)
+                    if callee is None:
+                        continue
+                    for key, var in free[callee].items():
+                        if var.owner is not header and key not in free[header]:
+                            free[header][key] = var._replace(direct=False)
+                            changed = True
+
+        for header in self.headers:
+            header.free = list(free[header].values())
+
+        self.program.captured = self.captured
+
+    @staticmethod
+    def definition(decl):
+        if isinstance(decl, Forward):
+            return decl.definition
+        return decl
+
+    def declare(self, name, node, owner):
+        scope = self.scopes[-1]
+        previous = scope.get(name, None)
+        if previous and isinstance(
+                previous[0], Forward) and isinstance(node, LocalHeader):
+            previous[0].definition = node
+        scope[name] = (node, owner)
+
+    def resolve(self, name):
+        for scope in reversed(self.scopes):
+            if name in scope:
+                return scope[name]
+        # Builtins and undeclared names (rejected by sem)
+        return None, None
+
+    def visit_body(self, body, owner):
+        for local in body.locals_:
+            if isinstance(local, VarList):
+                for var in local.vars_:
+                    for id_ in var.ids:
+                        self.declare(id_, var, owner)
+            elif isinstance(local, Forward):
+                self.declare(local.header.id_, local, owner)
+            elif isinstance(local, LocalHeader):
+                self.declare(local.header.id_, local, owner)
+                self.visit_header(local)
+
+        for node in body.block.walk():
+            if isinstance(node, Result):
+                continue
+            elif isinstance(node, NameLValue):
+                decl, decl_owner = self.resolve(node.id_)
+                if not isinstance(decl, (Var, Formal)) or decl_owner is owner:
+                    continue
+                if decl_owner is self.program:
+                    self.captured.add(node.id_)
+                else:
+                    self.uses[owner][(node.id_, decl_owner)] = decl.type_
+            elif isinstance(node, Call):
+                decl, _ = self.resolve(node.id_)
+                if isinstance(decl, (LocalHeader, Forward)):
+                    self.calls[owner].append(decl)
+                    self.call_sites.append((node, decl))
+
+    def visit_header(self, header):
+        self.headers.append(header)
+        self.scopes.append({})
+        for formal in header.header.formals:
+            for id_ in formal.ids:
+                self.declare(id_, formal, header)
+        self.visit_body(header.body, header)
+        self.scopes.pop()
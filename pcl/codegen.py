@@ -1,8 +1,13 @@
 from ctypes import CFUNCTYPE, c_double
 from llvmlite import ir, binding
 from pcl.error import PCLCodegenError
+from pcl.runtime import PCLRuntime
 import os
+import sys
+import math
+import functools
 from subprocess import check_output, run
+from collections import defaultdict
 
 
 class LLVMTypeSize:
@@ -10,6 +15,28 @@ class LLVMTypeSize:
     T_CHAR = 1
     T_PTR = 2
     T_INT = 4
+    T_REAL = 8
+    T_ADDR = 8
+
+    # Largest activation frame of a procedure. Locals that do
+    # not fit fall back to (internal) global storage.
+    MAX_FRAME = 4096
+
+    # Alignment of arrays of at least that many bytes, thus
+    # the vectorizer can use wide (up to 512 bit) aligned loads
+    ARRAY_ALIGN = 64
+
+    @staticmethod
+    def sizeof(typ):
+        ''' Size of an llvmlite type in bytes '''
+        if isinstance(typ, ir.ArrayType):
+            return typ.count * LLVMTypeSize.sizeof(typ.element)
+        elif isinstance(typ, ir.IntType):
+            return max(1, typ.width // 8)
+        elif isinstance(typ, ir.DoubleType):
+            return LLVMTypeSize.T_REAL
+        else:
+            return LLVMTypeSize.T_ADDR
 
 
 class LLVMTypes:
@@ -34,11 +61,260 @@ class LLVMTypes:
         'char': T_CHAR
     }
 
+    # Word of the bit-packed boolean arrays (see PackedArrayType)
+    T_WORD = ir.IntType(64)
+
+    # Names of the scalar types in the TBAA type tree
+    tbaa_names = {str(T_INT): 'integer', str(T_BOOL): 'boolean',
+                  str(T_REAL): 'real', str(T_CHAR): 'char'}
+
+
+class PackedArrayType(ir.ArrayType):
+    '''
+        Layout of an array [length] of boolean with --packed-booleans: the
+        booleans are the bits of 64-bit words, the element type and count
+        are the ones of the words. length is 0 for arrays of unknown length.
+    '''
+
+    BITS = 64
+
+    def __init__(self, length):
+        words = (length + PackedArrayType.BITS - 1) // PackedArrayType.BITS
+        super(PackedArrayType, self).__init__(LLVMTypes.T_WORD, words)
+        self.length = length
+
 
 class LLVMConstants:
     ZERO_INT = ir.Constant(LLVMTypes.T_INT, 0)
     ZERO_REAL = ir.Constant(LLVMTypes.T_REAL, 0)
     NIL = ir.Constant(LLVMTypes.T_NIL, 0)
+    TRUE = ir.Constant(LLVMTypes.T_BOOL, 1)
+    FALSE = ir.Constant(LLVMTypes.T_BOOL, 0)
+
+
+class LLVMBranchWeights:
+    # Branch weights (!prof metadata) of a branch whose outcome
+    # is inferred statically (same ratio as the heuristics of LLVM)
+    LIKELY = 20
+    UNLIKELY = 12
+
+
+class LLVMRuntime:
+    '''
+        Functions of the runtime (runtime.py and builtins.c) used by the
+        generated code and are not visible to PCL programs. They are
+        declared on first use.
+    '''
+
+    # Outlined body of a parallel loop: body(env, lo, hi)
+    parallel_body = ir.FunctionType(
+        ir.VoidType(), [LLVMTypes.T_NIL, LLVMTypes.T_INT, LLVMTypes.T_INT])
+
+    signatures = {
+        'pcl_new': ir.FunctionType(LLVMTypes.T_NIL, [ir.IntType(64)]),
+        'pcl_dispose': ir.FunctionType(ir.VoidType(), [LLVMTypes.T_NIL]),
+        'pcl_heap_length': ir.FunctionType(ir.IntType(64), [LLVMTypes.T_NIL]),
+        'pcl_bounds_error': ir.FunctionType(
+            ir.VoidType(), [LLVMTypes.T_INT, LLVMTypes.T_INT, ir.IntType(64)]),
+        'pcl_parallel_for': ir.FunctionType(ir.VoidType(), [
+            parallel_body.as_pointer(), LLVMTypes.T_NIL,
+            LLVMTypes.T_INT, LLVMTypes.T_INT, LLVMTypes.T_INT]),
+    }
+
+    attributes = {
+        'pcl_new': ['nounwind'],
+        'pcl_dispose': ['nounwind'],
+        'pcl_heap_length': ['nounwind', 'readonly'],
+        'pcl_bounds_error': ['noreturn', 'cold', 'nounwind'],
+        'pcl_parallel_for': ['nounwind'],
+    }
+
+    @staticmethod
+    def get(module, name):
+        try:
+            return module.get_global(name)
+        except KeyError:
+            fn = ir.Function(module, LLVMRuntime.signatures[name], name=name)
+            for attr in LLVMRuntime.attributes.get(name, []):
+                fn.attributes.add(attr)
+            return fn
+
+
+class LLVMAttributes:
+    '''
+        Attributes of the generated functions and of their call sites,
+        inferred from the Effects of the procedures (see EffectAnalyzer).
+    '''
+
+    # Builtins without side effects (the rest do input / output)
+    pure_builtins = {'fabs', 'sqrt', 'sin', 'cos', 'tan', 'arctan', 'exp',
+                     'ln', 'abs', 'trunc', 'round', 'ord', 'chr', 'pi'}
+
+    @staticmethod
+    def add(attributes, names):
+        '''
+            Adds names to the attribute set of a function or a call. The
+            sets of llvmlite reject attributes they do not know, e.g.
+            willreturn (and argmemonly on calls), though LLVM accepts them.
+        '''
+        for name in names:
+            try:
+                attributes.add(name)
+            except ValueError:
+                set.add(attributes, name)
+
+    @staticmethod
+    def of(effects):
+        ''' Attributes of a procedure with effects (None if unknown) '''
+        attributes = ['nounwind']
+        if effects is None:
+            return attributes
+        if not effects.recursive:
+            attributes.append('norecurse')
+        if effects.terminates:
+            attributes.append('willreturn')
+
+        memory = effects.reads | effects.writes
+        if not memory:
+            attributes.append('readnone')
+        elif not effects.writes:
+            attributes.append('readonly')
+        if memory and memory <= {'arg'}:
+            attributes.append('argmemonly')
+        return attributes
+
+    @staticmethod
+    def builtin(name):
+        if name in LLVMAttributes.pure_builtins:
+            return ['nounwind', 'readnone', 'willreturn']
+        return ['nounwind']
+
+
+class LLVMDirectives:
+    '''
+        Directive comments (see PCLLexer.directive) of procedures, lowered
+        to function attributes, and of while loops, lowered to the llvm.loop
+        metadata of the back edge. The tables map the name of a directive
+        to its only option, which may be given as a positional argument
+        too, e.g. (*$unroll 4*) or (*$unroll count=4*). Loops marked with
+        (*$parallel*) are outlined instead (see ParallelAnalyzer).
+    '''
+
+    procedure = {'inline': None, 'noinline': None}
+    loop = {'unroll': 'count', 'vectorize': 'width', 'parallel': 'chunk'}
+
+    @staticmethod
+    def check(directive, table):
+        ''' Message of the error of directive, None if it is valid '''
+        if directive.name not in table:
+            return 'Directive {} does not apply here'.format(directive.name)
+        option = table[directive.name]
+        keys = set(directive.options) - {option}
+        if keys or len(directive.args) + len(directive.options) > (option is not None):
+            return 'Invalid arguments of directive {}'.format(directive.name)
+        if 0 in directive.args or 0 in directive.options.values():
+            return 'Directive {} expects positive arguments'.format(directive.name)
+        return None
+
+    @staticmethod
+    def value(directive, table):
+        ''' Argument of a valid directive, None if not given '''
+        if directive.args:
+            return directive.args[0]
+        return directive.options.get(table[directive.name], None)
+
+    @staticmethod
+    def attributes(directives):
+        ''' Function attributes of the (valid) directives of a procedure '''
+        attributes = {'inline': 'alwaysinline', 'noinline': 'noinline'}
+        # The last one wins
+        names = [d.name for d in directives if d.name in attributes]
+        return [attributes[names[-1]]] if names else []
+
+    @staticmethod
+    def loop_properties(directives):
+        '''
+            Properties (name, value) of the llvm.loop metadata of the
+            (valid) directives of a loop. Width 1 disables vectorization.
+        '''
+        properties = []
+        for directive in directives:
+            value = LLVMDirectives.value(directive, LLVMDirectives.loop)
+            if directive.name == 'unroll':
+                if value is None:
+                    properties.append(('llvm.loop.unroll.enable', None))
+                else:
+                    properties.append(('llvm.loop.unroll.count', value))
+            elif directive.name == 'vectorize':
+                if value != 1:
+                    properties.append(('llvm.loop.vectorize.enable', True))
+                if value is not None:
+                    properties.append(('llvm.loop.vectorize.width', value))
+        return properties
+
+
+class LLVMIntrinsics:
+    '''
+        Math builtins that are lowered to LLVM intrinsics instead of calls
+        to the runtime, so that they can be constant folded, hoisted and
+        vectorized. The rest (tan, arctan) have no intrinsic and remain
+        calls to the runtime.
+    '''
+
+    math = {
+        'fabs': 'llvm.fabs',
+        'sqrt': 'llvm.sqrt',
+        'sin': 'llvm.sin',
+        'cos': 'llvm.cos',
+        'exp': 'llvm.exp',
+        'ln': 'llvm.log',
+    }
+
+    @staticmethod
+    def get(module, name):
+        return module.declare_intrinsic(name, [LLVMTypes.T_REAL])
+
+    @staticmethod
+    def call(builder, name, args):
+        ''' Emits the intrinsic of builtin name, None if there is none '''
+        if name not in LLVMIntrinsics.math:
+            return None
+        fn = LLVMIntrinsics.get(builder.module, LLVMIntrinsics.math[name])
+        return builder.call(fn, args)
+
+
+class LLVMExpansions:
+    '''
+        Trivial builtins that are expanded to IR at the call site, thus
+        they cost no call even at -O0. Each entry takes the builder and
+        the arguments and returns the value of the call.
+    '''
+
+    @staticmethod
+    def abs_(builder, x):
+        negative = builder.icmp_signed('<', x, LLVMConstants.ZERO_INT)
+        return builder.select(negative, builder.neg(x), x)
+
+    @staticmethod
+    def round_(builder, x):
+        x = builder.call(LLVMIntrinsics.get(builder.module, 'llvm.round'), [x])
+        return builder.fptosi(x, LLVMTypes.T_INT)
+
+    table = {
+        'abs': lambda builder, x: LLVMExpansions.abs_(builder, x),
+        'ord': lambda builder, x: builder.zext(x, LLVMTypes.T_INT),
+        'chr': lambda builder, x: builder.trunc(x, LLVMTypes.T_CHAR),
+        'pi': lambda builder: ir.Constant(LLVMTypes.T_REAL, math.pi),
+        'trunc': lambda builder, x: builder.fptosi(x, LLVMTypes.T_INT),
+        'round': lambda builder, x: LLVMExpansions.round_(builder, x),
+    }
+
+    @staticmethod
+    def expand(builder, name, args):
+        ''' Expands builtin name, None if it has no expansion '''
+        if name not in LLVMExpansions.table:
+            return None
+        return LLVMExpansions.table[name](builder, *args)
 
 
 class LLVMOperators:
@@ -54,8 +330,471 @@ class LLVMOperators:
         return LLVMOperators.comp_mapping.get(op, op)
 
 
+class PCLBuilder(ir.IRBuilder):
+    '''
+        ir.IRBuilder with bookkeeping for the activation frames
+        of the generated functions.
+    '''
+
+    def __init__(self, block=None):
+        super(PCLBuilder, self).__init__(block)
+        # Bytes allocated on the frame of each function
+        self.frame_sizes = defaultdict(int)
+
+        # Pool of string literals
+        self.literals = {}
+
+        # Statistics of the bounds checks (--bounds-check) by kind
+        # and the lines of the accesses that are checked at runtime
+        self.bounds_stats = defaultdict(int)
+        self.bounds_lines = []
+
+        # Fast-math flags of floating point instructions (e.g. 'fast',
+        # 'nnan', 'ninf', 'reassoc', 'contract'). None by default
+        self.fastmath = ()
+
+        # Bit-packed layout of the boolean arrays (see PackedArrayType)
+        self.packed_booleans = False
+
+        # Block-local value numbering: pure instructions and the values
+        # of loads (by pointer) available at the insertion point
+        self.value_numbering = True
+        self.values = {}
+        self.loads = {}
+
+    @staticmethod
+    def value_key(x):
+        ''' Hashable key of an instruction operand '''
+        if isinstance(x, ir.Value):
+            return (str(x.type), x.get_reference())
+        elif isinstance(x, (list, tuple)):
+            return tuple(PCLBuilder.value_key(y) for y in x)
+        elif isinstance(x, ir.Type):
+            return str(x)
+        return x
+
+    def numbered(self, opname, args, emit):
+        '''
+            Reuses the instruction opname(args) if an identical one is
+            available in the current block, else emits it
+        '''
+        if not self.value_numbering:
+            return emit()
+        key = (opname, self.value_key(args))
+        if key not in self.values:
+            self.values[key] = emit()
+        return self.values[key]
+
+    def invalidate(self):
+        ''' Forgets the available values (the insertion point moved) '''
+        self.values = {}
+        self.loads = {}
+
+    def position_before(self, instr):
+        self.invalidate()
+        super().position_before(instr)
+
+    def position_after(self, instr):
+        self.invalidate()
+        super().position_after(instr)
+
+    def position_at_start(self, block):
+        self.invalidate()
+        super().position_at_start(block)
+
+    def position_at_end(self, block):
+        self.invalidate()
+        super().position_at_end(block)
+
+    @staticmethod
+    def base(ptr):
+        '''
+            The variable (alloca or global) ptr points into, None if
+            unknown (heap pointers and by-reference parameters, which
+            may point to any variable)
+        '''
+        while isinstance(ptr, ir.GEPInstr) or (
+                isinstance(ptr, ir.CastInstr) and ptr.opname == 'bitcast'):
+            ptr = ptr.operands[0]
+        if isinstance(ptr, (ir.AllocaInstr, ir.GlobalVariable)):
+            return ptr
+        return None
+
+    @staticmethod
+    def tbaa_name(typ):
+        '''
+            Name of the TBAA type of the values of typ (see tbaa), None for
+            aggregates. Arrays are named by their element type only, since
+            by-reference parameters cast [n x T] to [0 x T].
+        '''
+        if isinstance(typ, ir.PointerType):
+            pointee = typ.pointee
+            prefix = 'pointer to '
+            while isinstance(pointee, ir.ArrayType):
+                pointee, prefix = pointee.element, prefix + 'array of '
+            name = PCLBuilder.tbaa_name(pointee)
+            return prefix + name if name else None
+        return LLVMTypes.tbaa_names.get(str(typ), None)
+
+    def tbaa(self, typ):
+        '''
+            Access tag of the type based alias analysis (TBAA) for scalars of
+            typ. PCL has no casts, thus scalars of different types (integer,
+            real, char, boolean and each pointer type) never alias.
+        '''
+        name = self.tbaa_name(typ)
+        if name is None:
+            return None
+        module = self.module
+        i64 = ir.IntType(64)
+        root = module.add_metadata(['PCL TBAA'])
+        parent = root
+        if isinstance(typ, ir.PointerType):
+            parent = module.add_metadata(['any pointer', root, ir.Constant(i64, 0)])
+        node = module.add_metadata([name, parent, ir.Constant(i64, 0)])
+        return module.add_metadata([node, node, ir.Constant(i64, 0)])
+
+    def may_alias(self, ptr, other):
+        '''
+            False if ptr and other point into different variables or to
+            scalars of different types
+        '''
+        base, other_base = self.base(ptr), self.base(other)
+        if base is not None and other_base is not None and base is not other_base:
+            return False
+        name = self.tbaa_name(ptr.type.pointee)
+        other_name = self.tbaa_name(other.type.pointee)
+        return name is None or other_name is None or name == other_name
+
+    def holds(self, ptr, value):
+        ''' Later loads of ptr reuse value, which is known to be stored there '''
+        if self.value_numbering:
+            self.loads[self.value_key(ptr)] = (ptr, value)
+
+    def load(self, ptr, name='', align=None):
+        ''' Loads are reused until the next store or call '''
+        key = self.value_key(ptr)
+        if not self.value_numbering or key not in self.loads:
+            instr = super().load(ptr, name=name, align=align)
+            tag = self.tbaa(instr.type)
+            if tag is not None:
+                instr.set_metadata('tbaa', tag)
+            if not self.value_numbering:
+                return instr
+            self.loads[key] = (ptr, instr)
+        return self.loads[key][1]
+
+    def store(self, value, ptr, align=None):
+        '''
+            A store kills the loads that may alias it (see may_alias). The
+            stored value is forwarded to later loads.
+        '''
+        key = self.value_key(ptr)
+        self.loads = {k: v for k, v in self.loads.items()
+                      if not self.may_alias(ptr, v[0])}
+        instr = super().store(value, ptr, align=align)
+        tag = self.tbaa(value.type)
+        if tag is not None:
+            instr.set_metadata('tbaa', tag)
+        if self.value_numbering and value.type == ptr.type.pointee:
+            self.loads[key] = (ptr, value)
+        return instr
+
+    def fadd(self, lhs, rhs, name='', flags=()):
+        return super().fadd(lhs, rhs, name=name, flags=flags or self.fastmath)
+
+    def fsub(self, lhs, rhs, name='', flags=()):
+        return super().fsub(lhs, rhs, name=name, flags=flags or self.fastmath)
+
+    def fmul(self, lhs, rhs, name='', flags=()):
+        return super().fmul(lhs, rhs, name=name, flags=flags or self.fastmath)
+
+    def fdiv(self, lhs, rhs, name='', flags=()):
+        return super().fdiv(lhs, rhs, name=name, flags=flags or self.fastmath)
+
+    def fneg(self, arg, name='', flags=()):
+        return super().fneg(arg, name=name, flags=flags or self.fastmath)
+
+    def fcmp_ordered(self, cmpop, lhs, rhs, name='', flags=()):
+        return super().fcmp_ordered(
+            cmpop, lhs, rhs, name=name, flags=flags or self.fastmath)
+
+    def call(self, fn, args, name='', cconv=None, tail=False, fastmath=(),
+             attrs=(), arg_attrs=None):
+        ''' Calls returning a real (math intrinsics) get fast-math flags '''
+        if not fastmath and fn.function_type.return_type == LLVMTypes.T_REAL:
+            fastmath = self.fastmath
+        # The callee may modify memory, unless it is a math intrinsic
+        if not (fn.name.startswith('llvm.') and not any(
+                isinstance(arg.type, ir.PointerType) for arg in args)):
+            self.loads = {}
+        return super().call(fn, args, name=name, cconv=cconv, tail=tail,
+                            fastmath=fastmath, attrs=attrs, arg_attrs=arg_attrs)
+
+    def alloca_frame(self, typ, name=''):
+        '''
+            Allocates typ on the activation frame of the current function.
+            The alloca is emitted at the entry block so that it happens
+            once per call and mem2reg can promote it. Returns None if the
+            frame would exceed LLVMTypeSize.MAX_FRAME.
+        '''
+        size = LLVMTypeSize.sizeof(typ)
+        if self.frame_sizes[self.function] + size > LLVMTypeSize.MAX_FRAME:
+            return None
+
+        self.frame_sizes[self.function] += size
+        with self.goto_entry_block():
+            ptr = self.alloca(typ, name=name)
+        # Large arrays are aligned for wide vector loads
+        if size >= LLVMTypeSize.ARRAY_ALIGN and isinstance(typ, ir.ArrayType):
+            ptr.align = LLVMTypeSize.ARRAY_ALIGN
+        return ptr
+
+    @property
+    def terminated(self):
+        '''
+            True if the current block is terminated (e.g. after a goto
+            or a return), thus the code that follows is unreachable
+        '''
+        return self.block.is_terminated
+
+    @staticmethod
+    def successors(block):
+        terminator = block.terminator
+        if isinstance(terminator, ir.SwitchInstr):
+            return [terminator.default] + [case[1] for case in terminator.cases]
+        elif terminator is not None:
+            return [op for op in terminator.operands if isinstance(op, ir.Block)]
+        return []
+
+    @staticmethod
+    def forward(block, entry):
+        '''
+            Target of the chain of blocks starting from block that contain
+            nothing but an unconditional branch (and no phi nodes to fix)
+        '''
+        seen = set()
+        while block is not entry and block not in seen and \
+                len(block.instructions) == 1 and \
+                type(block.terminator) is ir.Branch and \
+                not block.terminator.metadata:
+            target = block.terminator.operands[0]
+            if target.instructions and isinstance(target.instructions[0], ir.PhiInstr):
+                break
+            seen.add(block)
+            block = target
+        return block
+
+    def clean_cfg(self, function):
+        '''
+            Removes the empty and unreachable blocks of function. Branches
+            to blocks that hold nothing but a branch are forwarded to
+            the final target and blocks unreachable from the entry
+            block are dropped (along with their phi incomings).
+        '''
+        entry = function.entry_basic_block
+        for block in function.blocks:
+            terminator = block.terminator
+            if isinstance(terminator, ir.SwitchInstr):
+                terminator.default = self.forward(terminator.default, entry)
+                terminator.cases = [(value, self.forward(target, entry))
+                                    for value, target in terminator.cases]
+            elif terminator is not None:
+                for target in self.successors(block):
+                    terminator.replace_usage(target, self.forward(target, entry))
+
+        reachable, stack = {entry}, [entry]
+        while stack:
+            for target in self.successors(stack.pop()):
+                if target not in reachable:
+                    reachable.add(target)
+                    stack.append(target)
+
+        function.blocks = [block for block in function.blocks if block in reachable]
+        for block in function.blocks:
+            for instr in block.instructions:
+                if isinstance(instr, ir.PhiInstr):
+                    instr.incomings = [(value, pred) for value, pred in instr.incomings
+                                       if pred in reachable]
+
+    def check_bounds(self, index, length, lineno, known=None):
+        '''
+            Checks that 0 <= index < length (a single unsigned comparison)
+            and calls pcl_bounds_error of the runtime otherwise. If known is
+            given, the check applies only if it holds.
+        '''
+        size_type = ir.IntType(64)
+        ok = self.icmp_unsigned('<', self.sext(index, size_type), length)
+        if known is not None:
+            ok = self.or_(self.not_(known), ok)
+        with self.if_then(self.not_(ok), likely=False):
+            pcl_bounds_error = LLVMRuntime.get(self.module, 'pcl_bounds_error')
+            self.call(pcl_bounds_error, [
+                ir.Constant(LLVMTypes.T_INT, lineno), index, length])
+
+    def heap_length(self, array_ptr):
+        '''
+            Length of the array at array_ptr if pcl_new allocated it, and
+            whether it did (pcl_heap_length of the runtime looks the
+            pointer up among the live blocks). The length of packed
+            boolean arrays is rounded up to whole words.
+        '''
+        size_type = ir.IntType(64)
+        pcl_heap_length = LLVMRuntime.get(self.module, 'pcl_heap_length')
+        size = self.call(pcl_heap_length, [self.bitcast(array_ptr, LLVMTypes.T_NIL)])
+        known = self.icmp_signed('>=', size, ir.Constant(size_type, 0))
+        element_size = LLVMTypeSize.sizeof(array_ptr.type.pointee.element)
+        length = self.udiv(size, ir.Constant(size_type, element_size))
+        if self.packed(array_ptr):
+            length = self.mul(length, ir.Constant(size_type, PackedArrayType.BITS))
+        return length, known
+
+    @staticmethod
+    def packed(array_ptr):
+        ''' True if array_ptr points to a bit-packed boolean array '''
+        return isinstance(array_ptr.type.pointee, PackedArrayType)
+
+    def bit_address(self, array_ptr, index):
+        ''' The word of a packed boolean array that holds bit index, and the bit '''
+        word_index = self.ashr(index, ir.Constant(index.type, 6))
+        word = self.gep(array_ptr, [LLVMConstants.ZERO_INT, word_index])
+        bit = self.and_(index, ir.Constant(index.type, PackedArrayType.BITS - 1))
+        return word, self.zext(bit, LLVMTypes.T_WORD)
+
+    def load_bit(self, word, bit):
+        return self.trunc(self.lshr(self.load(word), bit), LLVMTypes.T_BOOL)
+
+    def store_bit(self, value, word, bit):
+        ''' Read-modify-write of the bit of word '''
+        mask = self.shl(ir.Constant(LLVMTypes.T_WORD, 1), bit)
+        cleared = self.and_(self.load(word), self.not_(mask))
+        value = self.shl(self.zext(value, LLVMTypes.T_WORD), bit)
+        self.store(self.or_(cleared, value), word)
+
+    @staticmethod
+    def alignment(ptr):
+        '''
+            Known alignment of the array at ptr: the one of the variable
+            if ptr points to its start, else the one of its scalars
+        '''
+        typ = ptr.type.pointee
+        while isinstance(typ, ir.ArrayType):
+            typ = typ.element
+        align = LLVMTypeSize.sizeof(typ)
+        if isinstance(ptr, (ir.AllocaInstr, ir.GlobalVariable)) and ptr.align:
+            align = max(align, ptr.align)
+        return align
+
+    def memcpy(self, dst, src, size):
+        '''
+            Copies size bytes from the array at src to the array at dst
+            with llvm.memcpy. An aggregate load and store would be
+            expanded to a value per element, which is slow to compile
+            and to run for large arrays.
+        '''
+        i8_ptr = ir.IntType(8).as_pointer()
+        size_type = ir.IntType(64)
+        fn = self.module.declare_intrinsic(
+            'llvm.memcpy', [i8_ptr, i8_ptr, size_type])
+        args = [self.bitcast(dst, i8_ptr), self.bitcast(src, i8_ptr),
+                ir.Constant(size_type, size), ir.Constant(ir.IntType(1), 0)]
+        instr = self.call(fn, args)
+        for i, ptr in enumerate([dst, src]):
+            attrs = ir.values.ArgumentAttributes()
+            attrs.align = self.alignment(ptr)
+            instr.arg_attributes[i] = attrs
+        return instr
+
+    def literal(self, value):
+        '''
+            Returns a private unnamed_addr constant global holding
+            value (an ir.Constant). Identical literals share the
+            same global across the module.
+        '''
+        key = (str(value.type), bytes(value.constant))
+        if key not in self.literals:
+            name = '.str.{}'.format(len(self.literals))
+            literal = ir.GlobalVariable(self.module, value.type, name=name)
+            literal.initializer = value
+            literal.global_constant = True
+            literal.unnamed_addr = True
+            literal.linkage = 'private'
+            self.literals[key] = literal
+
+        return self.literals[key]
+
+    def branch_weights(self, taken, not_taken):
+        ''' Profile metadata (prof) of a conditional branch '''
+        # Weights are unsigned 32-bit integers
+        i32, limit = ir.IntType(32), 2 ** 32 - 1
+        return self.module.add_metadata(
+            ['branch_weights', ir.Constant(i32, min(taken, limit)),
+             ir.Constant(i32, min(not_taken, limit))])
+
+    def loop_metadata(self, properties):
+        '''
+            Loop identifier (a distinct, self-referential node) with the
+            properties (name, value) of the loop, see LLVMDirectives
+        '''
+        operands = []
+        for name, value in properties:
+            if value is None:
+                operands.append(self.module.add_metadata([name]))
+            elif isinstance(value, bool):
+                operands.append(self.module.add_metadata(
+                    [name, LLVMConstants.TRUE if value else LLVMConstants.FALSE]))
+            else:
+                operands.append(self.module.add_metadata(
+                    [name, ir.Constant(LLVMTypes.T_INT, value)]))
+        # Not module.add_metadata: it would share the node of equal loops
+        loop = ir.MDValue(self.module, [], name=str(len(self.module.metadata)))
+        loop.operands = tuple([loop] + operands)
+        return loop
+
+    @property
+    def module(self):
+        return self.function.module
+
+
+def value_numbered(method):
+    ''' Value numbering of the pure instruction emitted by method '''
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        kwargs.pop('name', None)
+        return self.numbered(
+            method.__name__, (args, sorted(kwargs.items())),
+            lambda: method(self, *args, **kwargs))
+    return wrapper
+
+
+# Instructions without side effects (division is included, it is
+# reused only after an identical one was executed in the same block)
+for _name in ['add', 'sub', 'mul', 'sdiv', 'srem', 'neg', 'and_', 'or_',
+              'xor', 'not_', 'shl', 'lshr', 'ashr', 'icmp_signed',
+              'icmp_unsigned', 'fadd', 'fsub', 'fmul', 'fdiv', 'fneg',
+              'fcmp_ordered', 'sitofp', 'fptosi', 'zext', 'sext', 'trunc',
+              'fpext', 'bitcast', 'inttoptr', 'ptrtoint', 'gep', 'select',
+              'extract_value']:
+    setattr(PCLBuilder, _name, value_numbered(getattr(PCLBuilder, _name)))
+
+
 class PCLCodegen:
 
+    # Optimization levels: (opt_level, size_level, inlining_threshold,
+    # vectorize). The inlining thresholds are the ones of clang
+    opt_levels = {
+        '0': (0, 0, None, False),
+        '1': (1, 0, 225, False),
+        '2': (2, 0, 225, True),
+        '3': (3, 0, 275, True),
+        's': (2, 1, 75, True),
+        'z': (2, 2, 25, False),
+    }
+
+    # The library (-l) of the runtime functions that are not linked into
+    # the module (see PCLRuntime)
+    builtins_library = 'builtins'
+
     def __init__(self):
         ''' Initialize  llvm '''
         self.binding = binding
@@ -67,40 +806,134 @@ class PCLCodegen:
         self.module = ir.Module()
         self.module.triple = self.binding.get_default_triple()
 
+        # Target CPU and features, the host by default (see set_target)
+        self.cpu = None
+        self.features = None
+        self.tm = None
+
         # Declare main function
         func_type = ir.FunctionType(ir.VoidType(), [], False)
         base_func = ir.Function(self.module, func_type, name='main')
+        LLVMAttributes.add(base_func.attributes, ['nounwind', 'norecurse'])
         block = base_func.append_basic_block()
 
         # Declare builder
-        self.builder = ir.IRBuilder(block)
-
-    def postprocess_module(self, level=2):
+        self.builder = PCLBuilder(block)
+
+    def set_target(self, cpu='native', features='native'):
+        ''' Sets the target CPU and features, native for the host '''
+        self.cpu = self.binding.get_host_cpu_name() if cpu == 'native' else cpu
+        if features == 'native':
+            features = self.binding.get_host_cpu_features().flatten()
+        self.features = features
+        self.tm = None
+
+    def bounds_report(self):
+        ''' Summary of the bounds checks of the module '''
+        stats = self.builder.bounds_stats
+        lines = ', '.join(str(line) for line in sorted(set(self.builder.bounds_lines)))
+        return '\n'.join([
+            'Bounds checks of {} array accesses:'.format(sum(stats.values())),
+            '  eliminated (proven safe): {}'.format(stats['eliminated']),
+            '  hoisted out of loops: {}'.format(stats['hoisted']),
+            '  checked: {}{}'.format(
+                stats['checked'], ' (lines {})'.format(lines) if lines else ''),
+            '  unchecked (unknown length): {}'.format(stats['unknown']),
+        ])
+
+    def set_fast_math(self, flags):
+        '''
+            Attaches fast-math flags to the floating point instructions and
+            calls emitted from now on. 'fast' implies all of them.
+        '''
+        self.builder.fastmath = tuple(flags)
+
+    def set_packed_booleans(self, enabled=True):
+        '''
+            Lays out the boolean arrays declared from now on as bits of
+            64-bit words (see PackedArrayType) instead of one byte each
+        '''
+        self.builder.packed_booleans = enabled
+
+    def target_machine(self):
+        '''
+            Target machine (of the host unless set_target is called)
+            used both for optimization and emission
+        '''
+        if self.tm is None:
+            if self.cpu is None:
+                self.set_target()
+            target = self.binding.Target.from_triple(self.module.triple)
+            self.tm = target.create_target_machine(
+                cpu=self.cpu, features=self.features, opt=2, reloc='pic')
+        return self.tm
+
+    def postprocess_module(self, level=2, **options):
         ''' Module post-processing '''
-        self.builder.ret_void()
+        if not self.builder.terminated:
+            self.builder.ret_void()
+        self.builder.clean_cfg(self.builder.function)
+        self.module.data_layout = str(self.target_machine().target_data)
 
         # Verify module
         self.module = self.binding.parse_assembly(str(self.module))
         self.module.verify()
 
-        # Optimize module
-        self.optimize_module(level=level)
+        # Link the runtime before optimization. Functions of libbuiltins.so
+        # that are still referenced (the allocator) are resolved at link time
+        runtime = self.binding.parse_assembly(
+            str(PCLRuntime(triple=self.module.triple)))
+        runtime.verify()
+        self.module.link_in(runtime)
+        self.builtins = sorted(fn.name for fn in self.module.functions
+                               if fn.is_declaration and
+                               fn.name in LLVMRuntime.signatures)
+        self.libs = ['-lm']
+        if self.builtins:
+            self.libs.insert(0, '-l' + self.builtins_library)
 
-    def optimize_module(self, level=2):
-        if level == 0:
-            return
-        elif level < 0 or level >= 3:
+        # Optimize module
+        self.optimize_module(level=level, **options)
+
+    def optimize_module(self, level=2, loop_vectorize=None, slp_vectorize=None,
+                        inlining_threshold=None, passes=None):
+        '''
+            Optimizes the module at level (0-3, s or z). The vectorizers and
+            the inlining threshold default to the ones of the level. If passes
+            (names of llvmlite passes, e.g. licm, gvn, sroa) are given, they
+            are run instead of the pipeline of the level.
+        '''
+        level = str(level)
+        if level not in self.opt_levels:
             msg = 'Undefined optimization level: {}'.format(level)
             raise PCLCodegenError(msg)
 
+        if passes:
+            self.run_passes(passes)
+            return
+
+        opt_level, size_level, threshold, vectorize = self.opt_levels[level]
+        if opt_level == 0:
+            return
+
         # Initialize pass manager builder
         self.pmb = binding.PassManagerBuilder()
 
         # Declare optimization level
-        self.pmb.opt_level = level
+        self.pmb.opt_level = opt_level
+        self.pmb.size_level = size_level
+
+        # Inline the (linked) runtime into the program
+        if inlining_threshold is None:
+            inlining_threshold = threshold
+        self.pmb.inlining_threshold = inlining_threshold
+
+        self.pmb.loop_vectorize = vectorize if loop_vectorize is None else loop_vectorize
+        self.pmb.slp_vectorize = vectorize if slp_vectorize is None else slp_vectorize
 
         # Run LOCAL optimizations on functions
         self.fpm = binding.FunctionPassManager(self.module)
+        self.target_machine().add_analysis_passes(self.fpm)
         self.pmb.populate(self.fpm)
         self.fpm.initialize()
 
@@ -111,23 +944,71 @@ class PCLCodegen:
 
         # Configure module pass manager
         self.mpm = binding.ModulePassManager()
+        self.target_machine().add_analysis_passes(self.mpm)
         self.pmb.populate(self.mpm)
 
         # Run GLOBAL optimizations on the module
         self.mpm.run(self.module)
 
-    def generate_outputs(self, filename, llc_to_stdout=False):
+    def run_passes(self, passes):
+        ''' Runs a custom pipeline of passes (in the given order) '''
+        self.mpm = binding.ModulePassManager()
+        self.target_machine().add_analysis_passes(self.mpm)
+        for name in passes:
+            try:
+                getattr(self.mpm, 'add_{}_pass'.format(name))()
+            except (AttributeError, TypeError):
+                msg = 'Undefined pass: {}'.format(name)
+                raise PCLCodegenError(msg)
+        self.mpm.run(self.module)
+
+    # Output formats of emit and their file extensions
+    emit_formats = {
+        'obj': '.o',
+        'asm': '.s',
+        'bc': '.bc',
+    }
+
+    def emit(self, fmt='obj'):
+        ''' Emits the module in-process as bytes of the given format '''
+        if fmt == 'obj':
+            return self.target_machine().emit_object(self.module)
+        elif fmt == 'asm':
+            return self.target_machine().emit_assembly(self.module).encode()
+        elif fmt == 'bc':
+            return self.module.as_bitcode()
+        else:
+            msg = 'Undefined output format: {}'.format(fmt)
+            raise PCLCodegenError(msg)
+
+    def generate_outputs(self, filename, llc_to_stdout=False, fmt='obj'):
+        '''
+            Writes the IR (.imm) and the emitted module. Objects are linked
+            to an executable (.out), which is the only external step.
+        '''
+        if llc_to_stdout:
+            sys.stdout.buffer.write(self.emit(fmt))
+            sys.stdout.flush()
+            return
+
         llvm_filename = filename + '.imm'
         with open(llvm_filename, 'w+') as f:
             f.write(str(self.module))
-        if llc_to_stdout:
-            os.system('llc -o - -filetype=obj {}'.format(llvm_filename))
-            os.remove(llvm_filename)
-        else:
-            obj_filename = filename + '.o'
-            output_filename = filename + '.out'
 
-            os.system(
-                'llc -filetype=obj {} -o {}'.format(llvm_filename, obj_filename))
-            os.system(
-                'gcc {} -Wall -lbuiltins -lm -o {}'.format(obj_filename, output_filename))
+        output_filename = filename + self.emit_formats.get(fmt, '')
+        with open(output_filename, 'wb') as f:
+            f.write(self.emit(fmt))
+
+        if fmt == 'obj':
+            linked = run(['gcc', output_filename, '-Wall'] + self.libs +
+                         ['-o', filename + '.out'])
+            if linked.returncode == 0:
+                return
+            msg = 'Linking {} failed'.format(output_filename)
+            if self.builtins:
+                # new, dispose, parallel loops and the bounds checks
+                # of heap arrays need libbuiltins.so
+                msg += ', it calls {} of lib{}.so (make compiler_builtins ' \
+                       'installs it)'.format(', '.join(self.builtins),
+                                             self.builtins_library)
+            raise PCLCodegenError(msg)
@@ -0,0 +1,236 @@
+from collections import namedtuple, defaultdict
+from pcl.ast import *
+
+# Side effects of a procedure, including the ones of its callees.
+#   reads / writes: kinds of memory read / written. 'global' (variables of
+#       the main program and static locals), 'arg' (by-reference parameters and free
+#       variables), 'heap' (through pointers, thus any memory) and 'io'
+#       (input / output, the allocator and failing bounds checks)
+#   recursive: True if the procedure may call itself
+#   terminates: True if the procedure surely returns (no loops, gotos,
+#       recursion or input / output)
+Effects = namedtuple('Effects', ['reads', 'writes', 'recursive', 'terminates'])
+
+
+class EffectAnalyzer:
+    '''
+        Interprocedural effect analysis. Runs between closure and codegen
+        and annotates every procedure with its Effects, from which codegen
+        infers the attributes of the function and of its call sites
+        (readnone, readonly, argmemonly, norecurse, willreturn).
+
+        The locals of a procedure are private to its activation, thus
+        accessing them is not an effect, unless codegen keeps them in
+        static storage (see static_locals). A by-reference argument (or a
+        free variable) of a callee is memory of the kind of the actual
+        parameter at the caller.
+    '''
+
+    io_builtins = {'writeInteger', 'writeBoolean', 'writeChar', 'writeReal',
+                   'writeString', 'readInteger', 'readBoolean', 'readChar',
+                   'readReal', 'readString'}
+
+    def __init__(self, program):
+        self.program = program
+
+        # Stack of scopes, each maps a name to (declaring node, owner)
+        self.scopes = deque([])
+
+        self.headers = []
+
+        # Memory read and written by the body of each procedure itself
+        self.reads = defaultdict(set)
+        self.writes = defaultdict(set)
+
+        # Calls of each procedure: (callee, kinds of the memory passed
+        # to the callee by reference)
+        self.calls = defaultdict(list)
+
+        # Calls to procedures declared forward (resolved after the walk)
+        self.call_sites = []
+
+        # Procedures whose body contains loops or gotos
+        self.loops = set()
+
+        # Locals of each procedure that are not on its frame
+        self.static = {}
+
+    def run(self):
+        self.scopes.append({})
+        self.visit_body(self.program.body, self.program)
+        self.scopes.pop()
+
+        for owner, forward, kinds in self.call_sites:
+            if forward.definition is not None:
+                self.add_call(owner, forward.definition, kinds)
+
+        reads = {header: set(self.reads[header]) for header in self.headers}
+        writes = {header: set(self.writes[header]) for header in self.headers}
+        changed = True
+        while changed:
+            changed = False
+            for header in self.headers:
+                for callee, kinds in self.calls[header]:
+                    for effects in [reads, writes]:
+                        new = effects[callee] - {'arg'}
+                        if 'arg' in effects[callee]:
+                            new |= kinds
+                        if not new <= effects[header]:
+                            effects[header] |= new
+                            changed = True
+
+        for header in self.headers:
+            recursive = header in self.reachable(header)
+            terminates = not recursive and not any(
+                'io' in writes[node] or node in self.loops
+                for node in self.reachable(header) | {header})
+            header.effects = Effects(
+                frozenset(reads[header]), frozenset(writes[header]),
+                recursive, terminates)
+
+    def reachable(self, header):
+        ''' Procedures called by header, directly or indirectly '''
+        seen, stack = set(), [header]
+        while stack:
+            for callee, _ in self.calls[stack.pop()]:
+                if callee not in seen:
+                    seen.add(callee)
+                    stack.append(callee)
+        return seen
+
+    def declare(self, name, node, owner):
+        scope = self.scopes[-1]
+        previous = scope.get(name, None)
+        if previous and isinstance(
+                previous[0], Forward) and isinstance(node, LocalHeader):
+            previous[0].definition = node
+        scope[name] = (node, owner)
+
+    def resolve(self, name):
+        for scope in reversed(self.scopes):
+            if name in scope:
+                return scope[name]
+        return None, None
+
+    def kind(self, lvalue, owner):
+        '''
+            Kind of the memory of lvalue in the body of owner, None for
+            the locals of owner (and constants)
+        '''
+        while isinstance(lvalue, LBrack):
+            lvalue = lvalue.lvalue
+        if isinstance(lvalue, Deref):
+            return 'heap'
+        elif not isinstance(lvalue, NameLValue) or isinstance(lvalue, Result):
+            return None
+
+        decl, decl_owner = self.resolve(lvalue.id_)
+        if not isinstance(decl, (Var, Formal)):
+            return None
+        elif decl_owner is owner:
+            if isinstance(decl, Formal) and decl.by_reference:
+                return 'arg'
+            elif lvalue.id_ in self.static[owner]:
+                return 'global'
+            return None
+        elif decl_owner is self.program or owner.free is None:
+            # Free variables are static unless closure conversion ran
+            return 'global'
+        return 'arg'
+
+    def visit_body(self, body, owner):
+        for local in body.locals_:
+            if isinstance(local, VarList):
+                for var in local.vars_:
+                    for id_ in var.ids:
+                        self.declare(id_, var, owner)
+            elif isinstance(local, (Forward, LocalHeader)):
+                self.declare(local.header.id_, local, owner)
+                if isinstance(local, LocalHeader):
+                    self.visit_header(local)
+
+        if owner is self.program:
+            return
+
+        reads, writes = self.reads[owner], self.writes[owner]
+        for node in body.block.walk():
+            if isinstance(node, (NameLValue, Deref)):
+                reads.add(self.kind(node, owner))
+            elif isinstance(node, LBrack) and node.check:
+                # A failing bounds check prints and exits
+                writes.add('io')
+            elif isinstance(node, (While, Goto)):
+                self.loops.add(owner)
+
+            if isinstance(node, SetExpression):
+                writes.add(self.kind(node.lvalue, owner))
+            elif isinstance(node, (New, Dispose)):
+                writes.add(self.kind(node.lvalue, owner))
+                reads.add('io')
+                writes.add('io')
+            elif isinstance(node, Call):
+                self.visit_call(node, owner)
+
+        reads.discard(None)
+        writes.discard(None)
+
+    def visit_call(self, call, owner):
+        decl, _ = self.resolve(call.id_)
+        if isinstance(decl, (LocalHeader, Forward)):
+            formals = [formal for formal in decl.header.formals
+                       for _ in formal.ids]
+            kinds = {self.kind(expr, owner)
+                     for expr, formal in zip(call.exprs, formals)
+                     if formal.by_reference}
+            if isinstance(decl, Forward):
+                self.call_sites.append((owner, decl, kinds))
+            else:
+                self.add_call(owner, decl, kinds)
+        elif decl is None and call.id_ in self.io_builtins:
+            self.reads[owner].add('io')
+            self.writes[owner].add('io')
+            if call.id_ == 'readString':
+                self.writes[owner].add(self.kind(call.exprs[1], owner))
+
+    def add_call(self, owner, callee, kinds):
+        ''' The free variables of callee are passed by reference too '''
+        kinds = set(kinds)
+        for free in callee.free or []:
+            kinds.add(None if free.owner is owner else 'arg')
+        kinds.discard(None)
+        self.calls[owner].append((callee, kinds))
+
+    @staticmethod
+    def static_locals(header):
+        '''
+            Locals of header that codegen allocates as globals, thus they
+            are shared by all its activations: the ones used by nested
+            procedures unless closure conversion ran and all of them if
+            they do not fit in the activation frame (LLVMTypeSize.MAX_FRAME)
+        '''
+        static = header.captured_ids() if header.free is None else set()
+        size = 0
+        names = set()
+        decls = [formal for formal in header.header.formals
+                 if not formal.by_reference]
+        decls += [var for local in header.body.locals_
+                  if isinstance(local, VarList) for var in local.vars_]
+        for decl in decls:
+            for id_ in decl.ids:
+                names.add(id_)
+                if id_ not in static and is_composite(decl.type_.stype):
+                    decl.type_.codegen()
+                    size += LLVMTypeSize.sizeof(decl.type_.cvalue)
+        if size > LLVMTypeSize.MAX_FRAME:
+            return names
+        return static
+
+    def visit_header(self, header):
+        self.headers.append(header)
+        self.static[header] = self.static_locals(header)
+        self.scopes.append({})
+        for formal in header.header.formals:
+            for id_ in formal.ids:
+                self.declare(id_, formal, header)
+        self.visit_body(header.body, header)
+        self.scopes.pop()
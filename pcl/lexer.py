@@ -1,12 +1,30 @@
 from sly import Lexer
+from sly.lex import Token
+from collections import namedtuple
 from pcl.error import PCLLexerError
 import re
 
+# A compiler directive, written as a comment that starts with $, e.g.
+# (*$unroll 4*) or (*$vectorize width=8*). Other compilers ignore it.
+#   name: name of the directive
+#   args: positional integer arguments
+#   options: key=value integer arguments
+#   lineno: line of the comment
+Directive = namedtuple('Directive', ['name', 'args', 'options', 'lineno'])
+
 
 def regex(s):
     return re.escape(s)
 
 
+class DirectiveToken(Token):
+    '''
+        A token preceded by directive comments, which the parser attaches
+        to the node the token starts (see PCLParser.directives)
+    '''
+    __slots__ = ('directives',)
+
+
 class PCLLexer(Lexer):
 
     # keywords
@@ -140,8 +158,44 @@ class PCLLexer(Lexer):
         else:
             self.error(t)
 
+    def tokenize(self, text, lineno=1, index=0):
+        ''' Attaches the pending directives to the next token '''
+        self.directives = []
+        for tok in super(PCLLexer, self).tokenize(text, lineno, index):
+            if self.directives:
+                directive_tok = DirectiveToken()
+                directive_tok.type, directive_tok.value = tok.type, tok.value
+                directive_tok.lineno, directive_tok.index = tok.lineno, tok.index
+                directive_tok.directives = self.directives
+                self.directives = []
+                tok = directive_tok
+            yield tok
+
+    @staticmethod
+    def directive(comment, lineno):
+        '''
+            The Directive of comment, None if it is a plain comment or
+            not well formed (it is ignored as any other comment)
+        '''
+        m = re.fullmatch(r'(?s)\(\*\$([^\W\d]\w*)(.*)\*\)', comment)
+        if not m:
+            return None
+        args, options = [], {}
+        for word in m.group(2).split():
+            key, _, value = word.rpartition('=')
+            if not re.fullmatch(r'[0-9]+', value):
+                return None
+            if key:
+                options[key] = int(value)
+            else:
+                args.append(int(value))
+        return Directive(m.group(1), tuple(args), options, lineno)
+
     # Increase line counts upon newlines and comments
     def ignore_comment(self, t):
+        directive = self.directive(t.value, self.lineno)
+        if directive:
+            self.directives.append(directive)
         self.lineno += t.value.count('\n')
 
     def ignore_newline(self, t):
@@ -0,0 +1,187 @@
+from collections import namedtuple, deque
+from pcl.ast import *
+from pcl.bounds import BoundsAnalyzer
+
+# A counted while loop (see LoopAnalyzer).
+#   id_: name of the induction variable
+#   bound: the loop runs while id_ < bound (id_ <= bound if inclusive)
+#   inclusive: True for a condition id_ <= bound
+#   trips: number of iterations if it is a constant, else None
+CountedLoop = namedtuple('CountedLoop', ['id_', 'bound', 'inclusive', 'trips'])
+
+
+class LoopAnalyzer:
+    '''
+        Recognizes the counted loops
+
+            i := a;
+            while i < b do
+            begin
+                ...;
+                i := i + 1
+            end
+
+        (or i <= b) and annotates them with a CountedLoop, thus codegen
+        emits them in the canonical form of the LLVM loop passes (see
+        While.codegen_counted). Runs between the parallel analysis and
+        codegen. A loop is counted if:
+
+            1. i is an integer local that is only assigned by the
+            increment at the end of the body.
+            2. The bound b has no side effects and its variables are
+            integer locals that the body does not assign.
+            3. The body has no labels.
+
+        i and the variables of b must also be modified by name only:
+        they are not used by nested procedures, their address is not
+        taken and they are not passed to var parameters (anywhere in
+        the procedure, as a pointer or a call before the loop may let
+        the body modify them).
+    '''
+
+    def __init__(self, program):
+        self.program = program
+
+        # Stack of scopes, each maps a name to (declaring node, owner)
+        self.scopes = deque([])
+
+    def run(self):
+        self.visit_body(self.program.body, self.program, [])
+
+    def resolve(self, name):
+        for scope in reversed(self.scopes):
+            if name in scope:
+                return scope[name]
+        return None, None
+
+    def visit_body(self, body, owner, formals):
+        scope = {}
+        for formal in formals:
+            for id_ in formal.ids:
+                scope[id_] = (formal, owner)
+        for local in body.locals_:
+            if isinstance(local, VarList):
+                for var in local.vars_:
+                    for id_ in var.ids:
+                        scope[id_] = (var, owner)
+            elif isinstance(local, (Forward, LocalHeader)):
+                scope[local.header.id_] = (local, owner)
+
+        self.scopes.append(scope)
+        for local in body.locals_:
+            if isinstance(local, LocalHeader):
+                self.visit_body(local.body, local, local.header.formals)
+
+        # Names whose address is taken or that are passed to var
+        # parameters (they may change through pointers)
+        escaped = set()
+        for node in body.block.walk():
+            if isinstance(node, AddressOf) and \
+                    isinstance(node.lvalue, NameLValue):
+                escaped.add(node.lvalue.id_)
+            elif isinstance(node, Call):
+                escaped |= self.by_reference(node)
+        # The statement before each loop, which may set its start
+        previous = {}
+        for node in body.block.walk():
+            if isinstance(node, Block):
+                stmts = list(node.stmt_list)
+                for stmt, loop in zip(stmts, stmts[1:]):
+                    previous[id(loop)] = stmt
+        for node in body.block.walk():
+            if isinstance(node, While) and node.parallel is None:
+                node.counted = self.analyze(
+                    node, owner, escaped, previous.get(id(node), None))
+        self.scopes.pop()
+
+    def analyze(self, loop, owner, escaped, previous):
+        ''' The CountedLoop of loop, None if it is not counted '''
+        cond = loop.expr
+        if not isinstance(cond, CompOp) or cond.op not in ['<', '<='] or \
+                not isinstance(cond.lhs, NameLValue):
+            return None
+        id_ = cond.lhs.id_
+
+        stmts = BoundsAnalyzer.statements(loop.stmt)
+        last = stmts[-1]
+        if not isinstance(last, SetExpression) or \
+                not isinstance(last.lvalue, NameLValue) or \
+                last.lvalue.id_ != id_ or \
+                BoundsAnalyzer.linear(last.expr, id_) != 1:
+            return None
+
+        bound = cond.rhs
+        names = {node.id_ for node in bound.walk() if isinstance(node, NameLValue)}
+        if not bound.side_effect_free() or id_ in names or \
+                bound.stype != (ComposerType.T_NO_COMP, BaseType.T_INT):
+            return None
+        for name in names | {id_}:
+            if not self.is_local(name, owner) or name in escaped:
+                return None
+
+        for node in loop.stmt.walk():
+            if type(node) is Statement and node.name:
+                return None
+            elif isinstance(node, SetExpression) and node is not last and \
+                    isinstance(node.lvalue, NameLValue) and \
+                    node.lvalue.id_ in names | {id_}:
+                return None
+
+        # Constant start and bound
+        trips = None
+        start = None
+        if isinstance(previous, SetExpression) and \
+                isinstance(previous.lvalue, NameLValue) and \
+                previous.lvalue.id_ == id_:
+            start = BoundsAnalyzer.const(previous.expr, {})
+        end = BoundsAnalyzer.const(bound, {})
+        if start is not None and end is not None:
+            if cond.op == '<=':
+                end += 1
+            trips = max(end - start, 0)
+        return CountedLoop(id_, bound, cond.op == '<=', trips)
+
+    def is_local(self, name, owner):
+        '''
+            True if name is an integer local of owner that the
+            procedures nested in owner do not use
+        '''
+        decl, decl_owner = self.resolve(name)
+        if decl_owner is not owner:
+            return False
+        if isinstance(decl, Formal) and decl.by_reference:
+            return False
+        if not isinstance(decl, (Var, Formal)) or \
+                decl.type_.stype != (ComposerType.T_NO_COMP, BaseType.T_INT):
+            return False
+        if owner is self.program and self.program.captured is not None:
+            return name not in self.program.captured
+        return name not in self.captured(owner)
+
+    @staticmethod
+    def captured(owner):
+        ''' Names used by the procedures nested in owner '''
+        return {node.id_ for local in owner.body.locals_
+                if isinstance(local, LocalHeader)
+                for node in local.walk() if isinstance(node, NameLValue)}
+
+    def by_reference(self, call):
+        '''
+            Names passed by call to parameters that may be var
+            parameters (all of them if the callee is unknown)
+        '''
+        decl, _ = self.resolve(call.id_)
+        if decl is None:
+            # Builtins take scalars by value
+            return set()
+        if isinstance(decl, Forward):
+            decl = decl.definition
+        flags = None
+        if isinstance(decl, LocalHeader):
+            flags = [formal.by_reference for formal in decl.header.formals
+                     for _ in formal.ids]
+        names = set()
+        for k, expr in enumerate(call.exprs):
+            if isinstance(expr, NameLValue) and (flags is None or flags[k]):
+                names.add(expr.id_)
+        return names
@@ -0,0 +1,263 @@
+from collections import namedtuple, deque
+from pcl.ast import *
+from pcl.bounds import BoundsAnalyzer
+
+# A while loop whose iterations run in parallel (see ParallelAnalyzer).
+#   id_: name of the induction variable
+#   bound: the loop runs while id_ < bound (id_ <= bound if inclusive)
+#   inclusive: True for a condition id_ <= bound
+#   private: names of the scalars that every iteration assigns before
+#       using them, thus each thread has its own copy
+#   chunk: iterations taken at a time by each thread (dynamic scheduling),
+#       0 to split the range evenly among the threads (static scheduling)
+ParallelLoop = namedtuple(
+    'ParallelLoop', ['id_', 'bound', 'inclusive', 'private', 'chunk'])
+
+
+class ParallelAnalyzer:
+    '''
+        Dependence analysis of the loops marked with (*$parallel*). Runs
+        between the effect analysis and codegen. A loop
+
+            i := a;
+            (*$parallel*)
+            while i < b do
+            begin
+                ...;
+                i := i + 1
+            end
+
+        is annotated with a ParallelLoop if its iterations are independent,
+        in which case codegen outlines the body to a function that the
+        runtime runs on a pool of threads. Otherwise the program is rejected.
+        The iterations are independent if:
+
+            1. The induction variable is a local scalar that is only
+            assigned by the increment at the end of the body and the bound
+            is not modified by the body.
+            2. Every other scalar that the body assigns is a local that
+            is assigned before it is used (it is made private).
+            3. The arrays that the body writes are variables (and not
+            packed boolean arrays) and every access to them (or to arrays
+            that they may alias) has the same first index i + k. Other
+            arrays are only read.
+            4. The body does not write through pointers, allocate, jump or
+            return, and it only calls procedures that neither read nor write
+            memory other than their locals, and builtins without side effects.
+    '''
+
+    def __init__(self, program):
+        self.program = program
+
+        # Stack of scopes, each maps a name to (declaring node, owner)
+        self.scopes = deque([])
+
+    def run(self):
+        self.visit_body(self.program.body, self.program, [])
+
+    def resolve(self, name):
+        for scope in reversed(self.scopes):
+            if name in scope:
+                return scope[name]
+        return None, None
+
+    def visit_body(self, body, owner, formals):
+        scope = {}
+        for formal in formals:
+            for id_ in formal.ids:
+                scope[id_] = (formal, owner)
+        for local in body.locals_:
+            if isinstance(local, VarList):
+                for var in local.vars_:
+                    for id_ in var.ids:
+                        scope[id_] = (var, owner)
+            elif isinstance(local, (Forward, LocalHeader)):
+                scope[local.header.id_] = (local, owner)
+
+        self.scopes.append(scope)
+        for local in body.locals_:
+            if isinstance(local, LocalHeader):
+                self.visit_body(local.body, local, local.header.formals)
+        for node in body.block.walk():
+            if isinstance(node, While) and any(
+                    d.name == 'parallel' for d in node.directives):
+                node.parallel = self.analyze(node, owner)
+        self.scopes.pop()
+
+    def reject(self, loop, msg):
+        loop.raise_exception_helper('Cannot run in parallel: ' + msg, PCLSemError)
+
+    def analyze(self, loop, owner):
+        cond = loop.expr
+        if not isinstance(cond, CompOp) or cond.op not in ['<', '<='] or \
+                not isinstance(cond.lhs, NameLValue) or \
+                not self.is_private(cond.lhs.id_, owner) or \
+                cond.lhs.stype != (ComposerType.T_NO_COMP, BaseType.T_INT):
+            self.reject(loop, 'the condition is not i < e or i <= e '
+                        'with i a local integer variable')
+        id_ = cond.lhs.id_
+
+        stmts = BoundsAnalyzer.statements(loop.stmt)
+        last = stmts[-1]
+        if not isinstance(last, SetExpression) or \
+                not isinstance(last.lvalue, NameLValue) or \
+                last.lvalue.id_ != id_ or \
+                BoundsAnalyzer.linear(last.expr, id_) != 1:
+            self.reject(loop, 'the body does not end with {0} := {0} + 1'.format(id_))
+        stmts = stmts[:-1]
+
+        for node in loop.stmt.walk():
+            if isinstance(node, (Goto, Return, New, Dispose)) or (
+                    type(node) is Statement and node.name):
+                self.reject(loop, 'the body jumps, returns or allocates')
+            elif isinstance(node, Call):
+                self.check_call(loop, node, owner)
+
+        # Scalars assigned by the body
+        written = set()
+        for node in loop.stmt.walk():
+            if isinstance(node, SetExpression) and node is not last:
+                lvalue = node.lvalue
+                if isinstance(lvalue, NameLValue):
+                    if lvalue.id_ == id_:
+                        self.reject(loop, '{} is assigned in the body'.format(id_))
+                    written.add(lvalue.id_)
+        private = set()
+        for name in written:
+            if not self.is_private(name, owner) or \
+                    not self.assigned_first(name, stmts):
+                self.reject(loop, '{} carries a dependency between '
+                            'iterations'.format(name))
+            private.add(name)
+
+        bound = cond.rhs
+        names = {node.id_ for node in bound.walk() if isinstance(node, NameLValue)}
+        if not bound.side_effect_free() or names & (private | {id_}) or \
+                bound.stype != (ComposerType.T_NO_COMP, BaseType.T_INT):
+            self.reject(loop, 'the bound is not invariant')
+
+        self.check_arrays(loop, id_, owner)
+
+        chunk = 0
+        for directive in loop.directives:
+            if directive.name == 'parallel':
+                chunk = LLVMDirectives.value(directive, LLVMDirectives.loop) or 0
+        return ParallelLoop(id_, bound, cond.op == '<=', private, chunk)
+
+    def is_private(self, name, owner):
+        '''
+            True if name is a scalar local of owner that is only
+            accessed by name, thus it can be made private to a thread
+        '''
+        decl, decl_owner = self.resolve(name)
+        if decl_owner is not owner:
+            return False
+        if isinstance(decl, Formal) and decl.by_reference:
+            return False
+        if not isinstance(decl, (Var, Formal)) or \
+                decl.type_.stype[0] != ComposerType.T_NO_COMP:
+            return False
+        # Variables of the main program used by procedures are
+        # globals, which the procedures do not access by name
+        return owner is not self.program or \
+            name not in (self.program.captured or set())
+
+    @staticmethod
+    def assigned_first(name, stmts):
+        ''' True if the first statement of stmts that refers to name assigns it '''
+        for stmt in stmts:
+            names = {node.id_ for node in stmt.walk()
+                     if isinstance(node, NameLValue)}
+            if name not in names:
+                continue
+            if not isinstance(stmt, SetExpression) or \
+                    not isinstance(stmt.lvalue, NameLValue) or \
+                    stmt.lvalue.id_ != name:
+                return False
+            return name not in {node.id_ for node in stmt.expr.walk()
+                                if isinstance(node, NameLValue)}
+        return False
+
+    def check_call(self, loop, call, owner):
+        decl, _ = self.resolve(call.id_)
+        if isinstance(decl, Forward):
+            decl = decl.definition
+        if isinstance(decl, LocalHeader):
+            effects = decl.effects
+            if decl.free is None or effects is None or \
+                    effects.reads or effects.writes:
+                self.reject(loop, '{} may access shared memory'.format(call.id_))
+        elif decl is not None or call.id_ not in LLVMAttributes.pure_builtins:
+            self.reject(loop, '{} has side effects'.format(call.id_))
+
+    def base(self, lvalue):
+        ''' The variable of lvalue and the first index into it '''
+        index = None
+        while isinstance(lvalue, LBrack):
+            index = lvalue.expr
+            lvalue = lvalue.lvalue
+        return lvalue, index
+
+    def may_alias(self, lvalue, other, owner):
+        ''' False if lvalue and other are surely different variables '''
+        if not isinstance(lvalue, NameLValue) or not isinstance(other, NameLValue):
+            return True
+        if lvalue.id_ == other.id_:
+            return True
+        decls = [self.resolve(lvalue.id_), self.resolve(other.id_)]
+        for (decl, _), (other_decl, other_owner) in [decls, decls[::-1]]:
+            # The locals of owner are created after the arguments are bound
+            if isinstance(decl, Formal) and decl.by_reference and not (
+                    isinstance(other_decl, Var) and other_owner is owner):
+                return True
+        return False
+
+    def check_arrays(self, loop, id_, owner):
+        # First index of the writes of each array
+        offsets = {}
+        writes = []
+        for node in loop.stmt.walk():
+            if not isinstance(node, SetExpression) or \
+                    not isinstance(node.lvalue, (LBrack, Deref)):
+                continue
+            base, index = self.base(node.lvalue)
+            if not isinstance(base, NameLValue):
+                self.reject(loop, 'the body writes through a pointer')
+            if self.program.builder.packed_booleans and \
+                    node.lvalue.stype == (ComposerType.T_NO_COMP, BaseType.T_BOOL):
+                # Neighbouring iterations share the words of the array
+                self.reject(loop, 'the body writes a packed boolean array')
+            offset = None if index is None else BoundsAnalyzer.linear(index, id_)
+            if offset is None or offsets.get(base.id_, offset) != offset:
+                self.reject(loop, 'the array writes are not indexed by '
+                            '{} + k with the same k'.format(id_))
+            offsets[base.id_] = offset
+            writes.append(base)
+
+        if not writes:
+            return
+
+        # Every access that may alias a write has its index. Arrays
+        # and pointers that are not indexed are accessed as a whole
+        accesses = []
+        indexed = set()
+        for node in loop.stmt.walk():
+            if isinstance(node, LBrack) and not isinstance(node.lvalue, LBrack):
+                accesses.append((node.lvalue, node.expr))
+                indexed.add(id(node.lvalue))
+        for node in loop.stmt.walk():
+            if id(node) in indexed:
+                continue
+            if isinstance(node, Deref) or (
+                    isinstance(node, NameLValue) and node.stype[0] in [
+                        ComposerType.T_CONST_ARRAY, ComposerType.T_VAR_ARRAY]):
+                accesses.append((node, None))
+
+        for base in writes:
+            offset = offsets[base.id_]
+            for other, index in accesses:
+                if other is base or not self.may_alias(base, other, owner):
+                    continue
+                if index is None or BoundsAnalyzer.linear(index, id_) != offset:
+                    self.reject(loop, '{} may be accessed by other '
+                                'iterations'.format(base.id_))
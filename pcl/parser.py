@@ -60,6 +60,10 @@ class PCLParser(Parser):
         except AttributeError:
             return -1
 
+    def get_directives(self, p):
+        ''' Directives that precede the first token of p (see PCLLexer) '''
+        return list(getattr(p._slice[0], 'directives', []))
+
     @_('PROGRAM NAME SEMICOLON body COLON')
     def program(self, p):
         return Program(
@@ -159,6 +163,7 @@ class PCLParser(Parser):
             header_type=p[0],
             id_=p.NAME,
             formals=p.formal_list,
+            directives=self.get_directives(p),
             func_type=None,
             builder=self.builder,
             module=self.module,
@@ -172,6 +177,7 @@ class PCLParser(Parser):
             id_=p.NAME,
             formals=deque(
                 []),
+            directives=self.get_directives(p),
             func_type=None,
             builder=self.builder,
             module=self.module,
@@ -184,6 +190,7 @@ class PCLParser(Parser):
             header_type=p[0],
             id_=p.NAME,
             formals=p.formal_list,
+            directives=self.get_directives(p),
             func_type=p.vartype,
             builder=self.builder,
             module=self.module,
@@ -197,6 +204,7 @@ class PCLParser(Parser):
             id_=p.NAME,
             formals=deque(
                 []),
+            directives=self.get_directives(p),
             func_type=p.vartype,
             builder=self.builder,
             module=self.module,
@@ -371,6 +379,7 @@ class PCLParser(Parser):
         return While(
             expr=p.expr,
             stmt=p.stmt,
+            directives=self.get_directives(p),
             builder=self.builder,
             module=self.module,
             symbol_table=self.symbol_table,
@@ -0,0 +1,209 @@
+from llvmlite import ir
+
+# Types of the runtime (same as the typedefs of builtins.h)
+integer = ir.IntType(32)
+real = ir.DoubleType()
+boolean = ir.IntType(1)
+character = ir.IntType(8)
+string = ir.ArrayType(character, 0).as_pointer()
+cstring = character.as_pointer()
+
+
+class PCLRuntime:
+    '''
+        The builtins of PCL as an LLVM module, their only definition. It
+        is linked into every program before optimization, thus the
+        optimizer can inline the builtins and strip the ones that are not
+        used. The builtins are defined as linkonce_odr so that they do not
+        clash with the ones of libbuiltins.so, which is built from the
+        same module (see library).
+
+        Only the allocator (pcl_new / pcl_dispose) and the thread pool of
+        parallel loops (pcl_parallel_for) are native (pcl/builtins.c, which
+        explains why) and programs that use them link libbuiltins.so.
+    '''
+
+    def __init__(self, triple=''):
+        self.module = ir.Module(name='pcl_runtime')
+        self.module.triple = triple
+        self.formats = {}
+
+        # libc / libm
+        self.printf = self.declare('printf', integer, [cstring], var_arg=True)
+        self.scanf = self.declare('scanf', integer, [cstring], var_arg=True)
+        self.getchar = self.declare('getchar', integer, [])
+        self.log = self.declare('log', real, [real])
+        self.atan = self.declare('atan', real, [real])
+        self.trunc = self.declare('trunc', real, [real])
+        self.round = self.declare('round', real, [real])
+        self.fflush = self.declare('fflush', integer, [cstring])
+        self.dprintf = self.declare(
+            'dprintf', integer, [integer, cstring], var_arg=True)
+        self.exit = self.declare('exit', ir.VoidType(), [integer])
+
+        self.write_builtins()
+        self.read_builtins()
+        self.math_builtins()
+        self.bounds_builtins()
+
+    def declare(self, name, ret_type, arg_types, var_arg=False):
+        fn_type = ir.FunctionType(ret_type, arg_types, var_arg=var_arg)
+        return ir.Function(self.module, fn_type, name=name)
+
+    def define(self, name, ret_type, arg_types):
+        '''
+            Defines builtin name and returns a builder
+            positioned at its entry block
+        '''
+        fn = self.declare(name, ret_type, arg_types)
+        fn.linkage = 'linkonce_odr'
+        return ir.IRBuilder(fn.append_basic_block(name='entry'))
+
+    def format(self, builder, fmt):
+        ''' Pointer to the (pooled) format string fmt '''
+        if fmt not in self.formats:
+            value = bytearray(fmt.encode('ascii') + b'\0')
+            const = ir.Constant(ir.ArrayType(character, len(value)), value)
+            global_ = ir.GlobalVariable(
+                self.module, const.type, name='.fmt.{}'.format(len(self.formats)))
+            global_.linkage = 'private'
+            global_.global_constant = True
+            global_.unnamed_addr = True
+            global_.initializer = const
+            self.formats[fmt] = global_
+        return builder.bitcast(self.formats[fmt], cstring)
+
+    def write_builtins(self):
+        ''' Write procedures return a null i8* (see builtins.h) '''
+        null = ir.Constant(cstring, None)
+
+        for name, type_, fmt in [('writeInteger', integer, '%d'),
+                                 ('writeChar', character, '%c'),
+                                 ('writeReal', real, '%f')]:
+            builder = self.define(name, cstring, [type_])
+            x = builder.function.args[0]
+            if type_ == character:
+                x = builder.sext(x, integer)
+            builder.call(self.printf, [self.format(builder, fmt), x])
+            builder.ret(null)
+
+        builder = self.define('writeBoolean', cstring, [boolean])
+        b = builder.function.args[0]
+        s = builder.select(b, self.format(builder, 'true'),
+                           self.format(builder, 'false'))
+        builder.call(self.printf, [s])
+        builder.ret(null)
+
+        builder = self.define('writeString', cstring, [string])
+        s = builder.bitcast(builder.function.args[0], cstring)
+        builder.call(self.printf, [self.format(builder, '%s'), s])
+        builder.ret(null)
+
+    def read_builtins(self):
+        builder = self.define('readInteger', integer, [])
+        n = builder.alloca(integer)
+        builder.call(self.scanf, [self.format(builder, '%d'), n])
+        builder.ret(builder.load(n))
+
+        builder = self.define('readBoolean', boolean, [])
+        n = builder.alloca(integer)
+        builder.call(self.scanf, [self.format(builder, '%d'), n])
+        builder.ret(builder.trunc(builder.load(n), boolean))
+
+        builder = self.define('readChar', character, [])
+        builder.ret(builder.trunc(builder.call(self.getchar, []), character))
+
+        builder = self.define('readReal', real, [])
+        n = builder.alloca(ir.FloatType())
+        builder.call(self.scanf, [self.format(builder, '%f'), n])
+        builder.ret(builder.fpext(builder.load(n), real))
+
+        self.read_string()
+
+    def read_string(self):
+        '''
+            readString(size, s) reads characters into s until EOF or a
+            newline, at most size - 1 of them, and terminates s with a null
+            character. The first character is always stored.
+        '''
+        builder = self.define('readString', cstring, [integer, string])
+        size, s = builder.function.args
+        s = builder.bitcast(s, cstring)
+        null = ir.Constant(cstring, None)
+        one = ir.Constant(integer, 1)
+
+        with builder.if_then(builder.icmp_signed('<=', size, one)):
+            builder.ret(null)
+
+        size = builder.sub(size, one)
+        first = builder.trunc(builder.call(self.getchar, []), character)
+        entry = builder.block
+        loop = builder.append_basic_block('loop')
+        end = builder.append_basic_block('end')
+        builder.branch(loop)
+
+        builder.position_at_end(loop)
+        i = builder.phi(integer)
+        c = builder.phi(character)
+        i.add_incoming(ir.Constant(integer, 0), entry)
+        c.add_incoming(first, entry)
+        builder.store(c, builder.gep(s, [i]))
+        next_i = builder.add(i, one)
+        next_c = builder.trunc(builder.call(self.getchar, []), character)
+        i.add_incoming(next_i, loop)
+        c.add_incoming(next_c, loop)
+        stop = builder.or_(
+            builder.icmp_signed('==', next_c, ir.Constant(character, -1)),
+            builder.icmp_signed('==', next_c, ir.Constant(character, ord('\n'))))
+        stop = builder.or_(stop, builder.icmp_signed('>=', next_i, size))
+        builder.cbranch(stop, end, loop)
+
+        builder.position_at_end(end)
+        builder.store(ir.Constant(character, 0), builder.gep(s, [next_i]))
+        builder.ret(null)
+
+    def math_builtins(self):
+        for name, fn in [('ln', self.log), ('arctan', self.atan)]:
+            builder = self.define(name, real, [real])
+            builder.ret(builder.call(fn, builder.function.args))
+
+        builder = self.define('pi', real, [])
+        builder.ret(ir.Constant(real, 3.141592653589793))
+
+        for name, fn in [('trunc2', self.trunc), ('round2', self.round)]:
+            builder = self.define(name, integer, [real])
+            x = builder.call(fn, builder.function.args)
+            builder.ret(builder.fptosi(x, integer))
+
+        builder = self.define('chr', character, [integer])
+        builder.ret(builder.trunc(builder.function.args[0], character))
+
+        builder = self.define('ord', integer, [character])
+        builder.ret(builder.zext(builder.function.args[0], integer))
+
+    def bounds_builtins(self):
+        ''' Failure of a bounds check (--bounds-check) '''
+        builder = self.define(
+            'pcl_bounds_error', ir.VoidType(), [integer, integer, ir.IntType(64)])
+        builder.function.attributes.add('noreturn')
+        builder.function.attributes.add('cold')
+        line, index, length = builder.function.args
+        builder.call(self.fflush, [ir.Constant(cstring, None)])
+        fmt = self.format(builder, 'line %d: index %d out of bounds [0, %ld)\n')
+        builder.call(self.dprintf, [ir.Constant(integer, 2), fmt, line, index, length])
+        builder.call(self.exit, [ir.Constant(integer, 1)])
+        builder.unreachable()
+
+    def library(self):
+        '''
+            The module with external definitions of the builtins, which
+            the Makefile compiles into libbuiltins.so for programs linked
+            without pclc.py
+        '''
+        for fn in self.module.functions:
+            if not fn.is_declaration:
+                fn.linkage = ''
+        return str(self.module)
+
+    def __str__(self):
+        return str(self.module)
@@ -3,7 +3,7 @@ from itertools import product
 from llvmlite import ir
 from collections import deque, defaultdict, OrderedDict
 from pcl.error import PCLSymbolTableError
-from pcl.codegen import LLVMTypes
+from pcl.codegen import LLVMTypes, LLVMAttributes
 
 
 class BaseType(Enum):
@@ -67,9 +67,12 @@ class NameType(Enum):
 
 
 class SymbolEntry:
-    def __init__(self, stype, name_type, cvalue=None, by_reference=False):
+    def __init__(self, stype, name_type, cvalue=None, by_reference=False,
+                 type_=None):
         self.stype = stype
         self.name_type = name_type
+        # Declared Type of the name (the lengths of its arrays), if known
+        self.type_ = type_
         self.offset = None
         self.num_queries = 0
         self.cvalue = cvalue
@@ -220,6 +223,13 @@ class Scope:
         self.locals_ = {}
         self.globals = {}
         self.name = name
+        # Names of the scope that must be kept static.
+        # None if the scope has no activation frame.
+        self.captured = None
+        # LocalHeader that opened the scope
+        self.header = None
+        # Free variables lifted to parameters, indexed by (name, header)
+        self.lifted = {}
 
     def lookup(self, c):
         return self.locals_.get(c, None)
@@ -271,6 +281,8 @@ class SymbolTable:
                 self.module,
                 builtin_signature_type,
                 name='{}{}'.format(builtin_name, '2' if builtin_name in ['trunc', 'round'] else ''))
+            LLVMAttributes.add(
+                builtin_fn.attributes, LLVMAttributes.builtin(builtin_name))
 
             builtin_entry.cvalue = builtin_fn
             self.insert(builtin_name, builtin_entry)
@@ -321,6 +333,35 @@ class SymbolTable:
         msg = 'Unknown name: {} at line {}'.format(c, lineno)
         raise PCLSymbolTableError(msg)
 
+    def lookup_free(self, c, header, lineno=-1):
+        '''
+            Looks up local c of procedure header from the procedure
+            header itself or from a procedure nested in it, where c
+            has been lifted to a parameter
+        '''
+        for scope in reversed(self.scopes):
+            if scope.header is header:
+                entry = scope.lookup(c)
+            else:
+                entry = scope.lifted.get((c, header), None)
+            if entry:
+                return entry
+
+        msg = 'Unknown free name: {} at line {}'.format(c, lineno)
+        raise PCLSymbolTableError(msg)
+
+    def is_builtin(self, c, entry):
+        ''' Returns True if entry is the builtin c (and not a shadowing name) '''
+        return self.scopes[0].lookup(c) is entry
+
+    def on_frame(self, c):
+        '''
+            Returns True if local c of the innermost scope can be
+            allocated on the activation frame of its procedure
+        '''
+        captured = self.scopes[-1].captured
+        return captured is not None and c not in captured
+
     def insert(self, c, t, lineno=-1):
         if len(self.scopes) == 0:
             raise PCLSymbolTableError('Scopes do not exist')
@@ -7,6 +7,11 @@ from pcl import PCLCError, PCLError
 from pcl import PCLLexer
 from pcl import PCLParser
 from pcl import PCLCodegen
+from pcl import ClosureConverter
+from pcl import BoundsAnalyzer
+from pcl import EffectAnalyzer
+from pcl import ParallelAnalyzer
+from pcl import LoopAnalyzer
 
 __version__ = '0.0.1'
 
@@ -32,8 +37,24 @@ def get_argparser():
         default='',
         type=str,
         help='Input filename')
-    argparser.add_argument('-O', default=0, type=int,
+    argparser.add_argument('-O', default='0', type=str,
+                           choices=['0', '1', '2', '3', 's', 'z'],
                            help='Optimization level')
+    argparser.add_argument(
+        '--vectorize',
+        default=None,
+        choices=['none', 'loop', 'slp', 'all'],
+        help='Vectorizers to enable (default depends on -O)')
+    argparser.add_argument(
+        '--inline-threshold',
+        default=None,
+        type=int,
+        help='Inlining threshold (default depends on -O)')
+    argparser.add_argument(
+        '--passes',
+        nargs='+',
+        default=None,
+        help='Custom pipeline of optimization passes (e.g. sroa licm gvn)')
     argparser.add_argument(
         '--pipeline',
         nargs='+',
@@ -41,16 +62,57 @@ def get_argparser():
             'lex',
             'parse',
             'sem',
+            'closure',
+            'effects',
+            'parallel',
+            'loops',
             'codegen'])
     argparser.add_argument('-W', action='store_true', help='Enable warnings')
     argparser.add_argument(
         '-f',
         action='store_true',
-        help='Input from stdin, bin output to stdout')
+        help='Input from stdin, bin output (see --emit) to stdout')
     argparser.add_argument(
         '-i',
         action='store_true',
         help='Input from stdin, IR output to stdout')
+    argparser.add_argument(
+        '-mcpu',
+        default='native',
+        type=str,
+        help='Target CPU (default: the host)')
+    argparser.add_argument(
+        '-mattr',
+        default='native',
+        type=str,
+        help='Target features, e.g. +avx2,+fma (default: the host)')
+    argparser.add_argument(
+        '-ffast-math',
+        action='store_true',
+        help='Enable all fast-math flags for real arithmetic')
+    argparser.add_argument(
+        '--fast-math-flags',
+        nargs='+',
+        default=[],
+        choices=['nnan', 'ninf', 'nsz', 'arcp', 'contract', 'afn', 'reassoc'],
+        help='Enable individual fast-math flags for real arithmetic')
+    argparser.add_argument(
+        '--packed-booleans',
+        action='store_true',
+        help='Store boolean arrays as bits of 64-bit words')
+    argparser.add_argument(
+        '--bounds-check',
+        action='store_true',
+        help='Check array indices at runtime (checks proven redundant are eliminated)')
+    argparser.add_argument(
+        '--bounds-report',
+        action='store_true',
+        help='Print a summary of the bounds checks to stderr')
+    argparser.add_argument(
+        '--emit',
+        default='obj',
+        choices=['obj', 'asm', 'bc'],
+        help='Output format (object file, assembly or bitcode)')
     argparser.add_argument(
         '-v',
         action='store_true',
@@ -100,6 +162,21 @@ class PCLCDriver:
     def sem(self):
         self.parsed.sem()
 
+    def closure(self):
+        ClosureConverter(self.parsed).run()
+
+    def bounds(self):
+        BoundsAnalyzer(self.parsed).run()
+
+    def effects(self):
+        EffectAnalyzer(self.parsed).run()
+
+    def parallel(self):
+        ParallelAnalyzer(self.parsed).run()
+
+    def loops(self):
+        LoopAnalyzer(self.parsed).run()
+
     def codegen(self):
         self.parsed.codegen()
 
@@ -110,6 +187,8 @@ class PCLCDriver:
 if __name__ == '__main__':
     argparser = get_argparser()
     args = argparser.parse_args()
+    if args.bounds_report and not args.bounds_check:
+        argparser.error('--bounds-report requires --bounds-check')
 
     if not args.debug:
         # sys.tracebacklimit = 0
@@ -139,21 +218,48 @@ if __name__ == '__main__':
         'lex': driver.lex,
         'parse': driver.parse,
         'sem': driver.sem,
+        'closure': driver.closure,
+        'bounds': driver.bounds,
+        'effects': driver.effects,
+        'parallel': driver.parallel,
+        'loops': driver.loops,
         'pprint': driver.pprint,
         'codegen': driver.codegen,
     }
 
+    driver.parser.codegen.set_target(cpu=args.mcpu, features=args.mattr)
+    driver.parser.codegen.set_fast_math(
+        ['fast'] if args.ffast_math else args.fast_math_flags)
+    driver.parser.codegen.set_packed_booleans(args.packed_booleans)
+
+    if args.bounds_check and 'codegen' in args.pipeline:
+        # Before the effect analysis (bounds checks may exit)
+        stage = 'effects' if 'effects' in args.pipeline else 'codegen'
+        args.pipeline.insert(args.pipeline.index(stage), 'bounds')
+
     for stage in args.pipeline:
         pipeline_funcs[stage]()
 
+    if args.bounds_report:
+        sys.stderr.write(driver.parser.codegen.bounds_report() + '\n')
+
     if 'codegen' == args.pipeline[-1]:
-        driver.parser.codegen.postprocess_module(level=args.O)
+        options = {
+            'inlining_threshold': args.inline_threshold,
+            'passes': args.passes,
+        }
+        if args.vectorize is not None:
+            options['loop_vectorize'] = args.vectorize in ['loop', 'all']
+            options['slp_vectorize'] = args.vectorize in ['slp', 'all']
+        driver.parser.codegen.postprocess_module(level=args.O, **options)
         name = os.path.splitext(args.filename)[0]
         if args.i:
             # IR to stdout
             print(driver.parser.codegen.module)
         elif args.f:
             # Object file to stdout
-            driver.parser.codegen.generate_outputs(name, llc_to_stdout=True)
+            driver.parser.codegen.generate_outputs(
+                name, llc_to_stdout=True, fmt=args.emit)
         else:
-            driver.parser.codegen.generate_outputs(name, llc_to_stdout=False)
+            driver.parser.codegen.generate_outputs(
+                name, llc_to_stdout=False, fmt=args.emit)
@@ -0,0 +1,137 @@
+import os
+import sys
+import subprocess
+import pytest
+from pcl import PCLParser as Parser
+from pcl import PCLLexer as Lexer
+from pcl import BoundsAnalyzer
+from pcl import LBrack, While
+from llvmlite import ir
+
+lexer = Lexer()
+
+
+def analyze(filename):
+    parser = Parser()
+    with open(filename, 'r', encoding='ascii') as f:
+        example = f.read()
+    program = parser.parse(lexer.tokenize(example))
+    program.sem()
+    BoundsAnalyzer(program).run()
+    accesses = [node for node in program.walk() if isinstance(node, LBrack)]
+    loops = [node for node in program.walk() if isinstance(node, While)]
+    return accesses, loops
+
+
+def test_bounds():
+    accesses, loops = analyze('../examples/pos/bounds.pcl')
+
+    assert all(access.check for access in accesses)
+
+    ranges = sorted((access.lineno, access.range) for access in accesses
+                    if access.range is not None)
+    assert ranges == [
+        # a[i] for i in [0, n) with n = 10
+        (7, (0, 10)), (9, (0, 10)),
+        # a[i - 1], a[i] for i in [1, n)
+        (23, (0, 9)), (23, (1, 10)),
+        # p^[4] and a[n - 1]
+        (28, (4, 5)), (28, (9, 10)),
+        (29, (4, 5)),
+    ]
+
+    # The check of a[k] runs once before the second loop
+    assert [[access.lineno for access in loop.hoisted]
+            for loop in loops] == [[], [16], []]
+
+
+def test_heap_length():
+    parser = Parser()
+    with open('../examples/pos/bounds.pcl', 'r', encoding='ascii') as f:
+        program = parser.parse(lexer.tokenize(f.read()))
+    program.sem()
+    BoundsAnalyzer(program).run()
+    program.codegen()
+
+    # p^[4] is checked against the length that new recorded
+    stats = parser.codegen.builder.bounds_stats
+    assert stats['unknown'] == 0
+    assert stats['hoisted'] == 1
+    calls = [instr for block in parser.codegen.module.get_global('main').blocks
+             for instr in block.instructions if isinstance(instr, ir.CallInstr)
+             and instr.callee.name == 'pcl_heap_length']
+    assert len(calls) == 2
+
+
+@pytest.mark.parametrize('body, hoisted', [
+    ('s := s + a[k]; writeInteger(s)', True),
+    ('writeInteger(s); s := s + a[k]', False),
+    ('s := s + a[i] + a[k]', True),
+    ('a[i] := 0; s := s + a[k]', False),
+])
+def test_hoisting(tmp_path, body, hoisted):
+    # Checks are hoisted only if nothing before them is observable
+    source = tmp_path / 'hoist.pcl'
+    source.write_text('''
+    program hoist;
+    var a : array [10] of integer; i, k, s : integer;
+    begin
+        k := readInteger(); i := 0;
+        while i < 10 do
+        begin
+            {};
+            i := i + 1
+        end
+    end.
+    '''.format(body))
+    _, loops = analyze(str(source))
+    assert bool(loops[0].hoisted) == hoisted
+
+
+def test_runtime(tmp_path):
+    source = tmp_path / 'heap.pcl'
+    source.write_text('''
+    program heap;
+    var x : array [3] of integer; p : ^array of integer; i, k, s : integer;
+
+        procedure set(var a : array of integer);
+            var q : ^array of integer;
+        begin
+            q := @a;
+            q^[2] := 7
+        end;
+
+    begin
+        set(x);
+        new [4] p;
+        p^[3] := x[2];
+        writeInteger(p^[3]);
+        k := readInteger(); i := 0; s := 0;
+        while i < 3 do
+        begin
+            writeInteger(i);
+            s := s + x[k] + p^[k];
+            i := i + 1
+        end
+    end.
+    ''')
+    subprocess.run([sys.executable, '../pclc.py', str(source), '--bounds-check'],
+                   check=True)
+
+    def run(k):
+        return subprocess.run([str(tmp_path / 'heap.out')], input=k,
+                              capture_output=True, universal_newlines=True)
+
+    # q points to x, whose length the runtime does not know
+    result = run('1')
+    assert result.stdout == '7012' and not result.stderr
+    # x[k] fails in the first iteration, after its output
+    result = run('3')
+    assert result.returncode == 1 and result.stdout == '70'
+    assert result.stderr == 'line 21: index 3 out of bounds [0, 3)\n'
+    # p^[k] is checked against the length that new recorded
+    assert run('5').stderr.startswith('line 21: index 5')
+
+
+if __name__ == '__main__':
+    pytest.main(args=[os.path.abspath(__file__)])
@@ -0,0 +1,48 @@
+import os
+import pytest
+from pcl import PCLParser as Parser
+from pcl import PCLLexer as Lexer
+
+lexer = Lexer()
+
+
+def compile_(filename):
+    parser = Parser()
+    with open(filename, 'r', encoding='ascii') as f:
+        example = f.read()
+    program = parser.parse(lexer.tokenize(example))
+    program.sem()
+    program.codegen()
+    parser.codegen.postprocess_module(level=0)
+    return {fn.name: list(fn.blocks)
+            for fn in parser.codegen.module.functions
+            if not fn.is_declaration and fn.linkage.name != 'linkonce_odr'}
+
+
+@pytest.mark.parametrize('filename', ['../examples/pos/deadcode.pcl',
+                                      '../examples/pos/yes.pcl',
+                                      '../examples/official/bsort.pcl'])
+def test_clean(filename):
+    for name, blocks in compile_(filename).items():
+        for block in blocks[1:]:
+            instrs = list(block.instructions)
+            # No blocks that only jump elsewhere
+            assert not (len(instrs) == 1 and instrs[0].opcode == 'br' and
+                        len(list(instrs[0].operands)) == 1), name
+
+
+def test_dead_code():
+    functions = compile_('../examples/pos/deadcode.pcl')
+    # Statements after return are not generated and
+    # the guard return is emitted only when reachable
+    assert len(functions['f_1']) == 3
+    assert len(functions['main']) == 3
+    for blocks in functions.values():
+        for block in blocks:
+            rets = [instr for instr in block.instructions
+                    if instr.opcode in ('ret', 'br')]
+            assert len(rets) == 1
+
+
+if __name__ == '__main__':
+    pytest.main(args=[os.path.abspath(__file__)])
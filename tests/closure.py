@@ -0,0 +1,51 @@
+import os
+import pytest
+from pcl import PCLParser as Parser
+from pcl import PCLLexer as Lexer
+from pcl import ClosureConverter
+from pcl import LocalHeader
+
+lexer = Lexer()
+
+
+def convert(filename):
+    parser = Parser()
+    with open(filename, 'r', encoding='ascii') as f:
+        example = f.read()
+    program = parser.parse(lexer.tokenize(example))
+    program.sem()
+    ClosureConverter(program).run()
+    headers = {node.header.id_: node for node in program.walk()
+               if isinstance(node, LocalHeader)}
+    return program, headers
+
+
+def test_nested():
+    program, headers = convert('../examples/pos/nested.pcl')
+
+    # Globals used by procedures stay static
+    assert program.captured == {'g'}
+
+    free = {name: [(var.id_, var.owner.header.id_, var.direct)
+                   for var in header.free]
+            for name, header in headers.items()}
+
+    assert free['outer'] == []
+    assert free['add'] == [('acc', 'outer', True), ('k', 'outer', True)]
+    assert free['put'] == [('arr', 'outer', True), ('j', 'fill', True),
+                           ('n', 'outer', True)]
+    # fill passes the free variables of put and add
+    assert free['fill'] == [('arr', 'outer', False), ('n', 'outer', False),
+                            ('acc', 'outer', False), ('k', 'outer', False)]
+    assert free['sum'] == [('arr', 'outer', True)]
+
+
+def test_flat():
+    program, headers = convert('../examples/official/bsort.pcl')
+    assert program.captured == set()
+    for header in headers.values():
+        assert header.free == []
+
+
+if __name__ == '__main__':
+    pytest.main(args=[os.path.abspath(__file__)])
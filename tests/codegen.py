@@ -0,0 +1,514 @@
+import os
+import re
+import sys
+import subprocess
+import pytest
+from pcl import PCLParser as Parser
+from pcl import PCLLexer as Lexer
+from pcl import LLVMTypes, ClosureConverter, PCLCodegenError
+from llvmlite import ir, binding
+
+lexer = Lexer()
+
+
+def compile_(filename, pipeline=()):
+    parser = Parser()
+    with open(filename, 'r', encoding='ascii') as f:
+        example = f.read()
+    program = parser.parse(lexer.tokenize(example))
+    program.sem()
+    for stage in pipeline:
+        stage(program).run()
+    program.codegen()
+    parser.codegen.postprocess_module(level=0)
+    return {fn.name: list(fn.blocks)
+            for fn in parser.codegen.module.functions
+            if not fn.is_declaration and fn.linkage.name != 'linkonce_odr'}
+
+
+def parse(text):
+    ''' Module of the program text, before optimization '''
+    parser = Parser()
+    program = parser.parse(lexer.tokenize(text))
+    program.sem()
+    program.codegen()
+    return parser.codegen.module
+
+
+def run_(tmp_path, text, flags=(), input_=''):
+    ''' Compiles the program text with pclc (and flags) and runs it '''
+    source = tmp_path / 'test.pcl'
+    source.write_text(text)
+    subprocess.run([sys.executable, '../pclc.py', str(source)] + list(flags),
+                   check=True)
+    return subprocess.run([str(tmp_path / 'test.out')], input=input_,
+                          capture_output=True, universal_newlines=True).stdout
+
+
+def optimized(text, flags=()):
+    ''' IR of the program text, as pclc (with flags) optimizes it '''
+    return subprocess.run([sys.executable, '../pclc.py', '-i'] + list(flags),
+                          input=text, capture_output=True, check=True,
+                          universal_newlines=True).stdout
+
+
+def test_tbaa():
+    parser = Parser()
+    with open('../examples/pos/tbaa.pcl', 'r', encoding='ascii') as f:
+        program = parser.parse(lexer.tokenize(f.read()))
+    program.sem()
+    program.codegen()
+    builder = parser.codegen.builder
+    assert builder.tbaa_name(LLVMTypes.T_REAL) == 'real'
+    assert builder.tbaa_name(ir.ArrayType(LLVMTypes.T_INT, 0).as_pointer()) == \
+        'pointer to array of integer'
+    assert builder.tbaa_name(ir.ArrayType(LLVMTypes.T_INT, 4)) is None
+
+    # Every scalar access carries the tag of its type
+    for fn in parser.codegen.module.functions:
+        for block in fn.blocks:
+            for instr in block.instructions:
+                if isinstance(instr, (ir.LoadInstr, ir.StoreInstr)):
+                    typ = instr.type if isinstance(instr, ir.LoadInstr) \
+                        else instr.operands[0].type
+                    tag = builder.tbaa(typ)
+                    assert instr.metadata.get('tbaa', None) is tag
+
+
+def test_tail_calls():
+    functions = compile_('../examples/pos/tailcall.pcl', [ClosureConverter])
+
+    def calls(name):
+        ''' Callees and tail markers of the calls of function name '''
+        return [(list(instr.operands)[-1].name,
+                 next((m for m in ['musttail', 'tail']
+                       if ' {} call'.format(m) in str(instr)), None))
+                for block in functions[name] for instr in block.instructions
+                if instr.opcode == 'call']
+
+    # Self-recursive tail calls become loops
+    for name in ['gcd_1', 'sum_1', 'count_1']:
+        assert any(block.name == 'tailrecurse' for block in functions[name])
+        assert calls(name) == []
+    assert calls('quarter_1') == [('half_1', 'musttail')]
+    # x lives on the frame of escape
+    assert calls('escape_1') == [('count_1', None)]
+
+
+def test_directives():
+    parser = Parser()
+    with open('../examples/pos/directives.pcl', 'r', encoding='ascii') as f:
+        program = parser.parse(lexer.tokenize(f.read()))
+    program.sem()
+    program.codegen()
+    module = parser.codegen.module
+
+    def loops(name):
+        ''' Properties of the llvm.loop metadata of the loops of name '''
+        loops = []
+        for block in module.get_global(name).blocks:
+            if block.terminator is None:
+                continue
+            loop = block.terminator.metadata.get('llvm.loop', None)
+            if loop is not None:
+                assert loop.operands[0] is loop
+                loops.append([node.operands[0].string
+                              for node in loop.operands[1:]])
+        return loops
+
+    assert loops('fill_1') == [['llvm.loop.vectorize.enable',
+                                'llvm.loop.vectorize.width',
+                                'llvm.loop.unroll.count']]
+    # Directives that do not apply to loops are dropped
+    assert loops('main') == [['llvm.loop.unroll.enable']]
+    assert 'alwaysinline' in module.get_global('sq_1').attributes
+    assert 'noinline' in module.get_global('fill_1').attributes
+
+
+def test_packed_booleans():
+    parser = Parser()
+    with open('../examples/pos/packed.pcl', 'r', encoding='ascii') as f:
+        program = parser.parse(lexer.tokenize(f.read()))
+    program.sem()
+    parser.codegen.set_packed_booleans()
+    program.codegen()
+    module = parser.codegen.module
+
+    # 1000 booleans fit in 16 words
+    sieve, = [value for value in module.global_values
+              if value.name.startswith('sieve_')]
+    assert sieve.type.pointee == ir.ArrayType(LLVMTypes.T_WORD, 16)
+    assert sieve.type.pointee.length == 1000
+    # Elements are read and written as bits of whole words
+    for fn in module.functions:
+        for block in fn.blocks:
+            for instr in block.instructions:
+                if isinstance(instr, (ir.LoadInstr, ir.StoreInstr)):
+                    typ = instr.type if isinstance(instr, ir.LoadInstr) \
+                        else instr.operands[0].type
+                    assert typ != LLVMTypes.T_BOOL
+
+
+def test_array_copy():
+    parser = Parser()
+    with open('../examples/pos/copy.pcl', 'r', encoding='ascii') as f:
+        program = parser.parse(lexer.tokenize(f.read()))
+    program.sem()
+    program.codegen()
+
+    instrs = [instr for block in parser.codegen.module.get_global('main').blocks
+              for instr in block.instructions]
+    # Arrays are never loaded, they are copied with memcpy
+    assert not any(isinstance(instr, ir.LoadInstr) and
+                   isinstance(instr.type, ir.ArrayType) for instr in instrs)
+    copies = [(instr.args[2].constant,
+               [instr.arg_attributes[i].align for i in range(2)])
+              for instr in instrs if isinstance(instr, ir.CallInstr) and
+              instr.callee.name.startswith('llvm.memcpy')]
+    # b := a, p^ := b, m[3] := m[1] and s := "hello"
+    assert copies == [(8000, [64, 64]), (8000, [4, 64]), (24, [8, 8]), (6, [1, 1])]
+
+
+def test_elementwise():
+    parser = Parser()
+    with open('../examples/pos/elementwise.pcl', 'r', encoding='ascii') as f:
+        program = parser.parse(lexer.tokenize(f.read()))
+    program.sem()
+    program.codegen()
+
+    blocks = list(parser.codegen.module.get_global('main').blocks)
+    loops = [block for block in blocks if block.name.startswith('elementwise.body')]
+    # One loop per assignment, marked for vectorization
+    assert len(loops) == 6
+    for block in loops:
+        loop = block.terminator.metadata['llvm.loop']
+        assert loop.operands[1].operands[0].string == 'llvm.loop.vectorize.enable'
+    # No temporary arrays and the call is evaluated once, before its loop
+    assert not any(isinstance(instr, ir.AllocaInstr)
+                   for block in blocks for instr in block.instructions)
+    assert not any(isinstance(instr, ir.CallInstr)
+                   for block in loops for instr in block.instructions)
+
+
+def test_literal_copies():
+    parser = Parser()
+    with open('../examples/pos/literals.pcl', 'r', encoding='ascii') as f:
+        program = parser.parse(lexer.tokenize(f.read()))
+    program.sem()
+    program.codegen()
+
+    calls = {instr.callee.name: instr.args[-1]
+             for block in parser.codegen.module.get_global('main').blocks
+             for instr in block.instructions if isinstance(instr, ir.CallInstr)
+             and not instr.callee.name.startswith('llvm.')}
+    # up and readString write to a copy on the stack, writeString
+    # reads the pooled constant
+    assert isinstance(calls['up_1'], ir.Instruction)
+    assert isinstance(calls['readString'], ir.Instruction)
+    assert isinstance(calls['writeString'], ir.Constant)
+
+def test_switch():
+    functions = compile_('../examples/pos/switch.pcl')
+
+    def switches(name):
+        ''' Number of cases of each switch of function name '''
+        return [(len(list(instr.operands)) - 2) // 2
+                for block in functions[name] for instr in block.instructions
+                if instr.opcode == 'switch']
+
+    # The classification chain and the if without else
+    assert switches('main') == [11, 2]
+    # The repeated constant is dropped
+    assert switches('kind_1') == [3]
+    assert not any(instr.opcode == 'icmp' for block in functions['kind_1']
+                   for instr in block.instructions)
+
+
+def test_switch_dead_label():
+    blocks = compile_('../examples/pos/switch2.pcl')['main']
+    switches = [instr for block in blocks for instr in block.instructions
+                if instr.opcode == 'switch']
+    assert len(switches) == 1
+    # The dead case is kept for the goto to its label
+    writes = [instr for block in blocks for instr in block.instructions
+              if instr.opcode == 'call' and 'writeInteger' in str(instr)]
+    assert len(writes) == 3
+
+
+def test_missing_builtins(tmp_path, monkeypatch):
+    parser = Parser()
+    with open('../examples/pos/tbaa.pcl', 'r', encoding='ascii') as f:
+        program = parser.parse(lexer.tokenize(f.read()))
+    program.sem()
+    program.codegen()
+    monkeypatch.setattr(parser.codegen, 'builtins_library', 'pcl_missing')
+    parser.codegen.postprocess_module(level=0)
+
+    # new and dispose are left to the library, linking without it fails
+    with pytest.raises(PCLCodegenError, match='pcl_dispose, pcl_new'):
+        parser.codegen.generate_outputs(str(tmp_path / 'tbaa'))
+
+
+
+def test_short_circuit(tmp_path):
+    text = '''
+    program logic;
+    var i, n : integer;
+
+        function f(x : integer) : boolean;
+        begin
+            writeInteger(x); result := true
+        end;
+
+    begin
+        n := 3; i := readInteger();
+        if (i = n) and f(1) then writeString("a");
+        if (i <> n) or f(2) then writeString("b");
+        if f(3) or f(4) then writeString("c");
+        if (i > 0) and (i < n) then writeString("d")
+    end.
+    '''
+    # The calls run only if the left hand side does not decide the result
+    assert run_(tmp_path, text, input_='5') == 'b3c'
+    assert run_(tmp_path, text, input_='3') == '1a2b3c'
+    assert run_(tmp_path, text, input_='1') == 'b3cd'
+
+    blocks = list(parse(text).get_global('main').blocks)
+    # The calls get their own blocks, equality is predicted not to hold
+    weights = [[operand.constant for operand in
+                block.terminator.metadata['prof'].operands[1:]]
+               if 'prof' in block.terminator.metadata else None
+               for block in blocks if block.terminator is not None and
+               any('.rhs' in target.name for target in block.terminator.operands
+                   if isinstance(target, ir.Block))]
+    assert weights == [[12, 20], [20, 12], None]
+    # The comparisons of the last condition are selected, without a branch
+    assert sum(instr.opname == 'select'
+               for block in blocks for instr in block.instructions) == 1
+
+
+
+def test_intrinsics(tmp_path):
+    text = '''
+    program math;
+    var x : real;
+    begin
+        x := readReal();
+        writeReal(sqrt(x)); writeChar(' ');
+        writeReal(ln(x)); writeChar(' ');
+        writeReal(exp(x)); writeChar(' ');
+        writeReal(fabs(-x)); writeChar(' ');
+        writeReal(sin(x) * sin(x) + cos(x) * cos(x)); writeChar(' ');
+        writeReal(arctan(x)); writeChar(' ');
+        writeReal(sqrt(16.0) + ln(1.0))
+    end.
+    '''
+    assert run_(tmp_path, text, input_='2') == \
+        '1.414214 0.693147 7.389056 2.000000 1.000000 1.107149 4.000000'
+
+    calls = [instr.callee.name for block in parse(text).get_global('main').blocks
+             for instr in block.instructions if isinstance(instr, ir.CallInstr)]
+    assert calls.count('llvm.sqrt.f64') == 2 and calls.count('llvm.log.f64') == 2
+    assert 'arctan' in calls and 'sqrt' not in calls and 'ln' not in calls
+    # The calls with constant arguments are folded
+    module = optimized(text, ['-O', '1'])
+    assert module.count('call double @llvm.sqrt.f64') == 1
+    assert module.count('call double @llvm.log.f64') == 1
+
+
+
+def test_expansions(tmp_path):
+    text = '''
+    program expand;
+    var i : integer; x : real; c : char;
+    begin
+        i := readInteger(); x := i / 4; c := 'a';
+        writeInteger(abs(i)); writeChar(' ');
+        writeInteger(abs(-i)); writeChar(' ');
+        writeInteger(ord(c)); writeChar(' ');
+        writeChar(chr(ord(c) + 2)); writeChar(' ');
+        writeInteger(trunc(x)); writeChar(' ');
+        writeInteger(round(x)); writeChar(' ');
+        writeInteger(round(-x)); writeChar(' ');
+        writeReal(pi())
+    end.
+    '''
+    assert run_(tmp_path, text, ['-O', '0'], input_='-6') == \
+        '6 6 97 c -1 -2 2 3.141593'
+
+    # No calls, even at -O0
+    main = optimized(text, ['-O', '0']).split('define void @main()')[1]
+    main = main[:main.index('\n}')]
+    for name in ['abs', 'ord', 'chr', 'trunc2', 'round2', 'pi']:
+        assert '@{}('.format(name) not in main
+
+
+
+def test_emit(tmp_path):
+    text = '''
+    program emit;
+    begin
+        writeString("emitted")
+    end.
+    '''
+    # Only the link is external: an llc that fails is never run
+    bin_path = tmp_path / 'bin'
+    bin_path.mkdir()
+    (bin_path / 'llc').write_text('#!/bin/sh\nexit 1\n')
+    (bin_path / 'llc').chmod(0o755)
+    env = dict(os.environ, PATH='{}:{}'.format(bin_path, os.environ['PATH']))
+    source = tmp_path / 'emit.pcl'
+    source.write_text(text)
+
+    def pclc(*flags, **kwargs):
+        return subprocess.run([sys.executable, '../pclc.py'] + list(flags),
+                              env=env, capture_output=True, check=True, **kwargs)
+
+    pclc(str(source))
+    assert subprocess.run([str(tmp_path / 'emit.out')],
+                          capture_output=True).stdout == b'emitted'
+    pclc(str(source), '--emit', 'asm')
+    assert 'main:' in (tmp_path / 'emit.s').read_text()
+    pclc(str(source), '--emit', 'bc')
+    module = binding.parse_bitcode((tmp_path / 'emit.bc').read_bytes())
+    assert not module.get_function('main').is_declaration
+    # -f streams the object to stdout
+    assert pclc('-f', input=text.encode()).stdout[:4] == b'\x7fELF'
+
+
+
+def test_pipeline(tmp_path):
+    kernel = '''
+    program kernel;
+    var a : array [1024] of integer; i, s : integer;
+    begin
+        i := 0;
+        while i < 1024 do begin a[i] := 2 * i; i := i + 1 end;
+        i := 0; s := 0;
+        while i < 1024 do begin s := s + a[i]; i := i + 1 end;
+        writeInteger(s)
+    end.
+    '''
+    for level in ['0', '1', '2', '3', 's', 'z']:
+        assert run_(tmp_path, kernel, ['-O', level]) == '1047552'
+    assert run_(tmp_path, kernel, ['--passes', 'sroa', 'licm', 'gvn']) == '1047552'
+
+    def vectorized(*flags):
+        return 'x i32>' in optimized(kernel, flags)
+
+    # The vectorizers follow the level unless --vectorize is given
+    assert vectorized('-O', '3') and vectorized('-O', 's')
+    assert not vectorized('-O', '1') and not vectorized('-O', 'z')
+    assert not vectorized('-O', '3', '--vectorize', 'none')
+    assert vectorized('-O', '1', '--vectorize', 'loop')
+
+    calls = '''
+    program calls;
+    var i : integer;
+
+        function mix(x : integer) : integer;
+            var y : integer;
+        begin
+            y := x * x + 3 * x;
+            if y mod 7 = 0 then y := y div 7;
+            if y mod 5 = 0 then y := y div 5;
+            result := y + x div 3
+        end;
+
+    begin
+        i := readInteger();
+        writeInteger(mix(i) + mix(i + 1) + mix(i + 2))
+    end.
+    '''
+
+    def inlined(*flags):
+        return 'call fastcc i32 @mix_1(' not in optimized(calls, flags)
+
+    assert inlined('-O', '2')
+    assert not inlined('-O', '2', '--inline-threshold', '0')
+
+    with pytest.raises(subprocess.CalledProcessError) as e:
+        optimized(kernel, ['--passes', 'sroa', 'mem2reg'])
+    assert 'Undefined pass: mem2reg' in e.value.stderr
+
+
+
+def test_target(tmp_path):
+    text = '''
+    program target;
+    var a : array [1024] of integer; b : array [3] of integer; i, s : integer;
+    begin
+        i := 0;
+        while i < 1024 do begin a[i] := 2 * i; i := i + 1 end;
+        i := 0; s := 0;
+        while i < 1024 do begin s := s + a[i]; i := i + 1 end;
+        b[1] := s;
+        writeInteger(b[1])
+    end.
+    '''
+    # The host by default
+    assert run_(tmp_path, text, ['-O', '3']) == '1047552'
+
+    # The data layout and the width of the vectors are the ones of the target
+    module = optimized(text, ['-O', '3', '-mcpu', 'x86-64', '-mattr=+avx2'])
+    assert 'target datalayout = "e-m:e-' in module
+    assert '<8 x i32>' in module
+    module = optimized(text, ['-O', '3', '-mcpu', 'x86-64', '-mattr=-avx'])
+    assert '<8 x i32>' not in module and '<4 x i32>' in module
+
+    # Large arrays are aligned for the wide loads
+    module = optimized(text, ['-O', '0'])
+    assert '%a = alloca [1024 x i32], align 64' in module
+    assert '@b_1 = internal global [3 x i32] zeroinitializer\n' in module
+
+    # Emission uses the same target
+    source = tmp_path / 'test.pcl'
+    for mattr, registers in [('+avx2', 'ymm'), ('-avx', 'xmm')]:
+        subprocess.run([sys.executable, '../pclc.py', str(source), '-O', '3',
+                        '-mcpu', 'x86-64', '-mattr=' + mattr, '--emit', 'asm'],
+                       check=True)
+        assert '%' + registers in (tmp_path / 'test.s').read_text()
+
+
+
+def test_fast_math(tmp_path):
+    text = '''
+    program dot;
+    var a, b : array [1024] of real; i : integer; s, x : real;
+    begin
+        x := readReal();
+        i := 0;
+        while i < 1024 do begin a[i] := i; b[i] := x; i := i + 1 end;
+        i := 0; s := 0.0;
+        while i < 1024 do begin s := s + a[i] * b[i]; i := i + 1 end;
+        if s > 0.0 then writeReal(sqrt(s))
+    end.
+    '''
+    for flags in [[], ['-ffast-math']]:
+        assert run_(tmp_path, text, ['-O', '3'] + flags, input_='0.5') == '511.749939'
+
+    # Every floating point instruction and intrinsic gets the flags
+    module = optimized(text, ['-O', '0', '--fast-math-flags', 'nnan', 'ninf'])
+    main = module.split('define void @main()')[1]
+    main = main[:main.index('\n}')]
+    instrs = re.findall(r'= (?:fadd|fmul|fcmp|call)[a-z ]* double', main)
+    # The calls are readReal and sqrt
+    assert len(instrs) == 5
+    assert all(' nnan ninf ' in instr for instr in instrs)
+
+    # The reduction is vectorized only if it may be reassociated
+    target = ['-O', '3', '-mcpu', 'x86-64', '-mattr=+avx2,+fma']
+    assert 'fadd double' in optimized(text, target)
+    assert 'fadd reassoc <4 x double>' in optimized(
+        text, target + ['--fast-math-flags', 'reassoc'])
+
+    # and multiplications are fused with the additions if contracted
+    source = tmp_path / 'test.pcl'
+    for flags, fused in [([], False), (['--fast-math-flags', 'contract'], True)]:
+        subprocess.run([sys.executable, '../pclc.py', str(source), '--emit', 'asm']
+                       + target + flags, check=True)
+        assert ('vfmadd' in (tmp_path / 'test.s').read_text()) == fused
+
+
+if __name__ == '__main__':
+    pytest.main(args=[os.path.abspath(__file__)])
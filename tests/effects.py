@@ -0,0 +1,64 @@
+import os
+import pytest
+from pcl import PCLParser as Parser
+from pcl import PCLLexer as Lexer
+from pcl import ClosureConverter, EffectAnalyzer
+from pcl import LocalHeader, LLVMAttributes
+
+lexer = Lexer()
+
+
+def analyze(filename):
+    parser = Parser()
+    with open(filename, 'r', encoding='ascii') as f:
+        example = f.read()
+    program = parser.parse(lexer.tokenize(example))
+    program.sem()
+    ClosureConverter(program).run()
+    EffectAnalyzer(program).run()
+    return {node.header.id_: node.effects for node in program.walk()
+            if isinstance(node, LocalHeader)}
+
+
+def test_effects():
+    effects = analyze('../examples/pos/effects.pcl')
+    attributes = {name: sorted(LLVMAttributes.of(e))
+                  for name, e in effects.items()}
+
+    assert attributes['square'] == [
+        'norecurse', 'nounwind', 'readnone', 'willreturn']
+    # Loops may not terminate
+    assert attributes['power'] == ['norecurse', 'nounwind', 'readnone']
+    assert attributes['getg'] == [
+        'norecurse', 'nounwind', 'readonly', 'willreturn']
+    assert attributes['inc'] == [
+        'argmemonly', 'norecurse', 'nounwind', 'willreturn']
+    # inc writes g through its by-reference parameter
+    assert effects['bump'].writes == {'global'}
+    assert attributes['fact'] == ['nounwind', 'readnone']
+    assert effects['show'].writes == {'io'}
+
+
+def test_nested():
+    effects = analyze('../examples/pos/nested.pcl')
+    # Free variables are passed by reference
+    assert effects['put'].writes == {'arg'}
+    assert effects['add'].writes == {'arg', 'global'}
+    assert effects['fill'].writes == {'arg', 'global'}
+    assert sorted(LLVMAttributes.of(effects['sum'])) == [
+        'argmemonly', 'norecurse', 'nounwind', 'readonly']
+    # The locals of outer are not free in outer itself
+    assert effects['outer'].writes == {'global', 'io'}
+    assert effects['outer'].recursive
+
+
+
+def test_static_locals():
+    effects = analyze('../examples/pos/static.pcl')
+    # The locals of f exceed its frame and are kept in globals
+    assert effects['f'].reads == {'global'}
+    assert effects['f'].writes == {'global'}
+    assert 'readnone' not in LLVMAttributes.of(effects['f'])
+
+if __name__ == '__main__':
+    pytest.main(args=[os.path.abspath(__file__)])
@@ -1,5 +1,6 @@
 import pytest
 from pcl import PCLLexer as Lexer
+from pcl import Directive
 import pytest
 import os
 
@@ -121,6 +122,20 @@ def test_collatz():
 #                            'END', 'COLON'])
 
 
+def test_directives():
+    s = '''
+    (* $inline *) (*$inline*)
+    (*$unroll 4 x*) (*$vectorize width=8*) while
+    '''
+    tokens = list(lexer.tokenize(s))
+    assert [x.type for x in tokens] == ['WHILE']
+    assert tokens[0].directives == [
+        Directive('inline', (), {}, 2),
+        Directive('vectorize', (), {'width': 8}, 3)]
+    assert Lexer.directive('(*$unroll 4*)', 1) == Directive('unroll', (4,), {}, 1)
+    assert Lexer.directive('(*$unroll count=*)', 1) is None
+
+
 def test_reals():
     s = '''
     program reals;
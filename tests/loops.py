@@ -0,0 +1,158 @@
+import os
+import pytest
+from pcl import PCLParser as Parser
+from pcl import PCLLexer as Lexer
+from pcl import ClosureConverter, LoopAnalyzer, BoundsAnalyzer
+from pcl import While
+from llvmlite import ir
+
+lexer = Lexer()
+
+
+def analyze(text):
+    parser = Parser()
+    program = parser.parse(lexer.tokenize(text))
+    program.sem()
+    for stage in [ClosureConverter, LoopAnalyzer]:
+        stage(program).run()
+    return [node.counted for node in program.walk() if isinstance(node, While)]
+
+
+def test_counted():
+    with open('../examples/pos/loops.pcl', 'r', encoding='ascii') as f:
+        loops = analyze(f.read())
+
+    assert [None if loop is None else (loop.id_, loop.inclusive, loop.trips)
+            for loop in loops] == [
+        ('pos', False, None),
+        # j is also incremented by the nested procedure
+        None,
+        ('i', True, None),
+        # The address of k is taken, p^ may modify it
+        None,
+        ('i', False, 0),
+        None,
+    ]
+
+
+@pytest.mark.parametrize('body', [
+    'i := i + 2',
+    'i := i + 1; a[i] := 0',
+    'n := n - 1; i := i + 1',
+    'inc(i); i := i + 1',
+    'inc(n); i := i + 1',
+])
+def test_not_counted(body):
+    text = '''
+    program loops;
+    var a : array [100] of integer; i, n : integer;
+
+    procedure inc(var x : integer);
+    begin
+        x := x + 1
+    end;
+
+    begin
+        n := 100;
+        i := 0;
+        while i < n do
+        begin
+            {}
+        end
+    end.
+    '''.format(body)
+    assert analyze(text) == [None]
+
+
+@pytest.mark.parametrize('before', ['inc(i)', 'inc(n)', 'p := @i', 'p := @n'])
+def test_escaped(before):
+    text = '''
+    program loops;
+    var a : array [100] of integer; i, n : integer; p : ^integer;
+
+    procedure inc(var x : integer);
+    begin
+        x := x + 1
+    end;
+
+    begin
+        {};
+        n := 100;
+        i := 0;
+        while i < n do
+        begin
+            p^ := 0;
+            i := i + 1
+        end
+    end.
+    '''.format(before)
+    assert analyze(text) == [None]
+
+def test_trips():
+    text = '''
+    program loops;
+    var i : integer;
+    begin
+        i := 3;
+        while i <= 2 * 5 do
+            i := i + 1
+    end.
+    '''
+    assert analyze(text)[0].trips == 8
+
+
+def test_codegen():
+    parser = Parser()
+    with open('../examples/pos/loops.pcl', 'r', encoding='ascii') as f:
+        program = parser.parse(lexer.tokenize(f.read()))
+    program.sem()
+    for stage in [ClosureConverter, LoopAnalyzer]:
+        stage(program).run()
+    program.codegen()
+
+    blocks = {block.name: block for block in
+              parser.codegen.module.get_global('find_1').blocks}
+    # Guard, preheader and a body that starts with the induction variable
+    assert 'while.pre' in blocks
+    body = blocks['while.body']
+    assert isinstance(body.instructions[0], ir.PhiInstr)
+    latches = [block for block in blocks.values() if block.name != 'while.pre'
+               and body in block.terminator.operands]
+    assert len(latches) == 1
+    # The body may not terminate, the loop is not llvm.loop.mustprogress
+    assert 'llvm.loop' not in latches[0].terminator.metadata
+    assert any(instr.opname == 'add' and 'nsw' in instr.flags
+               for instr in latches[0].instructions)
+
+
+
+def test_bounds_check():
+    text = '''
+    program loops;
+    var a : array [10] of integer; i, k : integer;
+    begin
+        k := readInteger(); i := 0;
+        while i < 3 do
+        begin
+            a[k] := i;
+            i := i + 1
+        end
+    end.
+    '''
+    parser = Parser()
+    program = parser.parse(lexer.tokenize(text))
+    program.sem()
+    for stage in [ClosureConverter, BoundsAnalyzer, LoopAnalyzer]:
+        stage(program).run()
+    program.codegen()
+    parser.codegen.postprocess_module(level=0)
+
+    blocks = {block.name: block for block in
+              parser.codegen.module.get_function('main').blocks}
+    # The hoisted check of a[k] splits the preheader, its last
+    # block is the incoming block of the induction variable
+    phi = next(iter(blocks['while.body'].instructions))
+    assert phi.opcode == 'phi' and 'while.pre.endif' in str(phi)
+
+if __name__ == '__main__':
+    pytest.main(args=[os.path.abspath(__file__)])
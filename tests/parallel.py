@@ -0,0 +1,68 @@
+import os
+import pytest
+from pcl import PCLParser as Parser
+from pcl import PCLLexer as Lexer
+from pcl import ClosureConverter, EffectAnalyzer, ParallelAnalyzer
+from pcl import PCLSemError, While
+
+lexer = Lexer()
+
+
+def analyze(text):
+    parser = Parser()
+    program = parser.parse(lexer.tokenize(text))
+    program.sem()
+    for stage in [ClosureConverter, EffectAnalyzer, ParallelAnalyzer]:
+        stage(program).run()
+    return [node.parallel for node in program.walk() if isinstance(node, While)]
+
+
+def test_parallel():
+    with open('../examples/pos/parallel.pcl', 'r', encoding='ascii') as f:
+        loops = analyze(f.read())
+
+    assert [(loop.id_, loop.private, loop.chunk) for loop in loops
+            if loop is not None] == [
+        ('i', set(), 0),
+        ('i', set(), 0),
+        ('i', {'x'}, 100),
+        ('i', {'j', 'last'}, 0),
+    ]
+    # The inner loop runs serially
+    assert loops[-1] is None and loops[-2].inclusive
+
+
+@pytest.mark.parametrize('body', [
+    # Reduction
+    'x := x + a[i]',
+    # Other iterations read a[i + 1]
+    'a[i] := a[i + 1]',
+    'a[i] := b[i]; b[i + 1] := 1.0',
+    'writeInteger(i)',
+    'p^ := 1',
+    'n := 3',
+    # x is used before it is assigned
+    'a[i] := x; x := 1.0',
+    'if a[i] > 0.0 then i := i + 1',
+])
+def test_reject(body):
+    text = '''
+    program reject;
+    var a, b : array [100] of real; i, n : integer; x : real; p : ^integer;
+    begin
+        i := 0;
+        n := 100;
+        (*$parallel*)
+        while i < n do
+        begin
+            {};
+            i := i + 1
+        end
+    end.
+    '''.format(body)
+    with pytest.raises(PCLSemError):
+        analyze(text)
+
+
+if __name__ == '__main__':
+    pytest.main(args=[os.path.abspath(__file__)])
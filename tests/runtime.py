@@ -0,0 +1,64 @@
+import os
+import sys
+import subprocess
+import pytest
+from llvmlite import binding
+from pcl.runtime import PCLRuntime
+
+
+def test_library():
+    # libbuiltins.so gets the builtins of builtins.h from the runtime module
+    module = binding.parse_assembly(PCLRuntime().library())
+    module.verify()
+    defined = {fn.name for fn in module.functions if not fn.is_declaration}
+    assert defined == {
+        'writeInteger', 'writeBoolean', 'writeChar', 'writeReal', 'writeString',
+        'readInteger', 'readBoolean', 'readChar', 'readReal', 'readString',
+        'ln', 'arctan', 'pi', 'trunc2', 'round2', 'chr', 'ord',
+        'pcl_bounds_error'}
+    for name in defined:
+        assert module.get_function(name).linkage == binding.Linkage.external
+
+    # Programs link the same functions as linkonce_odr
+    module = binding.parse_assembly(str(PCLRuntime()))
+    assert all(fn.linkage == binding.Linkage.linkonce_odr
+               for fn in module.functions if not fn.is_declaration)
+
+
+
+def test_allocator(tmp_path):
+    source = tmp_path / 'heap.pcl'
+    source.write_text('''
+    program heap;
+    var p : ^integer; q : ^array of integer; r : ^array of real; i : integer;
+    begin
+        i := 0;
+        while i < 100 do
+        begin
+            new p; p^ := i; dispose p; i := i + 1
+        end;
+        new [2000] q; q^[1999] := 7; writeInteger(q^[1999]); dispose [] q;
+        new [10] r; r^[9] := 1.5; writeReal(r^[9]); dispose [] r
+    end.
+    ''')
+    subprocess.run([sys.executable, '../pclc.py', str(source)], check=True)
+
+    def run(env):
+        return subprocess.run([str(tmp_path / 'heap.out')], capture_output=True,
+                              universal_newlines=True, env=dict(os.environ, **env))
+
+    result = run({})
+    assert result.stdout == '71.500000' and result.stderr == ''
+
+    # A disposed block is reused by the next new of its size class, the
+    # array of 8000 bytes is mapped on its own
+    stats = run({'PCL_ALLOC_STATS': '1'}).stderr.splitlines()
+    assert 'new: 102 (large: 1, reused: 99)' in stats
+    assert 'dispose: 102' in stats
+    assert 'arenas: 1 x 1048576 bytes' in stats
+    assert stats[-2:] == ['  class     32: 100', '  class    128: 1']
+    assert any(line.startswith('live bytes: 0,') for line in stats)
+
+
+if __name__ == '__main__':
+    pytest.main(args=[os.path.abspath(__file__)])
@@ -0,0 +1,35 @@
+import os
+import pytest
+from pcl import PCLParser as Parser
+from pcl import PCLLexer as Lexer
+
+lexer = Lexer()
+
+
+def compile_(filename):
+    parser = Parser()
+    with open(filename, 'r', encoding='ascii') as f:
+        example = f.read()
+    program = parser.parse(lexer.tokenize(example))
+    program.sem()
+    program.codegen()
+    parser.codegen.postprocess_module(level=0)
+    return {fn.name: list(fn.blocks)
+            for fn in parser.codegen.module.functions
+            if not fn.is_declaration and fn.linkage.name != 'linkonce_odr'}
+
+
+def test_value_numbering():
+    functions = compile_('../examples/pos/valuenum.pcl')
+    opcodes = [instr.opcode for block in functions['main']
+               for instr in block.instructions]
+    # i in the condition and in the body, s in the body and after the
+    # loop. a[i] is forwarded from the store and i * i is computed once
+    assert opcodes.count('load') == 4
+    assert opcodes.count('mul') == 1
+    # The condition is generated once
+    assert opcodes.count('icmp') == 1
+
+
+if __name__ == '__main__':
+    pytest.main(args=[os.path.abspath(__file__)])